@@ -5,17 +5,106 @@
 #                         Dmitrii Kuvaiskii <dmitrii.kuvaiskii@intel.com>
 
 import argparse
+import codecs
+import collections
+import concurrent.futures
+import fnmatch
+import heapq
+import itertools
+import json
 import os
 import re
 import pathlib
+import shlex
+import shutil
+import struct
 import subprocess
 import sys
+import threading
+import time
 
 import hashlib
-import jinja2
 import tomli
 import tomli_w
 
+# Files are read in large blocks so that hashing threads spend most of their time in `read()` and
+# `hashlib.update()`, both of which release the GIL
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Maximum number of files queued for hashing (or hashed but not yet written to the manifest) per
+# hashing worker; bounds the memory used by the streaming pipeline
+PENDING_FILES_PER_WORKER = 64
+
+# Version of the hash index format, see `load_hash_index()`
+HASH_INDEX_VERSION = 1
+
+# Special files and paths which are never added as trusted files
+EXCLUDED_PATHS_RE = re.compile(r'^/('
+                               r'boot/.*'
+                               r'|\.dockerenv'
+                               r'|\.dockerinit'
+                               r'|dev/.*'
+                               r'|etc/gshadow.*'
+                               r'|etc/mtab'
+                               r'|etc/\.pwd\.lock'
+                               r'|etc/rc(\d|.)\.d/.*'
+                               r'|etc/security/.*'
+                               r'|etc/shadow.*'
+                               r'|gramine/python/.*'
+                               r'|gramine/app_files/access_trace\.log'
+                               r'|gramine/app_files/entrypoint\.manifest\.tmp'
+                               r'|gramine/app_files/finalize_manifest\.py'
+                               r'|gramine/(app_files|meson_build_output)/'
+                               r'gsc_hash_index(\.prev)?\.json'
+                               r'|proc/.*'
+                               r'|sys/.*'
+                               r'|var/.*)$')
+
+# Number of entries in the "top directories" and "largest files" lists of the finalize report
+REPORT_TOP_ENTRIES = 20
+
+# Prefix of the line with the finalize report on stdout (`--report -`), so that GSC can pick the
+# report out of the output of `docker build` instead of storing it in the image
+REPORT_LINE_PREFIX = 'GSC_FINALIZE_REPORT: '
+
+# ELF constants used by `read_elf_info()`, see `man 5 elf`
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFDATA2LSB = 1
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# Directories searched by the dynamic loader after `LD_LIBRARY_PATH` and `DT_RUNPATH`
+DEFAULT_LIBRARY_DIRS = ['/lib', '/usr/lib', '/lib64', '/usr/lib64']
+
+# Syscalls which open or execute a file, as printed in Gramine trace logs (`loader.log_level =
+# "trace"`, e.g. `[P1:T1:ls] trace: ---- openat(AT_FDCWD, "/etc/passwd", O_RDONLY, 0000) = 0x3`) and
+# by strace (e.g. `[pid 42] execve("/bin/ls", ["ls"], 0x7ffd /* 9 vars */) = 0`); the return value
+# is missing for strace's `<unfinished ...>` calls
+ACCESS_TRACE_RE = re.compile(r'\b(?:open|openat|openat2|creat|execve|execveat)\('
+                             r'(?:[^,"]*, )?"((?:[^"\\]|\\.)*)"'
+                             r'(?:.*\) += (-?)\w+|.*<unfinished \.\.\.>)')
+
+# Maximum number of nested shebang interpreters (same as Linux' `BINPRM_MAX_RECURSION`)
+MAX_SHEBANG_NESTING = 4
+
+# Names of shared libraries (`libfoo.so`, `libfoo.so.1.2` etc.), see `generate_runtime_payload()`
+SHARED_OBJECT_RE = re.compile(r'\.so(\.[0-9]+)*$')
+
+# Install tags of meson (see `meson install --tags`) of files which are not needed at runtime:
+# headers, pkg-config files, static libraries, documentation etc.
+MESON_DEVEL_TAGS = {'devel', 'bin-devel', 'man', 'doc'}
+
+class ManifestError(Exception):
+    pass
+
 def is_utf8(filename_bytes):
     try:
         filename_bytes.decode('UTF-8')
@@ -31,102 +120,911 @@ def uri2path(uri):
 def compute_sha256(filename):
     sha256 = hashlib.sha256()
     with open(filename, 'rb') as f:
-        for byte_block in iter(lambda: f.read(128 * sha256.block_size), b''):
+        for byte_block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
             sha256.update(byte_block)
     return sha256.hexdigest()
 
-def expand_trusted_files(trusted_files):
-    expanded_files = []
-    for uri in trusted_files:
-        file_path = uri2path(uri)
-        if file_path.exists():
-            expanded_files.append({'uri': uri, 'sha256': compute_sha256(file_path)})
+def default_num_workers():
+    try:
+        # respects CPU affinity (e.g. `docker build --cpuset-cpus`)
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def load_hash_index(filenames, strict=False):
+    # The hash index is a JSON file with the layout `{"version": 1, "files": {path: [size,
+    # mtime_ns, sha256, inode, ctime_ns], ...}}`. It is written by a previous finalization (e.g. of
+    # the base-Gramine image) and allows to skip re-hashing files whose stat data did not change
+    # since then. A non-strict index compares only size and mtime, which are preserved when files
+    # are copied into a new image layer; it is used only for the files in its own directory (e.g.
+    # the Gramine installation, indexed by GSC itself and copied without changes). A strict index
+    # also compares the inode number and ctime, which change whenever a file is written, even if
+    # its size and mtime are kept (e.g. by builds with normalized mtimes); this is needed for
+    # indexes of files which GSC doesn't control, e.g. of a previous build of the application image.
+    hash_index = {}
+    for filename in filenames:
+        try:
+            with open(filename, 'r', encoding='UTF-8') as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            print(f'\t[from inside Docker container] Ignoring malformed hash index `{filename}`: '
+                  f'{e}')
+            continue
+        if index.get('version') != HASH_INDEX_VERSION:
+            print(f'\t[from inside Docker container] Ignoring hash index `{filename}` of '
+                  f'unsupported version.')
+            continue
+        index_dir = os.path.dirname(os.path.abspath(filename))
+        for path, entry in index['files'].items():
+            if strict:
+                hash_index[path] = entry
+            elif path.startswith(index_dir + '/'):
+                hash_index[path] = entry[:3]
+    return hash_index
+
+# Writes the entries of the hash index `filename` for `paths` to `new_filename`, e.g. for the files
+# of the runtime payload (see `generate_runtime_payload()`)
+def filter_hash_index(filename, new_filename, paths):
+    try:
+        with open(filename, 'r', encoding='UTF-8') as index_file:
+            index = json.load(index_file)
+    except ValueError:
+        # ignored by `load_hash_index()` as well
+        return
+    paths = set(paths)
+    index['files'] = {path: entry for path, entry in index['files'].items() if path in paths}
+    with open(new_filename, 'w', encoding='UTF-8') as index_file:
+        json.dump(index, index_file, separators=(',', ':'))
+
+def write_hash_index(filename, hash_index):
+    with open(filename, 'w', encoding='UTF-8') as index_file:
+        json.dump({'version': HASH_INDEX_VERSION, 'files': hash_index}, index_file,
+                  separators=(',', ':'))
+
+class FinalizeReport:
+    # Collects timings and statistics of finalizing the manifest, written as a JSON report. The
+    # walk, hash and dump phases overlap (see `expand_trusted_files()`), so each of them is the time
+    # the main thread spent in that phase; `hash_worker` is the time spent hashing summed over all
+    # hashing workers. A high `walk` time points to slow metadata I/O, a high `hash_wait` time with
+    # low per-worker throughput to slow reads, and high per-worker throughput to CPU-bound hashing.
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phase_seconds = collections.OrderedDict(
+            (phase, 0.0) for phase in ('render', 'walk', 'hash_wait', 'hash_worker', 'dump'))
+        self.lock = threading.Lock()
+        self.num_files = self.num_hashed = 0
+        self.total_bytes = self.bytes_hashed = 0
+        self.dir_files = collections.Counter()
+        self.dir_bytes = collections.Counter()
+        self.largest_files = []
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] += seconds
+
+    def timed_iter(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.perf_counter() - start)
+                return
+            self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def timed_compute_sha256(self, filename):
+        # runs in a hashing worker
+        start = time.perf_counter()
+        sha256 = compute_sha256(filename)
+        self.add_time('hash_worker', time.perf_counter() - start)
+        return sha256
+
+    def add_file(self, path, size, hashed, alias):
+        self.num_files += 1
+        self.total_bytes += size
+        if hashed:
+            self.num_hashed += 1
+            self.bytes_hashed += size
+        dirpath = os.path.dirname(path)
+        self.dir_files[dirpath] += 1
+        self.dir_bytes[dirpath] += size
+        if alias:
+            # the same file was already considered under another path
+            return
+        if len(self.largest_files) < REPORT_TOP_ENTRIES:
+            heapq.heappush(self.largest_files, (size, path))
+        elif size > self.largest_files[0][0]:
+            heapq.heapreplace(self.largest_files, (size, path))
+
+    def write(self, filename):
+        total_seconds = time.perf_counter() - self.start_time
+        def mb_per_second(num_bytes, seconds):
+            return round(num_bytes / 10**6 / seconds, 1) if seconds else None
+        report = {
+            'total_seconds': round(total_seconds, 3),
+            'phase_seconds': {phase: round(seconds, 3)
+                              for phase, seconds in self.phase_seconds.items()},
+            'num_trusted_files': self.num_files,
+            'num_hashed_files': self.num_hashed,
+            'total_bytes': self.total_bytes,
+            'bytes_hashed': self.bytes_hashed,
+            'hash_throughput_mb_per_second': mb_per_second(self.bytes_hashed, total_seconds),
+            'hash_worker_throughput_mb_per_second': mb_per_second(
+                self.bytes_hashed, self.phase_seconds['hash_worker']),
+            'top_dirs_by_files': [{'dir': dirpath, 'files': num_files} for dirpath, num_files
+                                  in self.dir_files.most_common(REPORT_TOP_ENTRIES)],
+            'top_dirs_by_bytes': [{'dir': dirpath, 'bytes': num_bytes} for dirpath, num_bytes
+                                  in self.dir_bytes.most_common(REPORT_TOP_ENTRIES)],
+            'largest_files': [{'path': path, 'bytes': size} for size, path
+                              in sorted(self.largest_files, reverse=True)],
+        }
+        if filename == '-':
+            print(REPORT_LINE_PREFIX + json.dumps(report), flush=True)
+            return
+        with open(filename, 'w', encoding='UTF-8') as report_file:
+            json.dump(report, report_file, indent=4)
+            report_file.write('\n')
+
+def expand_trusted_files(trusted_files, num_workers=1, hash_index=None, new_hash_index=None,
+                         report=None, strict_hash_index=None):
+    # Generator which consumes `(uri, aliased)` pairs lazily (typically from
+    # `generate_trusted_files()`) and yields `{'uri': uri, 'sha256': sha256}` entries in the same
+    # order. Walking, hashing and writing the manifest thus overlap, and only a bounded number of
+    # files is in flight at any time, regardless of the total number of trusted files.
+    #
+    # The same file is typically reachable via several paths: hardlinks, symlinks and symlinked
+    # directories such as `/lib -> usr/lib` on merged-/usr distros. Each inode is read and hashed
+    # only once if possible, but an entry is still emitted for every URI. To keep memory bounded,
+    # only inodes that can be reached via another path are remembered: hardlinked files and files
+    # reached via a symlink (`aliased`). `walk_files()` visits symlinks before regular entries, so
+    # such aliases are typically seen before their targets.
+    #
+    # Hashes from `hash_index` and `strict_hash_index` (see `load_hash_index()`) are reused for
+    # unchanged files, and hashes of all files are added to `new_hash_index` (if provided).
+    # Statistics are collected in `report` (if provided).
+    known_hashes = {}
+    pending = collections.deque()
+    max_pending = PENDING_FILES_PER_WORKER * num_workers
+    num_files = num_hashed = num_reused = 0
+
+    def finish(item):
+        uri, file_path, file_stat, inode_key, sha256 = item
+        if isinstance(sha256, concurrent.futures.Future):
+            start = time.perf_counter()
+            sha256 = sha256.result()
+            if report is not None:
+                report.add_time('hash_wait', time.perf_counter() - start)
+            if inode_key in known_hashes:
+                known_hashes[inode_key] = sha256
+        if new_hash_index is not None:
+            new_hash_index[str(file_path)] = [file_stat.st_size, file_stat.st_mtime_ns, sha256,
+                                              file_stat.st_ino, file_stat.st_ctime_ns]
+        return {'uri': uri, 'sha256': sha256}
+
+    # hashing is I/O-bound or done in hashlib with the GIL released, so threads are enough to scale
+    # with the number of cores; results are emitted in input order, so the output is the same as if
+    # hashing was done serially
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for uri, aliased in trusted_files:
+            file_path = uri2path(uri)
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                raise ManifestError(f'File not found: {file_path}') from None
+            inode_key = (file_stat.st_dev, file_stat.st_ino)
+            num_files += 1
+
+            sha256 = known_hashes.get(inode_key)
+            is_alias = sha256 is not None
+            if sha256 is None and strict_hash_index is not None:
+                indexed = strict_hash_index.get(str(file_path))
+                if indexed and indexed[:2] + indexed[3:] == [file_stat.st_size,
+                                                             file_stat.st_mtime_ns,
+                                                             file_stat.st_ino,
+                                                             file_stat.st_ctime_ns]:
+                    sha256 = indexed[2]
+                    num_reused += 1
+            if sha256 is None and hash_index is not None:
+                indexed = hash_index.get(str(file_path))
+                if indexed and indexed[:2] == [file_stat.st_size, file_stat.st_mtime_ns]:
+                    sha256 = indexed[2]
+                    num_reused += 1
+            is_hashed = sha256 is None
+            if is_hashed:
+                sha256 = executor.submit(compute_sha256 if report is None
+                                         else report.timed_compute_sha256, file_path)
+                num_hashed += 1
+            if report is not None:
+                report.add_file(str(file_path), file_stat.st_size, is_hashed, is_alias)
+            if aliased or file_stat.st_nlink > 1:
+                known_hashes.setdefault(inode_key, sha256)
+
+            pending.append((uri, file_path, file_stat, inode_key, sha256))
+            while pending and (len(pending) > max_pending
+                               or not isinstance(pending[0][4], concurrent.futures.Future)
+                               or pending[0][4].done()):
+                yield finish(pending.popleft())
+
+        while pending:
+            yield finish(pending.popleft())
+
+    num_aliases = num_files - num_hashed - num_reused
+    if num_aliases:
+        print(f'\t[from inside Docker container] Reused hashes for {num_aliases} trusted files '
+              f'which are hardlinks or aliases via symlinks.')
+    if num_reused:
+        print(f'\t[from inside Docker container] Reused hashes of {num_reused} unchanged files '
+              f'from the hash index.')
+
+class PathRules:
+    # Set of user-provided path rules (absolute paths, optionally with shell-style wildcards which
+    # don't match across `/`). A rule matches the path itself and everything below it. Plain paths
+    # are stored in a prefix trie of path components, so matching costs O(depth) regardless of the
+    # number of rules; only rules with wildcards are matched one by one.
+    def __init__(self, rules):
+        self.trie = {}
+        self.globs = []
+        for rule in rules:
+            if not rule.startswith('/'):
+                raise ManifestError(f'Path rule `{rule}` is not an absolute path')
+            rule = rule.rstrip('/') or '/'
+            components = [c for c in rule.split('/') if c]
+            glob_idx = next((i for i, c in enumerate(components) if re.search(r'[*?[]', c)), None)
+            if glob_idx is None:
+                node = self.trie
+                for component in components:
+                    node = node.setdefault(component, {})
+                node[None] = rule
+            else:
+                literal_prefix = '/' + '/'.join(components[:glob_idx])
+                self.globs.append((rule, components, literal_prefix))
+
+    def __bool__(self):
+        return bool(self.trie or self.globs)
+
+    def match(self, path):
+        # returns the (first) rule matching `path` or one of its parent directories
+        components = [c for c in path.split('/') if c]
+        node = self.trie
+        if None in node:
+            return node[None]
+        for component in components:
+            node = node.get(component)
+            if node is None:
+                break
+            if None in node:
+                return node[None]
+        for rule, rule_components, _ in self.globs:
+            if len(components) >= len(rule_components) and all(
+                    fnmatch.fnmatchcase(component, pattern)
+                    for component, pattern in zip(components, rule_components)):
+                return rule
+        return None
+
+    def may_match_below(self, dirpath):
+        # returns True if some rule may match a path inside directory `dirpath`
+        node = self.trie
+        for component in (c for c in dirpath.split('/') if c):
+            node = node.get(component)
+            if node is None:
+                break
         else:
-            raise ManifestError(f'File not found: {file_path}')
-    return expanded_files
+            return True
+        for _, _, literal_prefix in self.globs:
+            if (literal_prefix == dirpath or literal_prefix.startswith(dirpath.rstrip('/') + '/')
+                    or dirpath.startswith(literal_prefix.rstrip('/') + '/')):
+                return True
+        return False
+
+
+class ExclusionRules:
+    # User-provided rules to exclude paths from the list of trusted files (in addition to the
+    # built-in exclusions); `include` rules take precedence over `exclude` rules. Keeps track of
+    # how many files and bytes each exclude rule removed from the list of trusted files, and how
+    # many directories it pruned. Pruned directories are never walked, so files below them are not
+    # counted.
+    def __init__(self, exclude, include):
+        self.exclude = PathRules(exclude)
+        self.include = PathRules(include)
+        self.saved = {}
+
+    def _account(self, rule, num_files=0, num_bytes=0, num_dirs=0):
+        saved = self.saved.setdefault(rule, [0, 0, 0])
+        saved[0] += num_files
+        saved[1] += num_bytes
+        saved[2] += num_dirs
+
+    def prune_dir(self, dirpath):
+        # returns True if the whole directory can be skipped without descending into it
+        rule = self.exclude.match(dirpath)
+        if rule is None or self.include.match(dirpath) or self.include.may_match_below(dirpath):
+            return False
+        self._account(rule, num_dirs=1)
+        return True
+
+    def exclude_file(self, filename, size=None):
+        rule = self.exclude.match(filename)
+        if rule is None or self.include.match(filename):
+            return False
+        if size is None:
+            try:
+                size = os.stat(filename).st_size
+            except OSError:
+                size = 0
+        self._account(rule, num_files=1, num_bytes=size)
+        return True
+
+    def print_report(self, prefix='\t[from inside Docker container] '):
+        for rule, (num_files, num_bytes, num_dirs) in sorted(self.saved.items()):
+            print(f'{prefix}Exclude rule `{rule}` removed {num_files} '
+                  f'files ({num_bytes / 2**20:.1f} MiB) and {num_dirs} whole directories from '
+                  f'the list of trusted files.')
 
+
+# Returns the URIs of the files listed in the manifest, each only once (a file may be listed several
+# times, e.g. both as trusted and as allowed file), so that each of them is hashed only once
 def extract_files_from_user_manifest(manifest):
-    files = []
-
-    files.extend(manifest['sgx'].get('trusted_files', []))
-    files.extend(manifest['sgx'].get('allowed_files', []))
-    files.extend(manifest['sgx'].get('protected_files',[]))
-
-    return files
-
-
-def generate_trusted_files(root_dir, already_added_files):
-    excluded_paths_regex = (r'^/('
-                                r'boot/.*'
-                                r'|\.dockerenv'
-                                r'|\.dockerinit'
-                                r'|dev/.*'
-                                r'|etc/gshadow.*'
-                                r'|etc/mtab'
-                                r'|etc/\.pwd\.lock'
-                                r'|etc/rc(\d|.)\.d/.*'
-                                r'|etc/security/.*'
-                                r'|etc/shadow.*'
-                                r'|gramine/python/.*'
-                                r'|gramine/app_files/finalize_manifest\.py'
-                                r'|proc/.*'
-                                r'|sys/.*'
-                                r'|var/.*)$')
-    exclude_re = re.compile(excluded_paths_regex)
+    files = {}
+    for key in ('trusted_files', 'allowed_files', 'protected_files'):
+        for entry in manifest['sgx'].get(key, []):
+            # entries may be given as URI strings or as tables with a `uri` key
+            files.setdefault(entry['uri'] if isinstance(entry, dict) else entry, None)
+
+    return list(files)
+
+
+# Yields `(path, aliased)` pairs for all regular files under `root_dir`, where `path` is in bytes
+# and `aliased` tells whether the path goes through a symlink (i.e., the same file may be
+# reachable via another path). Each directory is read with a single `os.scandir()` whose entries
+# carry the file type, so regular files need no additional `stat()`. Symlinks to directories are
+# followed, but a directory is not entered if it is one of its own ancestors (i.e., a symlink
+# cycle). Within each directory, symlinks are visited before regular entries (see
+# `expand_trusted_files()`). Directories matching `exclude_re` (or pruned by the optional
+# `ExclusionRules`) are skipped without descending into them.
+def walk_files(root_dir, exclude_re, exclusion_rules=None):
+    root_dir = os.fsencode(root_dir)
+    root_stat = os.stat(root_dir)
+
+    # explicit stack instead of recursion, to support arbitrarily deep directory trees; `None` marks
+    # the point where all subdirectories of the directory on top of `ancestors` were walked
+    ancestors = []
+    ancestor_keys = set()
+    stack = [(root_dir, (root_stat.st_dev, root_stat.st_ino), False)]
+    while stack:
+        item = stack.pop()
+        if item is None:
+            ancestor_keys.discard(ancestors.pop())
+            continue
+
+        dirpath, dir_key, dir_aliased = item
+        try:
+            scandir_it = os.scandir(dirpath)
+        except OSError:
+            # same as `os.walk()`, which ignores errors when listing directories
+            continue
+
+        files = []
+        subdirs = []
+        with scandir_it:
+            for entry in scandir_it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
 
+                if is_dir:
+                    if exclude_re.match(os.fsdecode(entry.path)):
+                        # exclude special paths from list of trusted files
+                        continue
+                    if (exclusion_rules is not None
+                            and exclusion_rules.prune_dir(os.fsdecode(entry.path))):
+                        continue
+                    try:
+                        entry_stat = entry.stat()
+                    except OSError:
+                        continue
+                    entry_key = (entry_stat.st_dev, entry_stat.st_ino)
+                    if entry_key in ancestor_keys or entry_key == dir_key:
+                        print(f'\t[from inside Docker container] Skipping directory '
+                              f'{os.fsdecode(entry.path)}: symlink cycle detected.')
+                        continue
+                    subdirs.append((entry.path, entry_key, dir_aliased or entry.is_symlink()))
+                    continue
+
+                try:
+                    if not entry.is_file():
+                        # only regular files are added as trusted files (other types are silently
+                        # ignored)
+                        continue
+                except OSError:
+                    continue
+                files.append((entry.path, dir_aliased or entry.is_symlink()))
+
+        # `sorted()` is stable, so apart from moving symlinks first the listing order is kept
+        yield from sorted(files, key=lambda file: not file[1])
+
+        ancestors.append(dir_key)
+        ancestor_keys.add(dir_key)
+        stack.append(None)
+        stack.extend(reversed(sorted(subdirs, key=lambda subdir: not subdir[2])))
+
+
+# Yields `(uri, aliased)` pairs, see `walk_files()`
+def generate_trusted_files(root_dir, already_added_files, exclusion_rules=None):
+    exclude_re = EXCLUDED_PATHS_RE
+
+    # set for O(1) membership checks below
+    already_added_files = set(already_added_files)
     num_trusted = 0
-    trusted_files = []
-
-    # WARNING: below loop does not remove cycles (which can happen due to symlinks), but we assume
-    # that Docker images (excluding paths/files listed in `excluded_paths_regex`) don't have cycles.
-    for dirpath, dirnames, files in os.walk(root_dir.encode('UTF-8'), followlinks=True):
-        scandirs = []
-        for dirname in dirnames:
-            to_be_walked_dir = os.path.join(dirpath, dirname)
-            if exclude_re.match(to_be_walked_dir.decode('UTF-8')):
-                # exclude special paths from list of trusted files
-                continue
-            scandirs.append(dirname)
-        # slice assignment, to modify `dirnames` in place (so that os.walk() will recurse only
-        # into the subdirs whose names remain in `dirnames`)
-        dirnames[:] = scandirs
-
-        for file in files:
-            filename = os.path.join(dirpath, file)
-            if not os.path.isfile(filename):
-                # only regular files are added as trusted files (other types are silently ignored)
+
+    for filename, aliased in walk_files(root_dir, exclude_re, exclusion_rules):
+        if not is_utf8(filename):
+            # we append filenames as TOML strings which must be in UTF-8
+            print(f'\t[from inside Docker container] File {filename} is not in UTF-8!')
+            sys.exit(1)
+
+        # convert from bytes to str for further string handling
+        filename = filename.decode('UTF-8')
+
+        if exclude_re.match(filename):
+            # exclude special files and paths from list of trusted files
+            continue
+        if '\n' in filename:
+            # we use TOML's basic single-line strings, can't have newlines
+            continue
+        if exclusion_rules is not None and exclusion_rules.exclude_file(filename):
+            # excluded by the user
+            continue
+
+        if not os.access(filename, os.R_OK):
+            # only accessible files are added as trusted files (note that this check is below
+            # other checks, in particular the `exclude_re` check)
+            print(f'\t[from inside Docker container] File {filename} is inaccessible!')
+            continue
+
+        trusted_file_entry = f'file:{filename}'
+        if trusted_file_entry in already_added_files:
+            # user manifest already contains this file (probably as allowed or protected)
+            continue
+
+        yield trusted_file_entry, aliased
+        num_trusted += 1
+
+    print(f'\t[from inside Docker container] Found {num_trusted} files in `{root_dir}`.')
+    if exclusion_rules is not None:
+        exclusion_rules.print_report()
+
+
+# Returns `None` if `path` is not an ELF file, otherwise a dict with the ELF class and machine, the
+# program interpreter (`PT_INTERP`), and the `DT_NEEDED`, `DT_RPATH` and `DT_RUNPATH` entries. Only
+# the ELF and program headers, the dynamic section and its string table are read.
+def read_elf_info(path):
+    try:
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+                return None
+            is_32bit = ident[4] == ELFCLASS32
+            endian = '<' if ident[5] == ELFDATA2LSB else '>'
+            if is_32bit:
+                ehdr_fmt, phdr_fmt, dyn_fmt = 'HHIIIIIHHHHHH', 'IIIIIIII', 'iI'
+            else:
+                ehdr_fmt, phdr_fmt, dyn_fmt = 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ'
+            ehdr_fmt, phdr_fmt, dyn_fmt = (endian + fmt for fmt in (ehdr_fmt, phdr_fmt, dyn_fmt))
+
+            ehdr = struct.unpack(ehdr_fmt, f.read(struct.calcsize(ehdr_fmt)))
+            e_machine, e_phoff, e_phentsize, e_phnum = ehdr[1], ehdr[4], ehdr[8], ehdr[9]
+
+            # normalize program headers to (type, offset, vaddr, filesz)
+            segments = []
+            for i in range(e_phnum):
+                f.seek(e_phoff + i * e_phentsize)
+                phdr = struct.unpack(phdr_fmt, f.read(struct.calcsize(phdr_fmt)))
+                if is_32bit:
+                    segments.append((phdr[0], phdr[1], phdr[2], phdr[4]))
+                else:
+                    segments.append((phdr[0], phdr[2], phdr[3], phdr[5]))
+
+            info = {'class': ident[4], 'machine': e_machine, 'interp': None, 'needed': [],
+                    'rpath': [], 'runpath': []}
+            dynamic = []
+            for p_type, p_offset, _, p_filesz in segments:
+                if p_type == PT_INTERP:
+                    f.seek(p_offset)
+                    info['interp'] = os.fsdecode(f.read(p_filesz).split(b'\0', 1)[0])
+                elif p_type == PT_DYNAMIC:
+                    f.seek(p_offset)
+                    data = f.read(p_filesz)
+                    dyn_size = struct.calcsize(dyn_fmt)
+                    for offset in range(0, len(data) - dyn_size + 1, dyn_size):
+                        d_tag, d_val = struct.unpack_from(dyn_fmt, data, offset)
+                        if d_tag == DT_NULL:
+                            break
+                        dynamic.append((d_tag, d_val))
+            if not dynamic:
+                # statically linked
+                return info
+
+            # the string table is referenced by its virtual address, translate it to a file offset
+            tags = dict(dynamic)
+            strtab_vaddr, strsz = tags.get(DT_STRTAB), tags.get(DT_STRSZ, 0)
+            strtab = None
+            for p_type, p_offset, p_vaddr, p_filesz in segments:
+                if (p_type == PT_LOAD and strtab_vaddr is not None
+                        and p_vaddr <= strtab_vaddr < p_vaddr + p_filesz):
+                    f.seek(strtab_vaddr - p_vaddr + p_offset)
+                    strtab = f.read(strsz)
+                    break
+            if strtab is None:
+                return info
+    except (OSError, struct.error):
+        return None
+
+    def dynstr(offset):
+        return os.fsdecode(strtab[offset:].split(b'\0', 1)[0])
+
+    for d_tag, d_val in dynamic:
+        if d_tag == DT_NEEDED:
+            info['needed'].append(dynstr(d_val))
+        elif d_tag == DT_RPATH:
+            info['rpath'].extend(dynstr(d_val).split(':'))
+        elif d_tag == DT_RUNPATH:
+            info['runpath'].extend(dynstr(d_val).split(':'))
+    return info
+
+# Returns the interpreter and its optional argument from the shebang line of `path`, or `None`
+def read_shebang(path):
+    try:
+        with open(path, 'rb') as f:
+            line = f.readline(256)
+    except OSError:
+        return None
+    if not line.startswith(b'#!'):
+        return None
+    words = os.fsdecode(line[2:]).split(None, 1)
+    if not words:
+        return None
+    return words[0], words[1].strip() if len(words) > 1 else ''
+
+# Returns the first `<dir>/name` for which `check()` succeeds, with `<dir>` from `search_path`
+def find_in_search_path(name, search_path, check=os.path.isfile):
+    for dirpath in search_path:
+        if dirpath:
+            candidate = os.path.join(dirpath, name)
+            if check(candidate):
+                return candidate
+    return None
+
+# Yields the files needed to run the executables `roots` inside the enclave: the executables
+# themselves, the interpreters of scripts (following shebang lines), and the transitive closure of
+# ELF program interpreters and shared libraries (`DT_NEEDED`). Libraries are looked up the way the
+# dynamic loader does it: in `DT_RPATH`, `LD_LIBRARY_PATH` (of the manifest), `DT_RUNPATH`, and
+# finally the default directories. Both the found path and its real path (without symlinks) are
+# yielded, because the app may open either of them. Libraries loaded only via `dlopen()` (e.g. NSS
+# modules) are not detected and have to be listed as data paths.
+def generate_elf_closure(roots, ld_library_path, exec_path):
+    ld_library_path = ld_library_path.split(':')
+    exec_path = exec_path.split(':')
+    seen = set()
+    queue = collections.deque((root, 0) for root in roots)
+    num_objects = 0
+
+    def add(path):
+        for candidate in (os.path.normpath(path), os.path.realpath(path)):
+            if candidate not in seen:
+                seen.add(candidate)
+                yield candidate
+
+    while queue:
+        path, shebang_nesting = queue.popleft()
+        if not os.path.isfile(path):
+            raise ManifestError(f'Could not find `{path}` required by the ELF closure')
+        new_paths = list(add(path))
+        if not new_paths:
+            continue
+        yield from new_paths
+        num_objects += 1
+
+        shebang = read_shebang(path)
+        if shebang is not None:
+            interpreter, argument = shebang
+            if shebang_nesting >= MAX_SHEBANG_NESTING:
+                raise ManifestError(f'Too many nested shebang interpreters for `{path}`')
+            queue.append((interpreter, shebang_nesting + 1))
+            if os.path.basename(interpreter) == 'env' and argument:
+                # `#!/usr/bin/env prog`: also add the program found in PATH
+                program = find_in_search_path(shlex.split(argument)[-1], exec_path,
+                                              check=lambda p: os.access(p, os.X_OK)
+                                                              and os.path.isfile(p))
+                if program is not None:
+                    queue.append((program, shebang_nesting + 1))
+            continue
+
+        elf_info = read_elf_info(path)
+        if elf_info is None:
+            continue
+
+        if elf_info['interp']:
+            queue.append((elf_info['interp'], 0))
+            # the interpreter may be shadowed by one in `LD_LIBRARY_PATH` (e.g. Gramine's patched
+            # glibc), add that one as well
+            interp = find_in_search_path(os.path.basename(elf_info['interp']), ld_library_path)
+            if interp is not None:
+                queue.append((interp, 0))
+
+        origin = os.path.dirname(os.path.realpath(path))
+        def expand_origin(dirs, origin=origin):
+            return [d.replace('${ORIGIN}', origin).replace('$ORIGIN', origin) for d in dirs]
+        search_path = []
+        if not elf_info['runpath']:
+            search_path += expand_origin(elf_info['rpath'])
+        search_path += ld_library_path
+        search_path += expand_origin(elf_info['runpath'])
+        search_path += DEFAULT_LIBRARY_DIRS
+
+        def is_compatible(candidate, elf_info=elf_info):
+            # the dynamic loader skips libraries of another ELF class or architecture
+            candidate_info = read_elf_info(candidate) if os.path.isfile(candidate) else None
+            return (candidate_info is not None
+                    and candidate_info['class'] == elf_info['class']
+                    and candidate_info['machine'] == elf_info['machine'])
+
+        for needed in elf_info['needed']:
+            if '/' in needed:
+                library = os.path.join(origin, needed)
+            else:
+                library = find_in_search_path(needed, search_path, check=is_compatible)
+            if library is None:
+                print(f'\t[from inside Docker container] Could not find library `{needed}` '
+                      f'needed by `{path}`!')
                 continue
-            if not is_utf8(filename):
-                # we append filenames as TOML strings which must be in UTF-8
-                print(f'\t[from inside Docker container] File {filename} is not in UTF-8!')
-                sys.exit(1)
+            queue.append((library, 0))
 
-            # convert from bytes to str for further string handling
-            filename = filename.decode('UTF-8')
+    print(f'\t[from inside Docker container] Found {num_objects} executables and libraries in the '
+          f'ELF closure ({len(seen)} paths).')
 
-            if exclude_re.match(filename):
-                # exclude special files and paths from list of trusted files
+# Yields `(uri, aliased)` pairs of the trusted files in ELF-closure mode: the ELF closure of
+# `roots` (see `generate_elf_closure()`), followed by all files under `data_paths`
+def generate_closure_trusted_files(roots, ld_library_path, exec_path, data_paths,
+                                   already_added_files, exclusion_rules=None):
+    already_added_files = set(already_added_files)
+    for path in generate_elf_closure(roots, ld_library_path, exec_path):
+        trusted_file_entry = f'file:{path}'
+        if trusted_file_entry not in already_added_files:
+            already_added_files.add(trusted_file_entry)
+            yield trusted_file_entry, True
+
+    for data_path in data_paths:
+        if os.path.isdir(data_path):
+            yield from generate_trusted_files(data_path, already_added_files, exclusion_rules)
+        elif os.path.isfile(data_path):
+            trusted_file_entry = f'file:{os.path.normpath(data_path)}'
+            if trusted_file_entry not in already_added_files:
+                already_added_files.add(trusted_file_entry)
+                yield trusted_file_entry, True
+        else:
+            raise ManifestError(f'Could not find data path `{data_path}`')
+
+# Returns the executables which the ELF closure starts from (the LibOS and the app entrypoint, which
+# in GSC is a symlink to the app binary), and the `LD_LIBRARY_PATH` and `PATH` of the app
+def get_closure_roots(manifest_dict):
+    def get_env(name):
+        value = manifest_dict.get('loader', {}).get('env', {}).get(name, '')
+        # `{ passthrough = true }` and similar are not known at this point
+        return value if isinstance(value, str) else ''
+
+    loader_entrypoint = manifest_dict.get('loader', {}).get('entrypoint', '')
+    if isinstance(loader_entrypoint, dict):
+        loader_entrypoint = loader_entrypoint.get('uri', '')
+    roots = [str(uri2path(loader_entrypoint))] if loader_entrypoint else []
+    roots.append(manifest_dict['libos']['entrypoint'])
+    return roots, get_env('LD_LIBRARY_PATH'), get_env('PATH')
+
+# Returns the set of absolute paths which were successfully opened or executed according to the
+# trace log `filename`, together with their real paths (the trace may contain either of them)
+def read_access_trace(filename):
+    accessed = set()
+    num_relative = 0
+    with open(filename, 'rb') as trace_file:
+        for line in trace_file:
+            match = ACCESS_TRACE_RE.search(os.fsdecode(line))
+            if match is None or match.group(2):
+                # not a file access or the syscall failed
                 continue
-            if '\n' in filename:
-                # we use TOML's basic single-line strings, can't have newlines
+            path = os.fsdecode(codecs.escape_decode(os.fsencode(match.group(1)))[0])
+            if not path.startswith('/'):
+                # relative to an unknown working directory
+                num_relative += 1
                 continue
+            accessed.add(os.path.normpath(path))
+            accessed.add(os.path.realpath(path))
+    if num_relative:
+        print(f'\t[from inside Docker container] Ignored {num_relative} accesses to relative paths '
+              f'in access trace `{filename}`.')
+    return accessed
 
-            if not os.access(filename, os.R_OK):
-                # only accessible files are added as trusted files (note that this check is below
-                # other checks, in particular the `exclude_re` check)
-                print(f'\t[from inside Docker container] File {filename} is inaccessible!')
-                continue
+# Adds to `accessed` the files in `runtime_dirs` (Gramine's runtime directories) with the same names
+# as accessed files: a trace of the application without Gramine (e.g. `strace -f`) records host
+# libraries such as `/lib/x86_64-linux-gnu/libc.so.6`, but inside the enclave the same library is
+# loaded from Gramine's patched glibc
+def add_gramine_runtime_paths(accessed, runtime_dirs):
+    runtime_paths = set()
+    for path in accessed:
+        for runtime_dir in runtime_dirs:
+            runtime_path = os.path.join(runtime_dir, os.path.basename(path))
+            if os.path.isfile(runtime_path):
+                runtime_paths.add(runtime_path)
+                runtime_paths.add(os.path.realpath(runtime_path))
+    return accessed | runtime_paths
 
-            trusted_file_entry = f'file:{filename}'
-            if trusted_file_entry in already_added_files:
-                # user manifest already contains this file (probably as allowed or protected)
-                continue
+# Passes through the `(uri, aliased)` pairs of `trusted_files` whose path is in `accessed` or in
+# `keep`, and reports what was pruned
+def prune_to_access_trace(trusted_files, accessed, keep):
+    keep = set(keep) | {os.path.realpath(path) for path in keep}
+    num_kept = num_pruned = bytes_pruned = manifest_bytes_pruned = 0
+    pruned_dirs = collections.Counter()
+    for uri, aliased in trusted_files:
+        path = str(uri2path(uri))
+        if path in accessed or path in keep:
+            num_kept += 1
+            yield uri, aliased
+            continue
+        num_pruned += 1
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+        bytes_pruned += size
+        pruned_dirs[os.path.dirname(path)] += size
+        # size of the `[[sgx.trusted_files]]` table emitted by `write_manifest()`
+        manifest_bytes_pruned += len(f'\n[[sgx.trusted_files]]\nuri = "{uri}"\n'
+                                     f'sha256 = "{"0" * 64}"\n'.encode('UTF-8'))
 
-            trusted_files.append(trusted_file_entry)
-            num_trusted += 1
+    print(f'\t[from inside Docker container] Access trace: kept {num_kept} trusted files, pruned '
+          f'{num_pruned} files ({bytes_pruned / 2**20:.1f} MiB not hashed, manifest smaller by '
+          f'{manifest_bytes_pruned / 2**10:.1f} KiB).')
+    for dirpath, size in pruned_dirs.most_common(10):
+        print(f'\t[from inside Docker container]     pruned {size / 2**20:.1f} MiB in `{dirpath}`')
 
-    print(f'\t[from inside Docker container] Found {num_trusted} files in `{root_dir}`.')
-    return trusted_files
+# Returns the installed paths of the files and directories installed by `meson install` from the
+# build directory `build_dir`, except for development files (see `MESON_DEVEL_TAGS`), or None if
+# the build directory contains no install plan (e.g. for a Gramine image not built by GSC). The
+# install plan maps each source path to its install tag, and the list of installed files maps it to
+# the installed path; files without a tag are kept, as meson can't tell whether they are needed.
+def read_meson_install_plan(build_dir):
+    info_dir = os.path.join(build_dir, 'meson-info')
+    try:
+        with open(os.path.join(info_dir, 'intro-install_plan.json'), encoding='UTF-8') as f:
+            install_plan = json.load(f)
+        with open(os.path.join(info_dir, 'intro-installed.json'), encoding='UTF-8') as f:
+            installed = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    paths = set()
+    for entries in install_plan.values():
+        for source, entry in entries.items():
+            if entry.get('tag') not in MESON_DEVEL_TAGS and source in installed:
+                # installed symlinks are kept as symlinks, so only their directory is resolved
+                path = installed[source]
+                paths.add(os.path.join(os.path.realpath(os.path.dirname(path)),
+                                       os.path.basename(path)))
+    return paths
+
+# Returns the sorted paths (relative to `prefix`) of the files of the Gramine installation under
+# `prefix` which are needed at runtime. The payload starts from the files installed from the meson
+# build directory `build_dir` that are not development files (see `read_meson_install_plan()`):
+# the tools in `bin/`, the Python package they use, the loaders, PALs, LibOS and patched runtime
+# libraries etc. The symlinks to these files, the GSC hash index and the ELF closure of all of them
+# complete the payload. Without an install plan, the whole installation is kept.
+def generate_runtime_payload(prefix, build_dir=None):
+    prefix = os.path.realpath(prefix)
+    installed = read_meson_install_plan(build_dir) if build_dir else None
+    if installed is None:
+        print(f'\t[from inside Docker container] WARNING: No meson install plan found in '
+              f'`{build_dir}`, keeping the whole Gramine installation.')
+
+    def is_root(path):
+        if installed is None or path == os.path.join(prefix, 'gsc_hash_index.json'):
+            return True
+        # files of installed directories (`install_subdir()`) are roots as well
+        while path != prefix:
+            if path in installed:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    roots = []
+    symlinks = []
+    num_files = num_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(prefix):
+        dirnames[:] = [dirname for dirname in dirnames if dirname != '__pycache__']
+        # symlinks to directories are not descended into by `os.walk()`, so keep them as symlinks
+        names = filenames + [dirname for dirname in dirnames
+                             if os.path.islink(os.path.join(dirpath, dirname))]
+        for name in names:
+            path = os.path.join(dirpath, name)
+            num_files += 1
+            num_bytes += os.lstat(path).st_size
+            if is_root(path):
+                roots.append(path)
+            elif os.path.islink(path):
+                symlinks.append(path)
+    # e.g. `libfoo.so.1 -> libfoo.so.1.2`, where only the latter is in the install plan; symlinks to
+    # directories are kept if the directories contain roots
+    targets = set()
+    for path in roots:
+        while path not in targets and path != prefix:
+            targets.add(path)
+            path = os.path.dirname(path)
+    roots += [path for path in symlinks if os.path.realpath(path) in targets]
+
+    library_dirs = sorted({os.path.dirname(path) for path in roots
+                           if SHARED_OBJECT_RE.search(path)})
+    ld_library_path = ':'.join(library_dirs + [generate_library_paths()])
+    exec_path = ':'.join([os.path.join(prefix, 'bin'), os.getenv('PATH', '')])
+    closure = generate_elf_closure([path for path in roots if os.path.isfile(path)],
+                                   ld_library_path, exec_path)
+
+    payload = set()
+    for path in itertools.chain(roots, closure):
+        # the closure also contains system executables and libraries (e.g. `python3`, `libc.so.6`)
+        # which are already part of the app image
+        if os.path.commonpath([prefix, path]) == prefix:
+            payload.add(os.path.relpath(path, prefix))
+    payload = sorted(payload)
+
+    payload_bytes = sum(os.lstat(os.path.join(prefix, path)).st_size for path in payload)
+    print(f'\t[from inside Docker container] Runtime payload: {len(payload)} of {num_files} files '
+          f'({payload_bytes / 2**20:.1f} of {num_bytes / 2**20:.1f} MiB) of `{prefix}`.')
+    return payload
+
+# Copies `paths` (relative to `src_dir`) to the same relative paths under `dst_dir`; symlinks are
+# copied as symlinks
+def copy_files(src_dir, dst_dir, paths):
+    for path in paths:
+        src = os.path.join(src_dir, path)
+        dst = os.path.join(dst_dir, path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        else:
+            shutil.copy2(src, dst)
+
+def write_manifest(manifest_path, manifest_dict, trusted_files=None, report=None):
+    # `trusted_files` (if given) is an iterable of `{'uri': ..., 'sha256': ...}` entries which are
+    # appended to the manifest one by one as `[[sgx.trusted_files]]` tables, so the list of trusted
+    # files is never held in memory. The manifest is written to a temporary file first, because
+    # the original manifest is itself a trusted file and may still be hashed at this point.
+    if trusted_files is not None:
+        trusted_files = iter(trusted_files)
+        first_entry = next(trusted_files, None)
+        if first_entry is None:
+            # still emitted as `sgx.trusted_files = []`, which has no array-of-tables equivalent
+            manifest_dict = {**manifest_dict,
+                             'sgx': {**manifest_dict.get('sgx', {}), 'trusted_files': []}}
+        else:
+            trusted_files = itertools.chain([first_entry], trusted_files)
+
+    tmp_manifest_path = f'{manifest_path}.tmp'
+    start = time.perf_counter()
+    with open(tmp_manifest_path, 'wb') as manifest_file:
+        tomli_w.dump(manifest_dict, manifest_file)
+        dump_seconds = time.perf_counter() - start
+        for entry in trusted_files or []:
+            start = time.perf_counter()
+            manifest_file.write(b'\n[[sgx.trusted_files]]\n')
+            manifest_file.write(tomli_w.dumps(entry).encode('UTF-8'))
+            dump_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+    os.replace(tmp_manifest_path, manifest_path)
+    dump_seconds += time.perf_counter() - start
+    if report is not None:
+        report.add_time('dump', dump_seconds)
 
 
 def generate_library_paths():
@@ -147,12 +1045,96 @@ def generate_library_paths():
 argparser = argparse.ArgumentParser()
 argparser.add_argument('-d', '--dir', default='/',
     help='Search directory tree from this root to generate list of trusted files.')
+argparser.add_argument('-j', '--jobs', type=int, default=default_num_workers(),
+    help='Number of parallel workers hashing trusted files (default: number of available CPUs).')
+argparser.add_argument('--exclude', action='append', default=[],
+    help='Do not add files matching this path rule as trusted files (may be repeated).')
+argparser.add_argument('--include', action='append', default=[],
+    help='Add files matching this path rule as trusted files even if they match an `--exclude` '
+         'rule (may be repeated).')
+argparser.add_argument('--hash-index', action='append', default=[],
+    help='Reuse hashes of files in the directory of this hash index whose size and mtime match '
+         'the hash index (may be repeated).')
+argparser.add_argument('--strict-hash-index', action='append', default=[],
+    help='Reuse hashes of files whose size, mtime, inode number and ctime match this hash index '
+         '(may be repeated).')
+argparser.add_argument('--write-hash-index',
+    help='Write the hashes of all trusted files to this hash index.')
+argparser.add_argument('--elf-closure', action='store_true',
+    help='Instead of all files under the search directory, add only the executables of the app '
+         '(with the shared libraries they need) and the data paths as trusted files.')
+argparser.add_argument('--data-path', action='append', default=[],
+    help='In ELF-closure mode, add this file or all files under this directory as trusted files '
+         '(may be repeated).')
+argparser.add_argument('--access-trace',
+    help='Add only files which were opened or executed according to this Gramine trace log or '
+         'strace log as trusted files.')
+argparser.add_argument('--report',
+    help='Write a JSON report with timings and statistics of finalizing the manifest to this file '
+         '(or, with `-`, as a single line to stdout).')
+argparser.add_argument('--index-only', action='store_true',
+    help='Only hash all files under the search directory and write the hash index; do not touch '
+         'the manifest.')
+argparser.add_argument('--runtime-payload', metavar='DIR',
+    help='Only copy the files of the Gramine installation under the search directory which are '
+         'needed at runtime to this directory; do not touch the manifest.')
+argparser.add_argument('--meson-build-dir', metavar='DIR',
+    help='With `--runtime-payload`, the meson build directory of the Gramine installation, whose '
+         'install plan tells which installed files are needed at runtime.')
 
 def main(args=None):
     args = argparser.parse_args(args[1:])
     if not os.path.isdir(args.dir):
         argparser.error(f'\t[from inside Docker container] Could not find directory `{args.dir}`.')
+    if args.jobs < 1:
+        argparser.error(f'\t[from inside Docker container] Invalid number of jobs `{args.jobs}`.')
 
+    if args.data_path and not args.elf_closure:
+        argparser.error('\t[from inside Docker container] `--data-path` requires `--elf-closure`.')
+
+    exclusion_rules = None
+    if args.exclude:
+        try:
+            exclusion_rules = ExclusionRules(args.exclude, args.include)
+        except ManifestError as e:
+            argparser.error(f'\t[from inside Docker container] {e}.')
+
+    if args.runtime_payload:
+        payload = generate_runtime_payload(args.dir, args.meson_build_dir)
+        copy_files(args.dir, args.runtime_payload, payload)
+        if 'gsc_hash_index.json' in payload:
+            # the payload is copied to the same paths in the image, so its entries stay valid
+            filter_hash_index(os.path.join(args.dir, 'gsc_hash_index.json'),
+                              os.path.join(args.runtime_payload, 'gsc_hash_index.json'),
+                              (os.path.join(args.dir, path) for path in payload))
+        print(f'\t[from inside Docker container] Successfully copied runtime payload to '
+              f'`{args.runtime_payload}`.')
+        return
+
+    hash_index = load_hash_index(args.hash_index) if args.hash_index else None
+    strict_hash_index = (load_hash_index(args.strict_hash_index, strict=True)
+                         if args.strict_hash_index else None)
+
+    if args.index_only:
+        if not args.write_hash_index:
+            argparser.error('\t[from inside Docker container] `--index-only` requires '
+                            '`--write-hash-index`.')
+        new_hash_index = {}
+        for _ in expand_trusted_files(generate_trusted_files(args.dir, []), num_workers=args.jobs,
+                                      hash_index=hash_index, new_hash_index=new_hash_index,
+                                      strict_hash_index=strict_hash_index):
+            pass
+        write_hash_index(args.write_hash_index, new_hash_index)
+        print(f'\t[from inside Docker container] Successfully wrote hash index '
+              f'`{args.write_hash_index}`.')
+        return
+
+    # imported only here because the Gramine compile stage, which runs this script with
+    # `--index-only`, doesn't have Jinja installed
+    import jinja2 # pylint: disable=import-outside-toplevel
+
+    report = FinalizeReport() if args.report else None
+    start = time.perf_counter()
     env = jinja2.Environment(loader=jinja2.FileSystemLoader('/'))
     env.globals.update({'library_paths': generate_library_paths(), 'env_path': os.getenv('PATH')})
 
@@ -160,15 +1142,49 @@ def main(args=None):
     rendered_manifest = env.get_template(manifest).render()
     rendered_manifest_dict = tomli.loads(rendered_manifest)
     already_added_files = extract_files_from_user_manifest(rendered_manifest_dict)
+    if report is not None:
+        report.add_time('render', time.perf_counter() - start)
 
+    trusted_files = None
+    new_hash_index = {} if args.write_hash_index else None
     if 'allow_all_but_log' not in rendered_manifest_dict['sgx'].get('file_check_policy', ''):
-        trusted_files = generate_trusted_files(args.dir, already_added_files)
-        rendered_manifest_dict['sgx']['trusted_files'] = expand_trusted_files(trusted_files + already_added_files)
+        if args.elf_closure:
+            roots, ld_library_path, exec_path = get_closure_roots(rendered_manifest_dict)
+            generated_files = generate_closure_trusted_files(roots, ld_library_path, exec_path,
+                                                             args.data_path, already_added_files,
+                                                             exclusion_rules)
+        else:
+            generated_files = generate_trusted_files(args.dir, already_added_files,
+                                                     exclusion_rules)
+        if args.access_trace:
+            # the LibOS maps the app binary, its ELF interpreter and its libraries without
+            # syscalls, so their closure is always kept
+            roots, ld_library_path, exec_path = get_closure_roots(rendered_manifest_dict)
+            keep = list(generate_elf_closure(roots, ld_library_path, exec_path))
+            runtime_dirs = [d for d in ld_library_path.split(':') if d.startswith('/gramine/')]
+            accessed = add_gramine_runtime_paths(read_access_trace(args.access_trace),
+                                                 runtime_dirs)
+            generated_files = prune_to_access_trace(generated_files, accessed, keep)
+        # files from the user manifest may be reachable via other paths as well
+        user_files = ((uri, True) for uri in already_added_files)
+        generated_files = itertools.chain(generated_files, user_files)
+        if report is not None:
+            generated_files = report.timed_iter('walk', generated_files)
+        # all trusted files (including the ones from the user manifest) are emitted by
+        # `write_manifest()` below
+        rendered_manifest_dict['sgx'].pop('trusted_files', None)
+        trusted_files = expand_trusted_files(generated_files, num_workers=args.jobs,
+                                             hash_index=hash_index, new_hash_index=new_hash_index,
+                                             report=report, strict_hash_index=strict_hash_index)
     else:
-        print(f'\t[from inside Docker container] Skipping trusted files generation. This image must not be used in production.')
+        print(f'\t[from inside Docker container] Skipping trusted files generation. This image '
+              f'must not be used in production.')
 
-    with open(manifest, 'wb') as manifest_file:
-        tomli_w.dump(rendered_manifest_dict, manifest_file)
+    write_manifest(manifest, rendered_manifest_dict, trusted_files, report=report)
+    if new_hash_index is not None:
+        write_hash_index(args.write_hash_index, new_hash_index)
+    if report is not None:
+        report.write(args.report)
     print(f'\t[from inside Docker container] Successfully finalized `{manifest}`.')
 
 if __name__ == '__main__':
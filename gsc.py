@@ -5,15 +5,30 @@
 #                         Dmitrii Kuvaiskii <dmitrii.kuvaiskii@intel.com>
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import fnmatch
+import functools
+import getpass
 import hashlib
+import io
+import json
 import os
 import pathlib
 import re
 import shutil
 import struct
+import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import traceback
 import uuid
+import zlib
 
 import docker  # pylint: disable=import-error
 import jinja2
@@ -22,6 +37,8 @@ import tomli   # pylint: disable=import-error
 import tomli_w # pylint: disable=import-error
 import yaml    # pylint: disable=import-error
 
+import finalize_manifest
+
 class DistroRetrievalError(Exception):
     def __init__(self, *args):
         super().__init__(('Could not automatically detect the OS distro of the supplied Docker '
@@ -50,6 +67,99 @@ def gsc_tmp_build_path(original_image_name):
     return pathlib.Path('build') / f'gsc-{original_image_name}'
 
 
+# Timeline of GSC phases and Docker build steps in the Chrome trace-event format (can be opened in
+# chrome://tracing or https://ui.perfetto.dev)
+class TraceTimeline:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.thread_ids = {}
+        self.lock = threading.Lock()
+
+    def timestamp(self, perf_counter_time):
+        return round((perf_counter_time - self.start) * 1e6)  # microseconds
+
+    def add_span(self, name, category, start, end, span_args=None):
+        with self.lock:
+            thread_id = self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids) + 1)
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': self.timestamp(start),
+                'dur': self.timestamp(end) - self.timestamp(start),
+                'pid': os.getpid(),
+                'tid': thread_id,
+                'args': span_args or {},
+            })
+
+    def write(self, filename):
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file, indent=1)
+
+
+# the timeline of the GSC command running in the current thread (if any)
+trace_local = threading.local()
+
+def add_trace_span(name, category, start, end, span_args=None):
+    timeline = getattr(trace_local, 'timeline', None)
+    if timeline is not None:
+        timeline.add_span(name, category, start, end, span_args)
+
+
+@contextlib.contextmanager
+def trace_span(name, category, **span_args):
+    start = time.perf_counter()
+    try:
+        yield span_args
+    finally:
+        add_trace_span(name, category, start, time.perf_counter(), span_args)
+
+
+# Decorator of GSC commands, which records the timeline of the command in
+# `<trace_path(args)>/trace-<command>.json` (by default `build/gsc-<image>/`); commands called by
+# other commands (e.g. by `gsc pipeline` or by the jobs of `gsc build-many`) record their phases in
+# the timeline of the calling command
+def traced_command(command_name, trace_path=lambda args: gsc_tmp_build_path(args.image),
+                   span_args=lambda args: {'image': args.image}):
+    def decorator(command):
+        @functools.wraps(command)
+        def wrapper(args, *command_args, **command_kwargs):
+            if getattr(trace_local, 'timeline', None) is not None:
+                with trace_span(command_name, 'command', **span_args(args)):
+                    return command(args, *command_args, **command_kwargs)
+
+            trace_local.timeline = TraceTimeline()
+            try:
+                with trace_span(command_name, 'command', **span_args(args)):
+                    return command(args, *command_args, **command_kwargs)
+            finally:
+                timeline = trace_local.timeline
+                trace_local.timeline = None
+                # nothing is written if the command failed before creating its build directory
+                if os.path.isdir(trace_path(args)):
+                    timeline.write(trace_path(args) / f'trace-{command_name}.json')
+        return wrapper
+    return decorator
+
+
+# Wraps `function` to run in another thread (e.g. of a `ThreadPoolExecutor`) with the timeline of
+# the calling thread, so that concurrent jobs show up as separate threads of the same timeline
+def traced_in_thread(function):
+    timeline = getattr(trace_local, 'timeline', None)
+
+    @functools.wraps(function)
+    def wrapper(*function_args):
+        trace_local.timeline = timeline
+        try:
+            return function(*function_args)
+        finally:
+            trace_local.timeline = None
+    return wrapper
+
+
 def get_docker_image(docker_socket, image_name):
     try:
         docker_image = docker_socket.images.get(image_name)
@@ -58,14 +168,943 @@ def get_docker_image(docker_socket, image_name):
         return None
 
 
-def build_docker_image(docker_api, build_path, image_name, dockerfile, **kwargs):
+def read_file_from_container(container, path, max_symlinks=8):
+    # Read the file via the archive API, which works for containers which were never started
+    for _ in range(max_symlinks):
+        try:
+            stream, _ = container.get_archive(path)
+        except docker.errors.NotFound:
+            return None
+        with tarfile.open(fileobj=io.BytesIO(b''.join(stream))) as archive:
+            member = archive.next()
+            if member.issym():
+                # e.g. `/etc/os-release -> ../usr/lib/os-release`
+                path = os.path.normpath(os.path.join(os.path.dirname(path), member.linkname))
+                continue
+            if not member.isfile():
+                return None
+            return archive.extractfile(member).read()
+    return None
+
+
+def path_exists_in_container(container, path):
+    try:
+        container.get_archive(path)
+    except docker.errors.NotFound:
+        return False
+    return True
+
+
+def read_file_from_image(docker_socket, image_name, path, max_symlinks=8):
+    # Create (but do not start) a container from the image and read the file via the archive API;
+    # this is much faster than running a container and works even if the image has no shell
+    with trace_span(f'read {path}', 'docker', image=image_name):
+        container = docker_socket.containers.create(image_name, entrypoint=['/bin/true'])
+        try:
+            return read_file_from_container(container, path, max_symlinks)
+        finally:
+            container.remove()
+
+
+def run_in_container(docker_socket, image_name, command, files=None, stdin=None, tmpfs=None,
+                     output_path=None):
+    # Runs `command` (the arguments of `sh -c`) as root in a temporary container of the image and
+    # returns its exit status, its output and (if `output_path` is given and the command succeeded)
+    # the tar archive of `output_path`. Files are passed via the Docker API instead of bind mounts,
+    # which would refer to the host of a remote Docker daemon (`DOCKER_HOST`): `files` maps absolute
+    # paths in the container to their contents, and `stdin` is written to the standard input of the
+    # command, e.g. secrets which must not be stored in any file.
+    container = docker_socket.containers.create(image_name, command, entrypoint=['sh', '-c'],
+                                                user='0:0', stdin_open=stdin is not None,
+                                                stdin_once=stdin is not None, tmpfs=tmpfs or {})
+    try:
+        if files:
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as files_tar:
+                dirs = set()
+                for path, contents in files.items():
+                    components = path.strip('/').split('/')
+                    for i in range(1, len(components)):
+                        dirpath = '/'.join(components[:i])
+                        if dirpath not in dirs:
+                            dirs.add(dirpath)
+                            member = tarfile.TarInfo(dirpath)
+                            member.type = tarfile.DIRTYPE
+                            member.mode = 0o755
+                            files_tar.addfile(member)
+                    member = tarfile.TarInfo('/'.join(components))
+                    member.size = len(contents)
+                    member.mode = 0o644
+                    files_tar.addfile(member, io.BytesIO(contents))
+            container.put_archive('/', archive.getvalue())
+        if stdin is not None:
+            stdin_socket = container.attach_socket(params={'stdin': 1, 'stream': 1})
+        container.start()
+        if stdin is not None:
+            # docker-py wraps the socket of the attached connection in a read-only file object;
+            # closing the connection closes the standard input of the command (`stdin_once`)
+            raw_socket = getattr(stdin_socket, '_sock', stdin_socket)
+            raw_socket.sendall(stdin)
+            raw_socket.close()
+            stdin_socket.close()
+        status = container.wait()['StatusCode']
+        output = container.logs(stdout=True, stderr=True)
+        archive = None
+        if output_path is not None and status == 0:
+            chunks, _ = container.get_archive(output_path)
+            archive = b''.join(chunks)
+        return status, output, archive
+    finally:
+        container.remove(force=True)
+
+
+# File system of a Docker image, reconstructed from the layer tarballs of `docker save` without
+# extracting them. Regular files are not read, only the layer tarball and member of their data are
+# recorded (`source`), so that they can be hashed from another stream of the saved image.
+class ImageFsNode:
+    __slots__ = ('kind', 'mode', 'uid', 'gid', 'size', 'sha256', 'data', 'source', 'linkname',
+                 'layer', 'children')
+
+    def __init__(self, kind, member=None, layer=-1, data=None, source=None):
+        self.kind = kind  # 'dir', 'file', 'symlink' or 'other'
+        self.mode = member.mode if member is not None else 0o755
+        self.uid = member.uid if member is not None else 0
+        self.gid = member.gid if member is not None else 0
+        self.size = member.size if member is not None and kind == 'file' else 0
+        self.sha256 = None    # of the contents of files, see `hash_image_fs_files()`
+        self.data = data      # contents of small files in /etc, see `load_image_fs()`
+        self.source = source  # `(layer tarball name, member name)` of files
+        self.linkname = member.linkname if member is not None and kind == 'symlink' else None
+        self.layer = layer
+        self.children = {} if kind == 'dir' else None
+
+
+def save_docker_image(docker_socket, image_name, saved_image_file):
+    for chunk in docker_socket.api.get_image(image_name):
+        saved_image_file.write(chunk)
+    saved_image_file.flush()
+
+
+def image_fs_lookup(root, path, follow_symlinks=True, max_symlinks=40):
+    # resolves `path` like the kernel would do it with `root` as the root directory
+    components = [c for c in path.split('/') if c and c != '.']
+    dirs = [root]
+    node = root
+    num_symlinks = 0
+    while components:
+        component = components.pop(0)
+        if component == '..':
+            if len(dirs) > 1:
+                dirs.pop()
+            node = dirs[-1]
+            continue
+        node = dirs[-1].children.get(component)
+        if node is None:
+            return None
+        if node.kind == 'symlink' and (components or follow_symlinks):
+            num_symlinks += 1
+            if num_symlinks > max_symlinks:
+                return None
+            if node.linkname.startswith('/'):
+                dirs = [root]
+            components = [c for c in node.linkname.split('/') if c and c != '.'] + components
+            node = dirs[-1]
+            continue
+        if components:
+            if node.kind != 'dir':
+                return None
+            dirs.append(node)
+    return node
+
+
+def get_saved_layer_member(saved_image, layer_name):
+    member = saved_image.getmember(layer_name)
+    while member.issym():
+        # older Docker versions save identical layers once and symlink the others
+        layer_name = os.path.normpath(os.path.join(os.path.dirname(layer_name), member.linkname))
+        member = saved_image.getmember(layer_name)
+    return member
+
+
+class ChunkReader:
+    # read-only file object over an iterator of byte chunks (e.g. the stream of `docker save`), for
+    # `tarfile`'s stream mode
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.offset = 0
+
+    def peek(self, size):
+        # returns up to `size` bytes without consuming them
+        data = self.read(size)
+        self.offset -= len(data)
+        return data
+
+    def read(self, size=-1):
+        if 0 <= size <= len(self.buffer) - self.offset:
+            # typically, chunks are much larger than the reads of `tarfile`
+            data = self.buffer[self.offset:self.offset + size]
+            self.offset += size
+            return data
+        pieces = [self.buffer[self.offset:]]
+        available = len(pieces[0])
+        while size < 0 or available < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            pieces.append(chunk)
+            available += len(chunk)
+        self.buffer = b''.join(pieces)
+        self.offset = min(size, len(self.buffer)) if size >= 0 else len(self.buffer)
+        return self.buffer[:self.offset]
+
+
+def decompress_layer_chunks(reader):
+    # yields the decompressed chunks of a (possibly gzip- or zstd-compressed) layer tarball, e.g. of
+    # images pulled from registries with containerd's image store
+    magic = reader.peek(4)
+    read_chunks = iter(functools.partial(reader.read, finalize_manifest.HASH_BLOCK_SIZE), b'')
+    if magic[:2] == b'\x1f\x8b':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif magic == b'\x28\xb5\x2f\xfd':
+        try:
+            import zstandard  # pylint: disable=import-error,import-outside-toplevel
+        except ImportError:
+            raise tarfile.ReadError('zstd-compressed image layers require the Python package '
+                                    '`zstandard`') from None
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        yield from read_chunks
+        return
+    for chunk in read_chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def iter_saved_image_layers(image_chunks, links=None, blobs=None):
+    # Yields `(name, layer_tar)` for the layer tarballs in the stream of `docker save`, in the
+    # order of the stream (not of the layers of the image), with `layer_tar` opened in stream mode.
+    # Symlinks between layer tarballs (older Docker versions save identical layers once) are added
+    # to `links` and other members (JSON metadata) to `blobs`.
+    with tarfile.open(fileobj=ChunkReader(image_chunks), mode='r|') as saved_image:
+        for saved_member in saved_image:
+            if saved_member.issym():
+                if links is not None:
+                    links[saved_member.name] = os.path.normpath(os.path.join(
+                        os.path.dirname(saved_member.name), saved_member.linkname))
+                continue
+            if not saved_member.isreg():
+                continue
+            layer_reader = ChunkReader(decompress_layer_chunks(
+                ChunkReader(iter(functools.partial(saved_image.extractfile(saved_member).read,
+                                                   finalize_manifest.HASH_BLOCK_SIZE), b''))))
+            if layer_reader.peek(tarfile.BLOCKSIZE)[257:262] != b'ustar':
+                # JSON metadata (or an empty layer)
+                if blobs is not None:
+                    blobs[saved_member.name] = layer_reader.read()
+                continue
+            with tarfile.open(fileobj=layer_reader, mode='r|') as layer_tar:
+                yield saved_member.name, layer_tar
+
+
+# Files in /etc of the image of up to this size are kept in memory (e.g. /etc/passwd and
+# /etc/ld.so.conf), see `read_image_fs_file()`
+IMAGE_FS_MAX_DATA_SIZE = 64 * 1024
+
+# Smaller files of the image are hashed in the thread reading the stream of `docker save`
+IMAGE_FS_MIN_PARALLEL_SIZE = 64 * 1024
+
+def load_image_fs(image_chunks):
+    # Returns the root directory node of the merged file system of all layers of the image, given
+    # the stream of `docker save`. The image is never stored and only the headers of the layer
+    # tarballs (and small files in /etc) are kept in memory; the layers are merged only at the end
+    # of the stream, as their order is given by `manifest.json` at the end of the saved image.
+    # Files are hashed afterwards, see `hash_image_fs_files()`.
+    layers = {}  # name of layer tarball in the saved image -> `(member, data)` tuples
+    links = {}
+    blobs = {}
+    for layer_name, layer_tar in iter_saved_image_layers(image_chunks, links, blobs):
+        layer_members = layers[layer_name] = []
+        for member in layer_tar:
+            data = None
+            if member.isreg() and member.size <= IMAGE_FS_MAX_DATA_SIZE:
+                components = [c for c in member.name.split('/') if c and c != '.']
+                if components[:1] == ['etc']:
+                    data = layer_tar.extractfile(member).read()
+            layer_members.append((member, data))
+
+    manifest = json.loads(blobs['manifest.json'])
+    root = ImageFsNode('dir')
+    for layer, layer_name in enumerate(manifest[0]['Layers']):
+        while layer_name in links:
+            layer_name = links[layer_name]
+        # empty layers may be saved as a tarball without any members
+        for member, data in layers.get(layer_name, []):
+            apply_layer_member(root, member, layer, data, source=(layer_name, member.name))
+    return root
+
+
+def hash_image_fs_files(image_chunks, nodes, num_workers=1, report=None):
+    # Hashes the regular files `nodes` of a file system returned by `load_image_fs()`, given another
+    # stream of `docker save` of the same image. Only the data of these files is read (e.g. not of
+    # files deleted by upper layers or excluded from the trusted files), files of up to
+    # `HASH_BLOCK_SIZE` in worker threads with a bounded amount of pending data; the stream is
+    # abandoned as soon as all files are hashed.
+    def hash_data(data):
+        start = time.perf_counter()
+        sha256 = hashlib.sha256(data).hexdigest()
+        if report is not None:
+            report.add_time('hash_worker', time.perf_counter() - start)
+        return sha256
+
+    wanted = collections.defaultdict(dict)  # layer tarball -> member name -> nodes
+    for node in nodes:
+        if node.sha256 is None:
+            wanted[node.source[0]].setdefault(node.source[1], set()).add(node)
+    num_wanted = sum(len(members) for members in wanted.values())
+    if not num_wanted:
+        return
+
+    hashed = []
+    pending = collections.deque()
+    pending_bytes = 0
+    max_pending_bytes = 4 * finalize_manifest.HASH_BLOCK_SIZE * num_workers
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        layers = iter_saved_image_layers(image_chunks)
+        for layer_name, layer_tar in layers:
+            layer_wanted = wanted.get(layer_name)
+            if not layer_wanted:
+                continue
+            for member in layer_tar:
+                if not member.isreg() or member.name not in layer_wanted:
+                    continue
+                member_file = layer_tar.extractfile(member)
+                if member.size <= finalize_manifest.HASH_BLOCK_SIZE:
+                    contents = member_file.read()
+                    if len(contents) < IMAGE_FS_MIN_PARALLEL_SIZE:
+                        # cheaper than handing the file over to a worker
+                        sha256 = hash_data(contents)
+                    else:
+                        sha256 = executor.submit(hash_data, contents)
+                        pending.append((sha256, len(contents)))
+                        pending_bytes += len(contents)
+                else:
+                    start = time.perf_counter()
+                    file_sha256 = hashlib.sha256()
+                    for block in iter(functools.partial(
+                            member_file.read, finalize_manifest.HASH_BLOCK_SIZE), b''):
+                        file_sha256.update(block)
+                    sha256 = file_sha256.hexdigest()
+                    if report is not None:
+                        report.add_time('hash_worker', time.perf_counter() - start)
+                # a later member of the same name (if any) replaces this one, as in the layer
+                hashed.append((layer_wanted[member.name], sha256))
+                while pending and (pending_bytes > max_pending_bytes or pending[0][0].done()):
+                    future, size = pending.popleft()
+                    future.result()
+                    pending_bytes -= size
+            del wanted[layer_name]
+            num_wanted -= len(layer_wanted)
+            if not num_wanted:
+                break
+        layers.close()
+
+    for file_nodes, sha256 in hashed:
+        if isinstance(sha256, concurrent.futures.Future):
+            sha256 = sha256.result()
+        for node in file_nodes:
+            node.sha256 = sha256
+    for node in nodes:
+        if node.sha256 is None:
+            raise tarfile.ReadError(f'data of `{node.source[1]}` not found in the saved image')
+
+
+def apply_layer_member(root, member, layer, data=None, source=None):
+    components = [c for c in member.name.split('/') if c and c != '.']
+    if not components:
+        return
+    parent = root
+    for component in components[:-1]:
+        node = parent.children.get(component)
+        if node is None or node.kind != 'dir':
+            node = parent.children[component] = ImageFsNode('dir', layer=layer)
+        parent = node
+
+    name = components[-1]
+    if name == '.wh..wh..opq':
+        # opaque directory: hide all entries of lower layers, also in subdirectories
+        hide_lower_layers(parent, layer)
+    elif name.startswith('.wh.'):
+        parent.children.pop(name[len('.wh.'):], None)
+    elif member.isdir():
+        node = parent.children.get(name)
+        new_node = ImageFsNode('dir', member, layer)
+        if node is not None and node.kind == 'dir':
+            # directories of different layers are merged
+            new_node.children = node.children
+        parent.children[name] = new_node
+    elif member.isreg():
+        parent.children[name] = ImageFsNode('file', member, layer, data, source)
+    elif member.issym():
+        parent.children[name] = ImageFsNode('symlink', member, layer)
+    elif member.islnk():
+        # hardlinks share the node, i.e. the data in the layer tarball
+        target = image_fs_lookup(root, member.linkname, follow_symlinks=False)
+        parent.children[name] = target if target is not None else ImageFsNode('other', member,
+                                                                              layer)
+    else:
+        parent.children[name] = ImageFsNode('other', member, layer)
+
+
+def hide_lower_layers(dir_node, layer):
+    # keeps only the entries of `layer` below `dir_node` (directories of lower layers are kept only
+    # as parents of such entries); hardlinks into other directories may still share nodes
+    children = {}
+    for name, node in dir_node.children.items():
+        if node.kind == 'dir':
+            hide_lower_layers(node, layer)
+            if node.layer != layer and not node.children:
+                continue
+        elif node.layer != layer:
+            continue
+        children[name] = node
+    dir_node.children = children
+
+
+def read_image_fs_file(root, path):
+    # only the contents of small files in /etc are available, see `load_image_fs()`
+    node = image_fs_lookup(root, path)
+    if node is None or node.kind != 'file':
+        return None
+    return node.data
+
+
+def resolve_image_user(root, user):
+    # returns the UID and the set of GIDs of the user (`name`, `uid`, `name:group` or `uid:gid`)
+    # as in the image's /etc/passwd and /etc/group
+    user, _, group = user.partition(':')
+    def parse_db(path):
+        contents = read_image_fs_file(root, path) or b''
+        return [line.split(':') for line in contents.decode('UTF-8', 'replace').splitlines()
+                if line and not line.startswith('#')]
+    passwd = parse_db('/etc/passwd')
+    groups = parse_db('/etc/group')
+
+    uid = gid = None
+    for entry in passwd:
+        if len(entry) >= 4 and user in (entry[0], entry[2]):
+            uid, gid = int(entry[2]), int(entry[3])
+            break
+    if uid is None:
+        uid = int(user) if user.isdigit() else 0
+    gids = set()
+    if group:
+        for entry in groups:
+            if len(entry) >= 3 and group in (entry[0], entry[2]):
+                gids.add(int(entry[2]))
+        if not gids and group.isdigit():
+            gids.add(int(group))
+    else:
+        if gid is not None:
+            gids.add(gid)
+        user_names = {entry[0] for entry in passwd if len(entry) >= 3 and entry[2] == str(uid)}
+        for entry in groups:
+            if len(entry) >= 4 and user_names & set(entry[3].split(',')):
+                gids.add(int(entry[2]))
+    return uid, gids
+
+
+def image_fs_access(node, uid, gids, mask):
+    # same as `os.access()` for the given user; `mask` is a combination of 4 (read) and 1 (execute)
+    if uid == 0:
+        return True
+    if node.uid == uid:
+        bits = node.mode >> 6
+    elif node.gid in gids:
+        bits = node.mode >> 3
+    else:
+        bits = node.mode
+    return bits & mask == mask
+
+
+def emulate_library_paths(root, image_env):
+    # emulates `generate_library_paths()` of finalize_manifest.py (i.e. the directories listed by
+    # `ldconfig -v -N -X` plus `LD_LIBRARY_PATH`) based on /etc/ld.so.conf of the image
+    dirs = []
+    def parse_conf(path, depth=0):
+        contents = read_image_fs_file(root, path)
+        if contents is None or depth > 8:
+            return
+        for line in contents.decode('UTF-8', 'replace').splitlines():
+            line = line.split('#', 1)[0].strip()
+            if line.startswith('include '):
+                for pattern in line[len('include '):].split():
+                    pattern = os.path.join(os.path.dirname(path), pattern)
+                    parent = image_fs_lookup(root, os.path.dirname(pattern))
+                    if parent is None or parent.kind != 'dir':
+                        continue
+                    for name in sorted(parent.children):
+                        if fnmatch.fnmatchcase(name, os.path.basename(pattern)):
+                            parse_conf(os.path.join(os.path.dirname(pattern), name), depth + 1)
+            elif line and not line.startswith('hwcap '):
+                dirs.extend(d for d in re.split(r'[\s:,=]+', line) if d.startswith('/'))
+    parse_conf('/etc/ld.so.conf')
+    dirs += ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+
+    library_paths = ''
+    seen = set()
+    for dirpath in dirs:
+        # like ldconfig, skip non-existing directories and duplicates (e.g. `/lib -> usr/lib`)
+        node = image_fs_lookup(root, dirpath)
+        if node is None or node.kind != 'dir' or id(node) in seen:
+            continue
+        seen.add(id(node))
+        library_paths += f'{dirpath.rstrip("/") or "/"}:'
+    return library_paths + image_env.get('LD_LIBRARY_PATH', '')
+
+
+def walk_image_fs(root, uid, gids, exclusion_rules):
+    # same as `generate_trusted_files()` of finalize_manifest.py, but on the image file system;
+    # yields `(path, node)` pairs
+    exclude_re = finalize_manifest.EXCLUDED_PATHS_RE
+
+    def walk_dir(top_path, top_node):
+        stack = [(top_path, top_node, frozenset())]
+        while stack:
+            dirpath, dir_node, ancestors = stack.pop()
+            if not image_fs_access(dir_node, uid, gids, 5):
+                # cannot be listed, same as `walk_files()`
+                continue
+            ancestors = ancestors | {id(dir_node)}
+            subdirs = []
+            for name, entry in dir_node.children.items():
+                path = f'{dirpath.rstrip("/")}/{name}'
+                node = image_fs_lookup(root, path) if entry.kind == 'symlink' else entry
+                if node is None:
+                    continue
+                if node.kind == 'dir':
+                    if exclude_re.match(path):
+                        continue
+                    if exclusion_rules is not None and exclusion_rules.prune_dir(path):
+                        continue
+                    if id(node) in ancestors:
+                        print(f'Skipping directory {path}: symlink cycle detected.')
+                        continue
+                    subdirs.append((path, node, ancestors))
+                elif node.kind == 'file':
+                    yield path, node
+            stack.extend(reversed(subdirs))
+
+    for path, node in walk_dir('/', root):
+        try:
+            path.encode('UTF-8')
+        except UnicodeError:
+            # we append filenames as TOML strings which must be in UTF-8
+            sys.exit(f'File {path!r} is not in UTF-8!')
+        if exclude_re.match(path) or '\n' in path:
+            continue
+        if exclusion_rules is not None and exclusion_rules.exclude_file(path, size=node.size):
+            continue
+        if not image_fs_access(node, uid, gids, 4):
+            print(f'File {path} is inaccessible!')
+            continue
+        yield path, node
+
+
+def finalize_manifest_on_host(docker_socket, image_name, finalized_image_name, tmp_build_path,
+                              app_user, path_command, args, trusted_files_config):
+    # Host-side equivalent of running finalize_manifest.py inside the image: the image is streamed
+    # from `docker save` (without starting a container or storing the saved image) and its layers
+    # are merged into an in-memory file system; then only the trusted files of the merged file
+    # system are hashed (in parallel) from a second stream. The finalized manifest is checked with
+    # `gramine-manifest-check` in a container of the image and added to the image as a single small
+    # layer. Files are passed to the Docker daemon only via its API, so this also works with a
+    # remote daemon (`DOCKER_HOST`).
+    report = finalize_manifest.FinalizeReport()
+    image = docker_socket.images.get(image_name)
+    image_env = dict(env_var.split('=', maxsplit=1)
+                     for env_var in image.attrs['Config'].get('Env') or [])
+
+    exclusion_rules = None
+    if trusted_files_config.get('Exclude'):
+        exclusion_rules = finalize_manifest.ExclusionRules(trusted_files_config['Exclude'],
+                                                           trusted_files_config.get('Include')
+                                                           or [])
+
+    start = time.perf_counter()
+    root = load_image_fs(docker_socket.api.get_image(image.id))
+    report.add_time('walk', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with open(tmp_build_path / 'entrypoint.manifest') as manifest_file:
+        manifest_template = jinja2.Template(manifest_file.read())
+    rendered_manifest_dict = tomli.loads(manifest_template.render(
+        library_paths=emulate_library_paths(root, image_env),
+        env_path=image_env.get('PATH', '')))
+    already_added_files = finalize_manifest.extract_files_from_user_manifest(
+        rendered_manifest_dict)
+    report.add_time('render', time.perf_counter() - start)
+
+    if 'allow_all_but_log' in rendered_manifest_dict['sgx'].get('file_check_policy', ''):
+        print('Skipping trusted files generation. This image must not be used in production.')
+        trusted_files = None
+    else:
+        start = time.perf_counter()
+        uid, gids = resolve_image_user(root, app_user)
+        files = []
+        already_added = set(already_added_files)
+        for path, node in walk_image_fs(root, uid, gids, exclusion_rules):
+            if f'file:{path}' not in already_added:
+                files.append((f'file:{path}', node))
+        print(f'Found {len(files)} files in the image.')
+        if exclusion_rules is not None:
+            exclusion_rules.print_report(prefix='')
+        for uri in already_added_files:
+            node = image_fs_lookup(root, str(finalize_manifest.uri2path(uri)))
+            if node is None or node.kind != 'file':
+                sys.exit(f'File not found in the image: {uri}')
+            files.append((uri, node))
+        report.add_time('walk', time.perf_counter() - start)
+
+        # hardlinks and aliases via symlinks share the node, so each file is counted once
+        seen = set()
+        for uri, node in files:
+            report.add_file(str(finalize_manifest.uri2path(uri)), node.size,
+                            id(node) not in seen, id(node) in seen)
+            seen.add(id(node))
+
+        start = time.perf_counter()
+        hash_image_fs_files(docker_socket.api.get_image(image.id), [node for _, node in files],
+                            args.finalize_jobs or finalize_manifest.default_num_workers(), report)
+        report.add_time('hash_wait', time.perf_counter() - start)
+        rendered_manifest_dict['sgx'].pop('trusted_files', None)
+        trusted_files = ({'uri': uri, 'sha256': node.sha256} for uri, node in files)
+
+    with tempfile.TemporaryDirectory() as inject_path:
+        finalize_manifest.write_manifest(os.path.join(inject_path, 'entrypoint.manifest'),
+                                         rendered_manifest_dict, trusted_files, report=report)
+        report.write(tmp_build_path / 'finalize_report.json')
+
+        # same check as at the end of finalizing the manifest inside the image
+        check_command = (f'{path_command + " && " if path_command else ""}gramine-manifest-check '
+                         '/gsc-finalized/entrypoint.manifest')
+        with open(os.path.join(inject_path, 'entrypoint.manifest'), 'rb') as manifest_file:
+            manifest = manifest_file.read()
+        with trace_span('gramine-manifest-check', 'gsc', image=image_name):
+            status, output, _ = run_in_container(docker_socket, image.id, [check_command],
+                files={'/gsc-finalized/entrypoint.manifest': manifest})
+        if status != 0:
+            print(output.decode('UTF-8', errors='replace'), file=sys.stderr)
+            sys.exit(f'The manifest finalized on the host for `{finalized_image_name}` is '
+                     f'invalid.')
+
+        # add the finalized manifest to the image as a new layer (which needs no container run)
+        with open(os.path.join(inject_path, 'Dockerfile'), 'w') as dockerfile:
+            dockerfile.write(f'FROM {image.id}\n'
+                             f'COPY --chown={app_user} entrypoint.manifest /gramine/app_files/\n')
+        build_docker_image(docker_socket.api, inject_path, finalized_image_name, 'Dockerfile',
+                           rm=True)
+
+    print(f'Finalized the manifest on the host: hashed {report.num_hashed} unique files '
+          f'({report.bytes_hashed / 2**20:.1f} MiB) for {report.num_files} trusted files.')
+
+
+class MergedLayerNode:
+    # node of the file system tree of merged layers (see `merge_layer_members()`); `member` is None
+    # for parent directories which are not part of the merged layers
+    def __init__(self, member=None, layer=None):
+        self.member = member
+        self.layer = layer
+        self.children = {}
+
+
+def merge_layer_members(root, members, layer):
+    # applies the members of the layer tarball with index `layer` on top of the tree `root` (a
+    # `MergedLayerNode`), so that the tree has the same effect as all layers applied so far;
+    # whiteouts are kept as they may hide files of the layers below the merged ones. Removing a
+    # subtree only unlinks it from its parent, so each member is applied in O(depth).
+    def lookup(components, create):
+        node = root
+        for component in components:
+            child = node.children.get(component)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[component] = MergedLayerNode()
+            node = child
+        return node
+
+    for member in members:
+        path = os.path.normpath(member.name.lstrip('/'))
+        if path.startswith('./'):
+            path = path[len('./'):]
+        if path == '.':
+            continue
+        member.name = path
+        components = path.split('/')
+        parent = lookup(components[:-1], create=True)
+        name = components[-1]
+        if name == '.wh..wh..opq':
+            # hides the contents of the directory in all lower layers, but not the entries added
+            # by this layer before the marker
+            parent.children = {child_name: child for child_name, child in parent.children.items()
+                               if child.layer == layer}
+            parent.children[name] = MergedLayerNode(member, layer)
+            continue
+        if name.startswith('.wh.'):
+            parent.children.pop(name[len('.wh.'):], None)
+            parent.children[name] = MergedLayerNode(member, layer)
+            continue
+
+        recreated = parent.children.pop('.wh.' + name, None) is not None
+        node = parent.children.get(name)
+        if (node is None or not member.isdir()
+                or (node.member is not None and not node.member.isdir())):
+            node = parent.children[name] = MergedLayerNode()
+        if member.islnk():
+            # hardlinks refer to members of the same layer, which may be replaced by later layers;
+            # store them as regular files with the data of their target
+            target = lookup(os.path.normpath(member.linkname.lstrip('/')).split('/'),
+                            create=False)
+            if target is None or target.member is None or not target.member.isreg():
+                del parent.children[name]
+                continue
+            member = copy.copy(target.member)
+            member.name = path
+        node.member = member
+        node.layer = layer
+        if recreated and member.isdir():
+            # the directory was deleted before, so its contents in the lower layers stay hidden
+            opaque = tarfile.TarInfo(f'{path}/.wh..wh..opq')
+            opaque.mtime = member.mtime
+            node.children['.wh..wh..opq'] = MergedLayerNode(opaque, layer)
+
+
+def iter_merged_members(root):
+    # yields the members of the tree of merged layers, parent directories before their contents
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.member is not None:
+            yield node.member
+        stack.extend(node.children[name] for name in sorted(node.children, reverse=True))
+
+
+def squash_gsc_layers(docker_socket, base_image_name, image_name):
+    # Replaces `image_name` by an image which consists of the unchanged layers of `base_image_name`
+    # (so that they stay shared with the original image, e.g. in a registry) and a single layer
+    # with the merged contents of all layers added on top of them by GSC
+    base_image = get_docker_image(docker_socket, base_image_name)
+    image = get_docker_image(docker_socket, image_name)
+    if base_image is None:
+        print(f'Cannot find original application Docker image `{base_image_name}`, which is '
+              f'needed to squash the layers of `{image_name}`.')
+        sys.exit(1)
+    base_layers = base_image.attrs['RootFS']['Layers']
+    layers = image.attrs['RootFS']['Layers']
+    if layers[:len(base_layers)] != base_layers:
+        print(f'Docker image `{image_name}` is not based on `{base_image_name}`, cannot squash '
+              f'its layers.')
+        sys.exit(1)
+    num_added_layers = len(layers) - len(base_layers)
+    if num_added_layers <= 1:
+        print(f'Docker image `{image_name}` has {num_added_layers} layers on top of '
+              f'`{base_image_name}`, nothing to squash.')
+        return
+
+    repo_tag = image_name if ':' in image_name.rsplit('/', 1)[-1] else f'{image_name}:latest'
+    num_base_history = len(docker_socket.api.history(base_image.id))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        saved_image_path = os.path.join(tmp_dir, 'image.tar')
+        squashed_image_path = os.path.join(tmp_dir, 'squashed.tar')
+        with open(saved_image_path, 'wb') as saved_image_file:
+            save_docker_image(docker_socket, image.id, saved_image_file)
+
+        with tarfile.open(saved_image_path) as saved_image, \
+                open(saved_image_path, 'rb') as saved_image_file, \
+                tarfile.open(squashed_image_path, 'w', format=tarfile.PAX_FORMAT) as squashed_image:
+            manifest = json.load(saved_image.extractfile('manifest.json'))
+            config = json.load(saved_image.extractfile(manifest[0]['Config']))
+            layer_members = [get_saved_layer_member(saved_image, layer_name)
+                             for layer_name in manifest[0]['Layers']]
+
+            merged = MergedLayerNode()
+            for layer, layer_member in enumerate(layer_members[len(base_layers):]):
+                saved_image_file.seek(layer_member.offset_data)
+                # the offsets of members are relative to the start of the saved image
+                with tarfile.open(fileobj=saved_image_file, mode='r:') as layer_tar:
+                    merge_layer_members(merged, list(layer_tar), layer)
+
+            squashed_layer_path = os.path.join(tmp_dir, 'layer.tar')
+            with tarfile.open(squashed_layer_path, 'w', format=tarfile.PAX_FORMAT) as layer_tar:
+                for member in iter_merged_members(merged):
+                    if member.isreg():
+                        saved_image_file.seek(member.offset_data)
+                        layer_tar.addfile(member, saved_image_file)
+                    else:
+                        layer_tar.addfile(member)
+            sha256 = hashlib.sha256()
+            with open(squashed_layer_path, 'rb') as layer_file:
+                for block in iter(functools.partial(layer_file.read,
+                                                    finalize_manifest.HASH_BLOCK_SIZE), b''):
+                    sha256.update(block)
+            diff_id = f'sha256:{sha256.hexdigest()}'
+
+            config['rootfs']['diff_ids'] = base_layers + [diff_id]
+            config['history'] = config.get('history', [])[:num_base_history] + [{
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'created_by': f'gsc: squashed {num_added_layers} layers added by GSC',
+            }]
+            config_data = json.dumps(config).encode()
+            config_name = f'{hashlib.sha256(config_data).hexdigest()}.json'
+
+            def add_data(name, data):
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                squashed_image.addfile(tarinfo, io.BytesIO(data))
+
+            add_data(config_name, config_data)
+            layer_names = []
+            for layer_name, layer_member in zip(manifest[0]['Layers'][:len(base_layers)],
+                                                layer_members):
+                saved_image_file.seek(layer_member.offset_data)
+                tarinfo = tarfile.TarInfo(layer_name)
+                tarinfo.size = layer_member.size
+                squashed_image.addfile(tarinfo, saved_image_file)
+                layer_names.append(layer_name)
+            squashed_image.add(squashed_layer_path, f'{diff_id[len("sha256:"):]}/layer.tar')
+            layer_names.append(f'{diff_id[len("sha256:"):]}/layer.tar')
+            add_data('manifest.json', json.dumps([{'Config': config_name, 'RepoTags': [repo_tag],
+                                                   'Layers': layer_names}]).encode())
+
+        os.remove(saved_image_path)
+        with open(squashed_image_path, 'rb') as squashed_image_file:
+            docker_socket.images.load(squashed_image_file)
+
+    squashed_image = docker_socket.images.get(repo_tag)
+    try:
+        docker_socket.images.remove(image.id)
+    except docker.errors.APIError:
+        # e.g. the image is still used by a container
+        pass
+    size_change = squashed_image.attrs['Size'] - image.attrs['Size']
+    print(f'Squashed {num_added_layers} layers added by GSC into one layer: `{image_name}` has '
+          f'{len(squashed_image.attrs["RootFS"]["Layers"])} instead of {len(layers)} layers, size '
+          f'{squashed_image.attrs["Size"] / 2**20:.1f} MiB ({size_change / 2**20:+.1f} MiB).')
+
+
+# Image label with the key of all inputs of `gsc build`, to skip rebuilding up-to-date images; the
+# signed image inherits it from the unsigned image
+BUILD_CACHE_LABEL = 'gsc_build_cache_key'
+
+# Options of `gsc build` which change the resulting image (others, e.g. `--rm`, `--reuse-hashes` or
+# the number of jobs, only change how it is built); build args are added separately
+BUILD_CACHE_ARGS = ('buildtype', 'insecure_args', 'elf_closure', 'host_finalize', 'compile_cache',
+                    'slim_runtime')
+
+def build_cache_input_files(config, args):
+    # yields the paths of all files which are copied into the build context or otherwise determine
+    # the built image, in a stable order
+    for source in (__file__, finalize_manifest.__file__, 'keys/intel-sgx-deb.key'):
+        yield source
+    for dirpath, dirnames, filenames in os.walk('templates'):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+    if args.access_trace:
+        yield args.access_trace
+    yield from host_repo_config_files(config.get('Distro') or 'auto')
+
+def compute_build_cache_key(original_image, gramine_image, gramine_commit, config,
+                            user_manifest_contents, args):
+    # The key is computed from the inputs only, before any slow step of the build (e.g. detecting
+    # the distro, preparing base-Gramine images or rendering templates), so that an up-to-date image
+    # is detected right away. `config` is the config file as it is (e.g. with `Distro: auto`), as
+    # the resolved values follow from the other inputs.
+    sha256 = hashlib.sha256()
+    def update(name, data):
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+        sha256.update(f'{name}\0{len(data)}\0'.encode('UTF-8'))
+        sha256.update(data)
+
+    update('original_image', original_image.id)
+    update('gramine_image', gramine_image.id if gramine_image is not None else '')
+    update('gramine_commit', gramine_commit or '')
+    update('config', json.dumps(config, sort_keys=True, default=str))
+    update('user_manifest', user_manifest_contents)
+    update('args', json.dumps({name: getattr(args, name) for name in BUILD_CACHE_ARGS},
+                              sort_keys=True))
+    update('build_args', json.dumps(extract_build_args(args), sort_keys=True))
+    for path in build_cache_input_files(config, args):
+        with open(path, 'rb') as input_file:
+            update(path, input_file.read())
+    return sha256.hexdigest()
+
+
+# Image label with the key of all inputs of `gsc sign-image`, to skip signing again if the signed
+# image is up to date
+SIGN_CACHE_LABEL = 'gsc_sign_cache_key'
+
+def compute_sign_cache_key(unsigned_image, sign_dockerfile_path, signing_key, args):
+    sha256 = hashlib.sha256()
+    sha256.update(f'unsigned_image\0{unsigned_image.id}\0'.encode('UTF-8'))
+    # the key (not the passphrase, which only decrypts it) and how the image is signed
+    sha256.update(signing_key.digest)
+    with open(sign_dockerfile_path, 'rb') as sign_dockerfile:
+        sha256.update(hashlib.sha256(sign_dockerfile.read()).digest())
+    sha256.update(f'squash\0{bool(args.squash)}'.encode('UTF-8'))
+    return sha256.hexdigest()
+
+
+def get_image_label(image, label):
+    if image is None:
+        return None
+    return (image.attrs['Config'].get('Labels') or {}).get(label)
+
+
+DOCKER_BUILD_STEP_RE = re.compile(r'^Step (\d+)/(\d+) : (.*)$')
+
+def build_docker_image(docker_api, build_path, image_name, dockerfile, capture_prefix=None,
+                       **kwargs):
+    # Returns the lines of the build output which start with `capture_prefix` (without the prefix);
+    # they are not printed.
     build_path = str(build_path) # Docker API doesn't understand PathLib's PosixPath type
-    stream = docker_api.build(path=build_path, tag=image_name, dockerfile=dockerfile,
-                              decode=True, **kwargs)
-    for chunk in stream:
-        if 'stream' in chunk:
-            for line in chunk['stream'].splitlines():
-                print(line)
+    captured = []
+    with trace_span(f'docker build {dockerfile}', 'docker', image=image_name):
+        stream = docker_api.build(path=build_path, tag=image_name, dockerfile=dockerfile,
+                                  decode=True, **kwargs)
+        # the (legacy) Docker builder reports each Dockerfile instruction as `Step N/M : ...`; each
+        # step lasts until the next one starts
+        step = None
+        partial_line = ''
+        for chunk in stream:
+            if 'stream' in chunk:
+                # long lines of the output may be split across chunks
+                lines = (partial_line + chunk['stream']).split('\n')
+                partial_line = lines.pop()
+                for line in lines:
+                    if capture_prefix is not None and line.startswith(capture_prefix):
+                        captured.append(line[len(capture_prefix):])
+                        continue
+                    print(line)
+                    match = DOCKER_BUILD_STEP_RE.match(line)
+                    if match:
+                        now = time.perf_counter()
+                        if step is not None:
+                            add_trace_span(step[0], 'docker-step', step[1], now, step[2])
+                        instruction = match.group(3)
+                        step = (f'Step {match.group(1)}/{match.group(2)}: {instruction[:60]}', now,
+                                {'instruction': instruction,
+                                 'finalize': 'finalize_manifest.py' in instruction})
+                    elif step is not None and line.strip() == '---> Using cache':
+                        step[2]['cached'] = True
+        if partial_line:
+            print(partial_line)
+        if step is not None:
+            add_trace_span(step[0], 'docker-step', step[1], time.perf_counter(), step[2])
+    return captured
 
 
 def extract_binary_info_from_image_config(config, env):
@@ -157,16 +1196,82 @@ def extract_define_args(args):
             sys.exit(1)
     return defineargs_dict
 
+def extract_finalize_manifest_args(args, trusted_files_config):
+    # the report is printed to the build output, so that it is not shipped in the image
+    finalize_args = ['--hash-index', '/gramine/meson_build_output/gsc_hash_index.json',
+                     '--report', '-']
+    if args.finalize_jobs:
+        finalize_args += ['--jobs', str(args.finalize_jobs)]
+    if args.reuse_hashes:
+        # the files of the previous image may have been rewritten with the same size and mtime
+        finalize_args += ['--strict-hash-index', '/gramine/app_files/gsc_hash_index.prev.json',
+                          '--write-hash-index', '/gramine/app_files/gsc_hash_index.json']
+    if args.elf_closure:
+        finalize_args.append('--elf-closure')
+        for data_path in trusted_files_config.get('DataPaths') or []:
+            finalize_args += ['--data-path', data_path]
+    if args.access_trace:
+        finalize_args += ['--access-trace', '/gramine/app_files/access_trace.log']
+    for rule in trusted_files_config.get('Exclude') or []:
+        finalize_args += ['--exclude', rule]
+    for rule in trusted_files_config.get('Include') or []:
+        finalize_args += ['--include', rule]
+    return finalize_args
+
 def extract_user_from_image_config(config, env):
     user = config.get('User') or 'root'
     env.globals.update({'app_user': user})
 
-def merge_manifests_in_order(manifest1, manifest2, manifest1_name, manifest2_name, path=[]):
+# Lists in manifests whose entries are merged by a key (the URI of files, the path of mounts)
+# instead of being concatenated, see `merge_manifest_lists()`
+MANIFEST_MERGE_KEYS = {
+    'sgx.trusted_files': 'uri',
+    'sgx.allowed_files': 'uri',
+    'sgx.protected_files': 'uri',
+    'fs.mounts': 'path',
+}
+
+def merge_manifest_lists(list1, list2, list_name, manifest1_name, manifest2_name, provenance):
+    # Returns the entries of `list1` followed by those of `list2`, where entries with the same key
+    # as an earlier entry are dropped (in case of different values, the first entry wins as for
+    # other duplicate keys). `provenance[list_name]` maps the keys to the manifest of their first
+    # entry.
+    key_field = MANIFEST_MERGE_KEYS[list_name]
+    sources = provenance.setdefault(list_name, {})
+    merged = []
+    positions = {}
+    for entries, manifest_name in ((list1, manifest1_name), (list2, manifest2_name)):
+        for entry in entries:
+            # files may be given as URI strings or as tables with a `uri` key
+            key = entry.get(key_field) if isinstance(entry, dict) else entry
+            if not isinstance(key, str):
+                merged.append(entry)
+                continue
+            if key not in positions:
+                positions[key] = len(merged)
+                merged.append(entry)
+                sources.setdefault(key, manifest_name)
+            elif merged[positions[key]] != entry:
+                print(f'Warning: Duplicate entry `{key}` in `{list_name}`. Overriding entry from '
+                      f'`{manifest_name}` by the one in `{sources.get(key, manifest1_name)}`.')
+    return merged
+
+def merge_manifests_in_order(manifest1, manifest2, manifest1_name, manifest2_name, path=[],
+                             provenance=None):
+    # `provenance` is updated with the origin of the entries of `MANIFEST_MERGE_KEYS` lists; pass
+    # the same dict to consecutive merges to keep the original manifest of each entry
+    if provenance is None:
+        provenance = {}
     for key in manifest2:
-        if key in manifest1:
+        list_name = '.'.join(path + [str(key)])
+        if (list_name in MANIFEST_MERGE_KEYS and isinstance(manifest2[key], list)
+                and isinstance(manifest1.get(key, []), list)):
+            manifest1[key] = merge_manifest_lists(manifest1.get(key, []), manifest2[key], list_name,
+                                                  manifest1_name, manifest2_name, provenance)
+        elif key in manifest1:
             if isinstance(manifest1[key], dict) and isinstance(manifest2[key], dict):
                 merge_manifests_in_order(manifest1[key], manifest2[key], manifest1_name,
-                                         manifest2_name, path + [str(key)])
+                                         manifest2_name, path + [str(key)], provenance)
             elif isinstance(manifest1[key], list) and isinstance(manifest2[key], list):
                 manifest1[key].extend(manifest2[key])
             elif manifest1[key] == manifest2[key]:
@@ -183,10 +1288,45 @@ def merge_manifests_in_order(manifest1, manifest2, manifest1_name, manifest2_nam
                 else:
                     print(f'Warning: Duplicate key `{".".join(path + [str(key)])}`. Overriding'
                           f' value from `{manifest2_name}` by the one in `{manifest1_name}`.')
+        elif isinstance(manifest2[key], dict):
+            manifest1[key] = merge_manifests_in_order({}, manifest2[key], manifest1_name,
+                                                      manifest2_name, path + [str(key)],
+                                                      provenance)
         else:
             manifest1[key] = manifest2[key]
+
+    # lists only present in `manifest1` may contain duplicates as well
+    for key in manifest1:
+        if key in manifest2:
+            continue
+        list_name = '.'.join(path + [str(key)])
+        if list_name in MANIFEST_MERGE_KEYS and isinstance(manifest1[key], list):
+            manifest1[key] = merge_manifest_lists(manifest1[key], [], list_name, manifest1_name,
+                                                  manifest2_name, provenance)
+        elif isinstance(manifest1[key], dict):
+            merge_manifests_in_order(manifest1[key], {}, manifest1_name, manifest2_name,
+                                     path + [str(key)], provenance)
     return manifest1
 
+REDHAT_REPO_PATH = '/etc/yum.repos.d/redhat.repo'
+SUSE_CREDENTIALS_PATH = '/etc/zypp/credentials.d/SCCcredentials'
+
+def host_repo_config_files(distro):
+    # returns the non-secret host files which `handle_redhat_repo_configs()` copies into the build
+    # context (if they exist); `distro` may still be `auto`. The secrets which are copied as well
+    # (the Red Hat entitlement certificates and keys, the SUSE credentials) are not inputs of the
+    # build cache key, so that no hash of them is stored in image labels: renewing them does not
+    # trigger a rebuild.
+    paths = []
+    if (distro == 'auto' or distro.startswith('redhat/')) and os.path.isfile(REDHAT_REPO_PATH):
+        paths.append(REDHAT_REPO_PATH)
+        with open(REDHAT_REPO_PATH) as redhat_repo:
+            redhat_repo_contents = redhat_repo.read()
+        match_sslcacert = re.search(r'(?<!#)sslcacert\s*=\s*(.*)', redhat_repo_contents)
+        if match_sslcacert and os.path.isfile(match_sslcacert.group(1)):
+            paths.append(match_sslcacert.group(1))
+    return paths
+
 def handle_redhat_repo_configs(distro, tmp_build_path):
     if not distro.startswith('redhat/'):
         return
@@ -198,7 +1338,7 @@ def handle_redhat_repo_configs(distro, tmp_build_path):
     else:
         raise ValueError(f'Invalid Red Hat distro format: {distro}')
 
-    with open('/etc/yum.repos.d/redhat.repo') as redhat_repo:
+    with open(REDHAT_REPO_PATH) as redhat_repo:
         redhat_repo_contents = redhat_repo.read()
 
         if not re.search(repo_name, redhat_repo_contents):
@@ -207,7 +1347,7 @@ def handle_redhat_repo_configs(distro, tmp_build_path):
                   f'Portal using Red Hat Subscription-Manager.')
             sys.exit(1)
 
-        shutil.copyfile('/etc/yum.repos.d/redhat.repo', tmp_build_path / 'redhat.repo')
+        shutil.copyfile(REDHAT_REPO_PATH, tmp_build_path / 'redhat.repo')
         pattern_sslclientkey = re.compile(r'(?<!#)sslclientkey\s*=\s*(.*)')
         pattern_sslcacert = re.compile(r'(?<!#)sslcacert\s*=\s*(.*)')
 
@@ -246,7 +1386,7 @@ def handle_suse_repo_configs(distro, tmp_build_path):
     if not distro.startswith('registry.suse.com/suse/sle'):
         return
 
-    if not os.path.exists('/etc/zypp/credentials.d/SCCcredentials'):
+    if not os.path.exists(SUSE_CREDENTIALS_PATH):
         print('Cannot find your SUSE Customer Center credentials file at '
                 '/etc/zypp/credentials.d/SCCcredentials. Please register and subscribe your SUSE '
                 'system to the SUSE Customer Center.')
@@ -255,7 +1395,7 @@ def handle_suse_repo_configs(distro, tmp_build_path):
     # This file contains the credentials for the SUSE Customer Center (SCC) account for the
     # system to authenticate and receive software updates and support from SUSE. Copy it to
     # the temporary build directory to include it in the graminized Docker image.
-    shutil.copyfile('/etc/zypp/credentials.d/SCCcredentials', tmp_build_path / 'SCCcredentials')
+    shutil.copyfile(SUSE_CREDENTIALS_PATH, tmp_build_path / 'SCCcredentials')
 
 def template_path(distro):
     if distro == 'quay.io/centos/centos':
@@ -284,43 +1424,315 @@ def get_sles_version(distro):
     match_ = re.match(r'^registry.suse.com/suse/sle(\d+):(\d+\.\d+)$', distro)
     return match_.group(2) if match_ else None
 
+# Caches of information derived from Docker images, keyed by image ID (an image ID identifies the
+# contents of the image, so the entries never become stale)
+IMAGE_CACHE_PATH = pathlib.Path('build') / '.cache'
+DISTRO_CACHE_PATH = IMAGE_CACHE_PATH / 'distro.json'
+SIGSTRUCT_CACHE_PATH = IMAGE_CACHE_PATH / 'sigstruct.json'
+image_cache_lock = threading.Lock()
+
+def load_image_cache(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def lookup_image_cache(cache_path, image_id):
+    with image_cache_lock:
+        return load_image_cache(cache_path).get(image_id)
+
+
+def store_image_cache(cache_path, image_id, value):
+    with image_cache_lock:
+        cache = load_image_cache(cache_path)
+        cache[image_id] = value
+        os.makedirs(cache_path.parent, exist_ok=True)
+        tmp_cache_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        with open(tmp_cache_path, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=1)
+        os.replace(tmp_cache_path, cache_path)
+
+
+def detect_image_distro(docker_socket, image_name):
+    # Read `/etc/os-release` and the marker files from the file system of a created (but not
+    # started) container, so that no container has to run
+    container = docker_socket.containers.create(image_name, entrypoint=['/bin/true'])
+    try:
+        out = read_file_from_container(container, '/etc/os-release')
+        if out is None:
+            raise DistroRetrievalError
+        out = out.decode('UTF-8')
+
+        os_release = dict(shlex.split(line)[0].split('=', maxsplit=1) for line in out.splitlines()
+                          if line.strip() and not line.startswith('#'))
+
+        if 'ID' not in os_release or 'VERSION_ID' not in os_release:
+            raise DistroRetrievalError
+
+        version_str = os_release['VERSION_ID']
+        version = version_str.split('.')
+        if os_release['ID'] == 'rhel':
+            # RedHat specific logic to distinguish between UBI and UBI-minimal
+            if path_exists_in_container(container, '/usr/bin/microdnf'):
+                distro = f'redhat/ubi{version[0]}-minimal:{version_str}'
+            else:
+                distro = f'redhat/ubi{version[0]}:{version_str}'
+        elif os_release['ID'] == 'sles':
+            distro = f'registry.suse.com/suse/sle{version[0]}:{version_str}'
+        else:
+            # Some OS distros (e.g. Alpine) have very precise versions (e.g. 3.17.3),
+            # and to support these OS distros, we need to truncate at the 2nd dot.
+            distro = os_release['ID'] + ':' + '.'.join(version[:2])
+
+        if os_release.get('NAME') == 'CentOS Stream':
+            distro = f'quay.io/centos/centos:stream{version[0]}'
+    finally:
+        container.remove()
+
+    return distro
+
+
 def get_image_distro(docker_socket, image_name):
-    out = docker_socket.containers.run(image_name, entrypoint='cat /etc/os-release', remove=True)
-    out = out.decode('UTF-8')
+    image_id = docker_socket.images.get(image_name).id
+    distro = lookup_image_cache(DISTRO_CACHE_PATH, image_id)
+    if distro is None:
+        distro = detect_image_distro(docker_socket, image_name)
+        store_image_cache(DISTRO_CACHE_PATH, image_id, distro)
+    return distro
 
-    os_release = dict(shlex.split(line)[0].split('=') for line in out.splitlines() if line.strip())
 
-    if 'ID' not in os_release or 'VERSION_ID' not in os_release:
-        raise DistroRetrievalError
+# Caches for compiling Gramine: a shallow mirror of each Gramine repository and a compiler cache
+# (ccache) per distro, which persist across builds and buildtypes
+GRAMINE_SOURCES_CACHE_PATH = IMAGE_CACHE_PATH / 'gramine-src'
+CCACHE_CACHE_PATH = IMAGE_CACHE_PATH / 'ccache'
+compile_cache_lock = threading.Lock()
 
-    version_str = os_release['VERSION_ID']
-    version = version_str.split('.')
-    if os_release['ID'] == 'rhel':
-        # RedHat specific logic to distinguish between UBI and UBI-minimal
-        try:
-            docker_socket.containers.run(image_name, entrypoint='ls /usr/bin/microdnf', remove=True)
-        except docker.errors.ContainerError:
-            distro = f'redhat/ubi{version[0]}:{version_str}'
+def run_git(*git_args):
+    try:
+        return subprocess.run(['git', *git_args], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).stdout.decode('UTF-8').strip()
+    except FileNotFoundError:
+        sys.exit('`--compile-cache` requires `git` on the host.')
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode('UTF-8', errors='replace')
+        sys.exit(f'`git {" ".join(git_args)}` failed:\n{stderr}')
+
+
+def prepare_gramine_compile_cache(gramine_config, distro, tmp_build_path):
+    # fetch only the requested branch/tag/commit (without history) into the local mirror, and
+    # export its sources into the build context
+    repository = gramine_config['Repository']
+    repository_hash = hashlib.sha256(repository.encode('UTF-8')).hexdigest()[:12]
+    mirror_path = GRAMINE_SOURCES_CACHE_PATH / f'{repository_hash}.git'
+    with compile_cache_lock:
+        if not os.path.exists(mirror_path):
+            os.makedirs(GRAMINE_SOURCES_CACHE_PATH, exist_ok=True)
+            run_git('init', '--quiet', '--bare', str(mirror_path))
+        run_git('--git-dir', str(mirror_path), 'fetch', '--quiet', '--depth', '1', repository,
+                str(gramine_config['Branch']))
+        commit = run_git('--git-dir', str(mirror_path), 'rev-parse', 'FETCH_HEAD^{commit}')
+        run_git('--git-dir', str(mirror_path), 'archive', '--format=tar',
+                '--output', str(pathlib.Path(tmp_build_path).resolve() / 'gramine-src.tar'),
+                commit)
+    print(f'Using Gramine commit {commit} from the local mirror `{mirror_path}`.')
+
+    # hard links instead of copies, the cache is replaced (not modified) after the build
+    ccache_path = CCACHE_CACHE_PATH / re.sub(r'[^A-Za-z0-9_.-]', '-', distro)
+    if os.path.exists(tmp_build_path / 'ccache'):
+        shutil.rmtree(tmp_build_path / 'ccache')
+    with compile_cache_lock:
+        if os.path.isdir(ccache_path):
+            shutil.copytree(ccache_path, tmp_build_path / 'ccache', copy_function=os.link)
         else:
-            distro = f'redhat/ubi{version[0]}-minimal:{version_str}'
-    elif os_release['ID'] == 'sles':
-        distro = f'registry.suse.com/suse/sle{version[0]}:{version_str}'
+            os.makedirs(tmp_build_path / 'ccache')
+    return ccache_path
+
+
+# Remove the Gramine sources and compiler cache of a previous build from the build context
+def remove_gramine_compile_cache_files(tmp_build_path):
+    if os.path.exists(tmp_build_path / 'gramine-src.tar'):
+        os.remove(tmp_build_path / 'gramine-src.tar')
+    if os.path.exists(tmp_build_path / 'ccache'):
+        shutil.rmtree(tmp_build_path / 'ccache')
+
+
+# Copy the compiler cache of the `gramine-compile` stage of `dockerfile` back to the host
+def update_gramine_compile_cache(docker_socket, tmp_build_path, dockerfile, ccache_path,
+                                 buildargs):
+    compile_image_name = f'gsc-gramine-compile-{uuid.uuid4().hex}'
+    # all layers of this stage were already built (and cached) by the preceding full build
+    build_docker_image(docker_socket.api, tmp_build_path, compile_image_name, dockerfile,
+                       target='gramine-compile', buildargs=buildargs)
+    if get_docker_image(docker_socket, compile_image_name) is None:
+        print('Failed to update the Gramine compiler cache.', file=sys.stderr)
+        return
+
+    with trace_span('update compiler cache', 'gsc'):
+        container = docker_socket.containers.create(compile_image_name, entrypoint=['/bin/true'])
+        try:
+            new_ccache_path = ccache_path.with_name(f'{ccache_path.name}.{uuid.uuid4().hex}.tmp')
+            os.makedirs(new_ccache_path)
+            with tempfile.TemporaryFile(dir=new_ccache_path) as archive_file:
+                stream, _ = container.get_archive('/ccache')
+                for chunk in stream:
+                    archive_file.write(chunk)
+                archive_file.seek(0)
+                with tarfile.open(fileobj=archive_file) as archive:
+                    members = [member for member in archive.getmembers()
+                               if (member.isfile() or member.isdir())
+                               and not os.path.isabs(member.name)
+                               and '..' not in pathlib.PurePosixPath(member.name).parts]
+                    archive.extractall(new_ccache_path, members=members)
+        finally:
+            container.remove()
+            docker_socket.images.remove(compile_image_name)
+
+        # the archive of `/ccache` contains the directory itself as `ccache/`
+        extracted_path = new_ccache_path / 'ccache'
+        if not os.path.isdir(extracted_path):
+            extracted_path = new_ccache_path
+        with compile_cache_lock:
+            old_ccache_path = ccache_path.with_name(f'{ccache_path.name}.{uuid.uuid4().hex}.old')
+            if os.path.exists(ccache_path):
+                os.rename(ccache_path, old_ccache_path)
+            os.rename(extracted_path, ccache_path)
+            shutil.rmtree(old_ccache_path, ignore_errors=True)
+            shutil.rmtree(new_ccache_path, ignore_errors=True)
+    print(f'Updated the Gramine compiler cache `{ccache_path}`.')
+
+
+# Base-Gramine images built by `gsc build` (unless `Gramine.ImageCacheSize` is 0) and by `gsc
+# build-many` are labeled with the Gramine commit, buildtype and distro, and reused by all later
+# builds with the same values; the least recently used images are removed when the images exceed
+# `Gramine.ImageCacheSize` (in GiB)
+GRAMINE_CACHE_LABELS = ('gsc_gramine_commit', 'gsc_gramine_buildtype', 'gsc_gramine_distro')
+GRAMINE_IMAGE_CACHE_PATH = IMAGE_CACHE_PATH / 'gramine-images.json'
+DEFAULT_GRAMINE_IMAGE_CACHE_SIZE = 20
+
+def gramine_image_cache_size(gramine_config):
+    # in bytes; 0 disables the cache in `gsc build`
+    return float(gramine_config.get('ImageCacheSize', DEFAULT_GRAMINE_IMAGE_CACHE_SIZE)) * 2**30
+
+def resolve_gramine_commit(gramine_config):
+    branch = str(gramine_config['Branch'])
+    if re.fullmatch(r'[0-9a-f]{40}', branch):
+        return branch
+    try:
+        out = subprocess.run(['git', 'ls-remote', gramine_config['Repository'], branch,
+                              f'{branch}^{{}}'],
+                             check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'Cannot resolve Gramine branch `{branch}`: {e}', file=sys.stderr)
+        return None
+    refs = dict(reversed(line.split('\t', maxsplit=1))
+                for line in out.stdout.decode('UTF-8').splitlines() if '\t' in line)
+    # annotated tags are listed twice, the `^{}` entry is the commit the tag points to
+    for ref in (f'refs/tags/{branch}^{{}}', f'refs/heads/{branch}', f'refs/tags/{branch}', branch):
+        if ref in refs:
+            return refs[ref]
+    print(f'Cannot find Gramine branch `{branch}` in `{gramine_config["Repository"]}`.',
+          file=sys.stderr)
+    return None
+
+
+def get_cached_gramine_image(docker_socket, args, config, distro, commit=None):
+    gramine_config = config['Gramine']
+    if commit is None:
+        commit = resolve_gramine_commit(gramine_config)
+    if commit is None:
+        return None
+    label_values = (commit, args.buildtype, distro)
+    labels = dict(zip(GRAMINE_CACHE_LABELS, label_values))
+    images = []
+    if not args.no_cache:
+        images = docker_socket.images.list(filters={'label': [f'{key}={value}'
+                                                              for key, value in labels.items()]})
+        images = [image for image in images if image.tags]
+    if images:
+        image = images[0]
+        print(f'Using cached base-Gramine Docker image `{image.tags[0]}` (commit {commit}).')
     else:
-        # Some OS distros (e.g. Alpine) have very precise versions (e.g. 3.17.3),
-        # and to support these OS distros, we need to truncate at the 2nd dot.
-        distro = os_release['ID'] + ':' + '.'.join(version[:2])
+        image_name = (f'gsc-gramine-cache:{re.sub(r"[^a-z0-9_.-]", "-", distro.lower())}-'
+                      f'{args.buildtype}-{commit[:12]}')
+        gramine_args = argparse.Namespace(image=image_name, buildtype=args.buildtype, rm=args.rm,
+                                          no_cache=args.no_cache, build_arg=args.build_arg,
+                                          config_file=None, file_only=False,
+                                          compile_cache=args.compile_cache)
+        build_config = copy.deepcopy(config)
+        build_config['Distro'] = distro
+        build_config['Gramine']['Branch'] = commit
+        try:
+            gsc_build_gramine(gramine_args, docker_socket, build_config, labels=labels)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise
+        image = get_docker_image(docker_socket, image_name)
+        if image is None:
+            sys.exit(f'Failed to build base-Gramine Docker image `{image_name}`.')
+
+    # only images recorded here are ever evicted, see `evict_cached_gramine_images()`
+    store_image_cache(GRAMINE_IMAGE_CACHE_PATH, image.tags[0], time.time())
+    return image
+
+
+def evict_cached_gramine_images(docker_socket, used_image_names, max_size):
+    # Removes the least recently used base-Gramine images until the images fit into `max_size`
+    # (in bytes), except for `used_image_names`. Only images which GSC recorded as used (see
+    # `get_cached_gramine_image()`) are considered, other images with the same labels are kept.
+    with image_cache_lock:
+        last_used = load_image_cache(GRAMINE_IMAGE_CACHE_PATH)
+
+    # the sizes of images include the layers they share (e.g. of the distro), so the size of the
+    # cache is overestimated
+    images = [image for image in
+              docker_socket.images.list(filters={'label': GRAMINE_CACHE_LABELS[0]})
+              if any(tag in last_used for tag in image.tags)]
+    images.sort(key=lambda image: max(last_used.get(tag, 0) for tag in image.tags))
+    total_size = sum(image.attrs['Size'] for image in images)
+    for image in images:
+        if total_size <= max_size:
+            break
+        if set(used_image_names) & set(image.tags):
+            continue
+        try:
+            for tag in image.tags:
+                docker_socket.images.remove(tag)
+        except docker.errors.APIError as e:
+            print(f'Cannot remove cached base-Gramine Docker image `{image.tags}`: {e}',
+                  file=sys.stderr)
+            continue
+        total_size -= image.attrs['Size']
+        print(f'Removed least recently used base-Gramine Docker image `{", ".join(image.tags)}`.')
 
-    if os_release['NAME'] == 'CentOS Stream':
-        distro = f'quay.io/centos/centos:stream{version[0]}'
 
-    return distro
+def create_jinja_env(config):
+    # Jinja environment with the templates of GSC and the config file as globals; callers which
+    # run several commands in one process (e.g. `gsc pipeline`) share it between the commands, so
+    # that templates are loaded once and `Distro: auto` is resolved once (in the globals, while the
+    # config itself stays unchanged as it is an input of the build cache key)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader('templates/'))
+    env.filters['shlex_quote'] = shlex.quote
+    env.filters['assert_not_none'] = assert_not_none
+    env.tests['trueish'] = test_trueish
+    env.globals['get_ubi_version'] = get_ubi_version
+    env.globals['get_sles_version'] = get_sles_version
+    env.globals['template_path'] = template_path
+    env.globals.update(config)
+    env.globals['python_path'] = env.get_template('python.common.path.template').module.python_path
+    return env
 
-def fetch_and_validate_distro_support(docker_socket, image_name, env):
-    distro = env.globals['Distro']
+def resolve_distro(docker_socket, image_name, distro):
+    # returns the configured distro, or the detected one for `Distro: auto`
     if distro == 'auto':
-        distro = get_image_distro(docker_socket, image_name)
-        env.globals['Distro'] = distro
+        with trace_span('distro detection', 'gsc', image=image_name) as span_args:
+            distro = get_image_distro(docker_socket, image_name)
+            span_args['distro'] = distro
+    return distro
 
+def validate_distro_support(distro):
     distro = distro.split(':')[0]
 
     if not os.path.exists(f'templates/{template_path(distro)}'):
@@ -328,70 +1740,160 @@ def fetch_and_validate_distro_support(docker_socket, image_name, env):
 
     return distro
 
+def fetch_and_validate_distro_support(docker_socket, image_name, env):
+    distro = resolve_distro(docker_socket, image_name, env.globals['Distro'])
+    env.globals['Distro'] = distro
+    return validate_distro_support(distro)
+
 # Command 1: Build unsigned graminized Docker image from original app Docker image.
-def gsc_build(args):
+# `docker_socket`, `config` (the parsed config file), `env` (see `create_jinja_env()`) and
+# `original_image` may be passed by callers which run several commands in one process (e.g.
+# `gsc build-many`).
+@traced_command('build')
+def gsc_build(args, docker_socket=None, config=None, env=None, original_image=None):
     original_image_name = args.image                           # input original-app image name
     unsigned_image_name = gsc_unsigned_image_name(args.image)  # output unsigned image name
     signed_image_name = gsc_image_name(args.image)             # final signed image name (to check)
     tmp_build_path = gsc_tmp_build_path(args.image)            # pathlib obj with build artifacts
 
-    docker_socket = docker.from_env()
+    if docker_socket is None:
+        docker_socket = docker.from_env()
 
-    if get_docker_image(docker_socket, signed_image_name) is not None:
-        print(f'Final graminized image `{signed_image_name}` already exists.')
-        sys.exit(0)
-
-    original_image = get_docker_image(docker_socket, original_image_name)
+    if original_image is None:
+        original_image = get_docker_image(docker_socket, original_image_name)
     if original_image is None:
         print(f'Cannot find original application Docker image `{original_image_name}`.')
         sys.exit(1)
 
-    config = yaml.safe_load(args.config_file)
+    if config is None:
+        config = yaml.safe_load(args.config_file)
     gramine_config = config.get('Gramine')
     if not gramine_config:
         sys.exit('Missing `Gramine` section in the config file.')
 
+    gramine_image = None
     gramine_image_name = gramine_config.get('Image')
     if gramine_image_name:
-        if get_docker_image(docker_socket, gramine_image_name) is None:
+        gramine_image = get_docker_image(docker_socket, gramine_image_name)
+        if gramine_image is None:
             sys.exit(f'Cannot find base-Gramine Docker image `{gramine_image_name}`.')
     else:
         if 'Repository' not in gramine_config:
             sys.exit('`Gramine.Repository` is missing. Provide this or `Gramine.Image`.')
         if 'Branch' not in gramine_config:
             sys.exit('`Gramine.Branch` is missing.')
+        image_cache_size = gramine_config.get('ImageCacheSize')
+        if image_cache_size is not None and (not isinstance(image_cache_size, (int, float))
+                                             or image_cache_size < 0):
+            sys.exit('`Gramine.ImageCacheSize` must be a non-negative number (of GiB).')
+
+    trusted_files_config = config.get('TrustedFiles') or {}
+    for key in ('Exclude', 'Include', 'DataPaths'):
+        rules = trusted_files_config.get(key) or []
+        if not isinstance(rules, list) or not all(isinstance(rule, str) and rule.startswith('/')
+                                                  for rule in rules):
+            sys.exit(f'`TrustedFiles.{key}` must be a list of absolute paths.')
+
+    if args.access_trace and not os.path.isfile(args.access_trace):
+        sys.exit(f'Cannot find access trace `{args.access_trace}`.')
+
+    if args.host_finalize and (args.elf_closure or args.access_trace or args.reuse_hashes):
+        sys.exit('`--host-finalize` cannot be combined with `--elf-closure`, `--access-trace` or '
+                 '`--reuse-hashes`.')
+
+    user_manifest_name = args.manifest
+    if not os.path.exists(user_manifest_name):
+        print(f'Manifest file "{user_manifest_name}" does not exist.', file=sys.stderr)
+        sys.exit(1)
+    with open(user_manifest_name, 'r') as user_manifest_file:
+        user_manifest_contents = user_manifest_file.read()
+
+    # skip the build if the existing image was built from exactly the same inputs; unless a
+    # prebuilt base-Gramine image is used, Gramine is pinned to the commit of the branch (only if
+    # the commit cannot be resolved, e.g. offline, the branch in the config is the input)
+    gramine_commit = None
+    if not gramine_image_name:
+        gramine_commit = resolve_gramine_commit(gramine_config)
+    with trace_span('build cache key', 'gsc'):
+        build_cache_key = compute_build_cache_key(original_image, gramine_image, gramine_commit,
+                                                  config, user_manifest_contents, args)
+    signed_image = get_docker_image(docker_socket, signed_image_name)
+    unsigned_image = get_docker_image(docker_socket, unsigned_image_name)
+    if not args.no_cache:
+        if get_image_label(signed_image, BUILD_CACHE_LABEL) == build_cache_key:
+            print(f'Final graminized image `{signed_image_name}` already exists and is up to '
+                  f'date.')
+            sys.exit(0)
+        if get_image_label(unsigned_image, BUILD_CACHE_LABEL) == build_cache_key:
+            print(f'Unsigned graminized image `{unsigned_image_name}` already exists and is up '
+                  f'to date.')
+            sys.exit(0)
+    if signed_image is not None:
+        print(f'Final graminized image `{signed_image_name}` is out of date, it must be signed '
+              f'again after this build.')
 
     print(f'Building unsigned graminized Docker image `{unsigned_image_name}` from original '
           f'application image `{original_image_name}`...')
 
     # initialize Jinja env with configurations extracted from the original Docker image
-    env = jinja2.Environment()
-    env.filters['shlex_quote'] = shlex.quote
-    env.filters['assert_not_none'] = assert_not_none
-    env.globals['get_ubi_version'] = get_ubi_version
-    env.globals['get_sles_version'] = get_sles_version
-    env.globals['template_path'] = template_path
-    env.globals.update(config)
+    if env is None:
+        env = create_jinja_env(config)
     env.globals.update(vars(args))
     env.globals.update({'app_image': original_image_name})
+    env.globals['finalize_manifest_args'] = extract_finalize_manifest_args(args,
+                                                                           trusted_files_config)
     extract_user_from_image_config(original_image.attrs['Config'], env)
     extract_binary_info_from_image_config(original_image.attrs['Config'], env)
 
     os.makedirs(tmp_build_path, exist_ok=True)
 
+    # reuse the hash index of the previously built unsigned image (if any), so that finalizing the
+    # manifest re-hashes only files which changed since then
+    prev_hash_index_path = tmp_build_path / 'gsc_hash_index.prev.json'
+    if os.path.exists(prev_hash_index_path):
+        os.remove(prev_hash_index_path)
+    prev_hash_index = None
+    if args.reuse_hashes and unsigned_image is not None:
+        prev_hash_index = read_file_from_image(docker_socket, unsigned_image_name,
+                                               '/gramine/app_files/gsc_hash_index.json')
+    if prev_hash_index is not None:
+        with open(prev_hash_index_path, 'wb') as prev_hash_index_file:
+            prev_hash_index_file.write(prev_hash_index)
+        print(f'Reusing trusted-file hashes from previous image `{unsigned_image_name}`.')
+    env.globals.update({'prev_hash_index': prev_hash_index is not None})
+
+    # the access trace is consumed by finalize_manifest.py inside the Docker image
+    access_trace_path = tmp_build_path / 'access_trace.log'
+    if os.path.exists(access_trace_path):
+        os.remove(access_trace_path)
+    if args.access_trace:
+        shutil.copyfile(args.access_trace, access_trace_path)
+
     try:
         distro = fetch_and_validate_distro_support(docker_socket, original_image_name, env)
     except Exception as e:
         print(e, file=sys.stderr)
         sys.exit(1)
 
-    env.loader = jinja2.FileSystemLoader('templates/')
+    # use (or build) the cached base-Gramine image instead of compiling Gramine in this build
+    image_cache_size = gramine_image_cache_size(gramine_config)
+    if not gramine_image_name and image_cache_size:
+        with trace_span('base-Gramine image cache', 'gsc'):
+            gramine_image = get_cached_gramine_image(docker_socket, args, config,
+                                                     env.globals['Distro'], gramine_commit)
+            if gramine_image is not None:
+                evict_cached_gramine_images(docker_socket, gramine_image.tags, image_cache_size)
+        if gramine_image is not None:
+            gramine_image_name = gramine_image.tags[0]
+            env.globals['Gramine'] = {**gramine_config, 'Image': gramine_image_name}
+    if not gramine_image_name and gramine_commit is not None:
+        # compile the commit of the build cache key, even if the branch moves in the meantime
+        env.globals['Gramine'] = {**gramine_config, 'Branch': gramine_commit}
+
+    render_start = time.perf_counter()
     compile_template = env.get_template(f'{template_path(distro)}/Dockerfile.compile.template')
     env.globals.update({'compile_template': compile_template})
 
-    python_path = env.get_template('python.common.path.template')
-    env.globals.update({'python_path': python_path.module.python_path})
-
     # generate Dockerfile.build from Jinja-style templates/<distro>/Dockerfile.build.template
     # using the user-provided config file with info on OS distro, Gramine version and SGX driver
     # and other env configurations generated above
@@ -404,6 +1906,9 @@ def gsc_build(args):
     apploader_template = env.get_template(f'{template_path(distro)}/apploader.template')
     with open(tmp_build_path / 'apploader.sh', 'w') as apploader:
         apploader.write(apploader_template.render())
+    if args.host_finalize:
+        # `docker build` preserves the permissions of copied files, so no `RUN chmod` is needed
+        os.chmod(tmp_build_path / 'apploader.sh', 0o755)
 
     # generate entrypoint.manifest from three parts:
     #   - Jinja-style templates/entrypoint.manifest.template
@@ -423,29 +1928,27 @@ def gsc_build(args):
     base_image_env_dict = tomli.loads(base_image_environment)
     base_image_env_name = f'<{original_image_name} image env>'
 
-    user_manifest_name = args.manifest
-    user_manifest_contents = ''
-    if not os.path.exists(user_manifest_name):
-        print(f'Manifest file "{user_manifest_name}" does not exist.', file=sys.stderr)
+    try:
+        user_manifest_dict = tomli.loads(user_manifest_contents)
+    except Exception as e:
+        print(f'Failed to parse the "{user_manifest_name}" file. Error:', e, file=sys.stderr)
         sys.exit(1)
 
-    with open(user_manifest_name, 'r') as user_manifest_file:
-        user_manifest_contents = user_manifest_file.read()
-
-        try:
-            user_manifest_dict = tomli.loads(user_manifest_contents)
-        except Exception as e:
-            print(f'Failed to parse the "{user_manifest_name}" file. Error:', e, file=sys.stderr)
-            sys.exit(1)
-
+    provenance = {}
     merged_manifest_dict = merge_manifests_in_order(user_manifest_dict, entrypoint_manifest_dict,
-                                                    user_manifest_name, entrypoint_manifest_name)
+                                                    user_manifest_name, entrypoint_manifest_name,
+                                                    provenance=provenance)
     merged_manifest_name = (f'<merged {user_manifest_name} and {entrypoint_manifest_name}>')
     merged_manifest_dict = merge_manifests_in_order(merged_manifest_dict, base_image_env_dict,
-                                                    merged_manifest_name, base_image_env_name)
+                                                    merged_manifest_name, base_image_env_name,
+                                                    provenance=provenance)
 
     with open(tmp_build_path / 'entrypoint.manifest', 'wb') as entrypoint_manifest:
         tomli_w.dump(merged_manifest_dict, entrypoint_manifest)
+    # which manifest each file and mount comes from, for diagnostics only
+    with open(tmp_build_path / 'manifest_provenance.json', 'w') as provenance_file:
+        json.dump(provenance, provenance_file, indent=4)
+    add_trace_span('render templates', 'gsc', render_start, time.perf_counter())
 
     # copy helper script to finalize the manifest from within graminized Docker image
     shutil.copyfile('finalize_manifest.py', tmp_build_path / 'finalize_manifest.py')
@@ -457,26 +1960,75 @@ def gsc_build(args):
     handle_redhat_repo_configs(distro, tmp_build_path)
     handle_suse_repo_configs(distro, tmp_build_path)
 
-    build_docker_image(docker_socket.api, tmp_build_path, unsigned_image_name, 'Dockerfile.build',
-                       rm=args.rm, nocache=args.no_cache, buildargs=extract_build_args(args))
+    # with `--compile-cache`, Gramine is compiled from the sources in the local mirror
+    compile_cache = args.compile_cache and not gramine_image_name
+    if compile_cache:
+        ccache_path = prepare_gramine_compile_cache(gramine_config, env.globals['Distro'],
+                                                    tmp_build_path)
+    else:
+        remove_gramine_compile_cache_files(tmp_build_path)
+
+    finalize_report_path = tmp_build_path / 'finalize_report.json'
+    if os.path.exists(finalize_report_path):
+        os.remove(finalize_report_path)
+
+    # with `--host-finalize`, the image is finalized after the build (and tagged only then)
+    build_image_name = unsigned_image_name
+    if args.host_finalize:
+        build_image_name = f'{unsigned_image_name}-prefinalize'
+
+    finalize_reports = build_docker_image(docker_socket.api, tmp_build_path, build_image_name,
+                                          'Dockerfile.build',
+                                          capture_prefix=finalize_manifest.REPORT_LINE_PREFIX,
+                                          rm=args.rm, nocache=args.no_cache,
+                                          buildargs=extract_build_args(args),
+                                          labels={BUILD_CACHE_LABEL: build_cache_key})
 
     # Check if docker build failed
-    if get_docker_image(docker_socket, unsigned_image_name) is None:
+    if get_docker_image(docker_socket, build_image_name) is None:
         print(f'Failed to build unsigned graminized Docker image `{unsigned_image_name}`.')
         sys.exit(1)
 
+    if compile_cache:
+        update_gramine_compile_cache(docker_socket, tmp_build_path, 'Dockerfile.build',
+                                     ccache_path, extract_build_args(args))
+
+    if args.host_finalize:
+        with trace_span('finalize manifest on host', 'gsc'):
+            sign_template = env.get_template(f'{template_path(distro)}/Dockerfile.sign.template')
+            finalize_manifest_on_host(docker_socket, build_image_name, unsigned_image_name,
+                                      tmp_build_path, env.globals['app_user'],
+                                      sign_template.render(path_only=True).strip(), args,
+                                      trusted_files_config)
+        # only remove the tag, the finalized image is based on this image
+        docker_socket.images.remove(build_image_name, noprune=True)
+        if get_docker_image(docker_socket, unsigned_image_name) is None:
+            print(f'Failed to finalize unsigned graminized Docker image `{unsigned_image_name}`.')
+            sys.exit(1)
+    elif finalize_reports:
+        # the report of finalizing the manifest (to analyze slow builds) is not written if Docker
+        # reused the cached layer of the finalize step
+        finalize_report = json.loads(finalize_reports[-1])
+        with open(finalize_report_path, 'w') as finalize_report_file:
+            json.dump(finalize_report, finalize_report_file, indent=4)
+            finalize_report_file.write('\n')
+        print(f'Wrote the report of finalizing the manifest to `{finalize_report_path}`.')
+
     print(f'Successfully built an unsigned graminized Docker image `{unsigned_image_name}` from '
           f'original application image `{original_image_name}`.')
 
 
 # Command 2: Build a "base Gramine" Docker image with the compiled runtime of Gramine.
-def gsc_build_gramine(args):
+@traced_command('build-gramine')
+def gsc_build_gramine(args, docker_socket=None, config=None, labels=None):
     gramine_image_name = args.image  # output base-Gramine image name
     tmp_build_path = gsc_tmp_build_path(args.image)  # pathlib obj with build artifacts
 
-    docker_socket = docker.from_env()
+    if docker_socket is None:
+        docker_socket = docker.from_env()
 
-    config = yaml.safe_load(args.config_file)
+    if config is None:
+        config = yaml.safe_load(args.config_file)
     gramine_config = config.get('Gramine')
     if not gramine_config:
         sys.exit('Missing `Gramine` section in the config file.')
@@ -489,19 +2041,14 @@ def gsc_build_gramine(args):
     if 'Branch' not in gramine_config:
         sys.exit('`Gramine.Branch` is required for `gsc build-gramine` but is missing.')
 
-    if get_docker_image(docker_socket, gramine_image_name) is not None:
+    if get_docker_image(docker_socket, gramine_image_name) is not None and not args.no_cache:
         print(f'Base-Gramine Docker image `{gramine_image_name}` already exists.')
         sys.exit(0)
 
     print(f'Building base-Gramine Docker image `{gramine_image_name}`...')
 
     # initialize Jinja env with user-provided configurations
-    env = jinja2.Environment()
-    env.filters['assert_not_none'] = assert_not_none
-    env.globals['get_ubi_version'] = get_ubi_version
-    env.globals['get_sles_version'] = get_sles_version
-    env.globals['template_path'] = template_path
-    env.globals.update(config)
+    env = create_jinja_env(config)
     env.globals.update(vars(args))
 
     os.makedirs(tmp_build_path, exist_ok=True)
@@ -512,13 +2059,12 @@ def gsc_build_gramine(args):
               'file.')
         sys.exit(1)
 
+    full_distro = distro
     distro, _ = distro.split(':')
     if not os.path.exists(f'templates/{template_path(distro)}'):
         print(f'{distro} distro is not supported by GSC.')
         sys.exit(1)
 
-    env.loader = jinja2.FileSystemLoader('templates/')
-
     # generate Dockerfile.compile from Jinja-style templates/<distro>/Dockerfile.compile.template
     # using the user-provided config file with info on OS distro, Gramine version and SGX driver
     # and other user-provided args (see argparser::gsc_build_gramine below)
@@ -535,27 +2081,141 @@ def gsc_build_gramine(args):
     # Available at https://download.01.org/intel-sgx/sgx_repo/ubuntu/intel-sgx-deb.key
     shutil.copyfile('keys/intel-sgx-deb.key', tmp_build_path / 'intel-sgx-deb.key')
 
+    # copy helper script to create the hash index of the Gramine installation
+    shutil.copyfile('finalize_manifest.py', tmp_build_path / 'finalize_manifest.py')
+
     handle_redhat_repo_configs(distro, tmp_build_path)
     handle_suse_repo_configs(distro, tmp_build_path)
 
+    if args.compile_cache:
+        ccache_path = prepare_gramine_compile_cache(gramine_config, full_distro, tmp_build_path)
+    else:
+        remove_gramine_compile_cache_files(tmp_build_path)
+
     build_docker_image(docker_socket.api, tmp_build_path, gramine_image_name, 'Dockerfile.compile',
-                       rm=args.rm, nocache=args.no_cache, buildargs=extract_build_args(args))
+                       rm=args.rm, nocache=args.no_cache, buildargs=extract_build_args(args),
+                       labels=labels)
 
     # Check if docker build failed
     if get_docker_image(docker_socket, gramine_image_name) is None:
         print(f'Failed to build a base-Gramine Docker image `{gramine_image_name}`.')
         sys.exit(1)
 
+    if args.compile_cache:
+        update_gramine_compile_cache(docker_socket, tmp_build_path, 'Dockerfile.compile',
+                                     ccache_path, extract_build_args(args))
+
     print(f'Successfully built a base-Gramine Docker image `{gramine_image_name}`.')
 
 
+class SigningKey:
+    # The signing key of `gsc sign-image` and `gsc sign-many`, read once for all images signed
+    # with it and kept only in memory; `passphrase` decrypts an encrypted key
+    def __init__(self, path, passphrase=None):
+        try:
+            with open(path, 'rb') as key_file:
+                self.contents = key_file.read()
+        except OSError as e:
+            sys.exit(f'Cannot read signing key `{path}`: {e}')
+        self.encrypted = b'ENCRYPTED' in self.contents
+        self.digest = hashlib.sha256(self.contents).digest()
+        self.passphrase = passphrase
+
+
+class SignContext:
+    # Inputs shared by all images signed in one run (e.g. of `gsc sign-many`): the Jinja environment
+    # with the loaded templates, the signing key and, when signing without `--thin-layer`, one build
+    # context with a copy of the key, to which the Dockerfile of each image is added. The values
+    # which differ per image are passed to the templates when rendering (instead of being stored in
+    # the globals of `env`), so that images can be signed concurrently.
+    def __init__(self, env, signing_key, thin_layer):
+        self.env = env
+        self.signing_key = signing_key
+        self.build_context = None
+        if not thin_layer:
+            self.build_context = tempfile.mkdtemp(prefix='gsc-sign-')
+            key_path = os.path.join(self.build_context, 'gsc-signer-key.pem')
+            with open(os.open(key_path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as key_file:
+                key_file.write(signing_key.contents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.build_context is not None:
+            shutil.rmtree(self.build_context)
+
+
+# Runs `gramine-sgx-sign` with the arguments of the script and the signing key on its standard
+# input, preceded by a line with the passphrase (possibly empty). The key is written only to the
+# tmpfs /gsc-sign and the passphrase is passed to the signer within this process, so neither of
+# them is stored on any disk or appears in the command line of any process.
+SIGNER_SCRIPT = """\
+import os, runpy, shutil, sys
+passphrase, _, key = sys.stdin.buffer.read().partition(b'\\n')
+with open(os.open('/gsc-sign/key.pem', os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as key_file:
+    key_file.write(key)
+sys.argv = ['gramine-sgx-sign', '--key', '/gsc-sign/key.pem'] + sys.argv[1:]
+if passphrase:
+    sys.argv += ['--passphrase', passphrase.decode()]
+runpy.run_path(shutil.which('gramine-sgx-sign'), run_name='__main__')
+"""
+
+# Sign the enclave in a temporary container of the unsigned image and add only the signer outputs
+# as a new layer, instead of building a full intermediate stage from the unsigned image.
+def sign_image_thin_layer(docker_socket, path_command, unsigned_image_name, signed_image_name,
+                          tmp_build_path, labels, signing_key):
+    sign_command = (f'{path_command + " && " if path_command else ""}mkdir /gsc-sign-output '
+                    '&& exec python3 -c "$1" --manifest /gramine/app_files/entrypoint.manifest '
+                    '--output /gsc-sign-output/entrypoint.manifest.sgx')
+    with trace_span('gramine-sgx-sign', 'gsc', image=unsigned_image_name):
+        # the signer runs as root, as the passphrase and the key are passed on its standard input
+        status, output, archive = run_in_container(docker_socket, unsigned_image_name,
+            [sign_command, 'sh', SIGNER_SCRIPT],
+            stdin=(signing_key.passphrase or '').encode() + b'\n' + signing_key.contents,
+            tmpfs={'/gsc-sign': 'mode=0700'}, output_path='/gsc-sign-output')
+    print(output.decode('UTF-8', errors='replace'), end='')
+    if status != 0:
+        sys.exit(f'Failed to sign graminized Docker image `{unsigned_image_name}`.')
+
+    # the signer outputs are the (key-free) build context of the signed image
+    with tempfile.TemporaryDirectory() as sign_output_path:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as output_tar:
+            for name in ('entrypoint.sig', 'entrypoint.manifest.sgx'):
+                with open(os.path.join(sign_output_path, name), 'wb') as output_file:
+                    output_file.write(output_tar.extractfile(f'gsc-sign-output/{name}').read())
+        shutil.copyfile(tmp_build_path / 'Dockerfile.sign',
+                        os.path.join(sign_output_path, 'Dockerfile.sign'))
+        build_docker_image(docker_socket.api, sign_output_path, signed_image_name,
+                           'Dockerfile.sign', rm=True, labels=labels)
+
+    if get_docker_image(docker_socket, signed_image_name) is None:
+        print(f'Failed to build a signed graminized Docker image `{signed_image_name}`.')
+        sys.exit(1)
+
+
 # Command 3: Sign Docker image which was previously built via `gsc build`.
-def gsc_sign_image(args):
+# `sign_context` (see `SignContext`) may be passed by callers which sign several images.
+@traced_command('sign-image')
+def gsc_sign_image(args, docker_socket=None, config=None, env=None, sign_context=None):
+    if docker_socket is None:
+        docker_socket = docker.from_env()
+    if config is None:
+        config = yaml.safe_load(args.config_file)
+
+    if sign_context is None:
+        with SignContext(env or create_jinja_env(config), SigningKey(args.key, args.passphrase),
+                         args.thin_layer) as sign_context:
+            return sign_image(args, docker_socket, sign_context)
+    return sign_image(args, docker_socket, sign_context)
+
+
+def sign_image(args, docker_socket, sign_context):
     unsigned_image_name = gsc_unsigned_image_name(args.image)  # input image name
     signed_image_name = gsc_image_name(args.image)             # output image name
     tmp_build_path = gsc_tmp_build_path(args.image)            # pathlib obj with build artifacts
-
-    docker_socket = docker.from_env()
+    env = sign_context.env
+    signing_key = sign_context.signing_key
 
     unsigned_image = get_docker_image(docker_socket, unsigned_image_name)
     if unsigned_image is None:
@@ -567,48 +2227,72 @@ def gsc_sign_image(args):
 
     # generate Dockerfile.sign from Jinja-style templates/<distro>/Dockerfile.sign.template
     # using the user-provided config file with info on OS distro, Gramine version and SGX driver
-    env = jinja2.Environment()
-    env.globals.update(yaml.safe_load(args.config_file))
-    extract_user_from_image_config(unsigned_image.attrs['Config'], env)
-    env.globals['args'] = extract_define_args(args)
-    env.tests['trueish'] = test_trueish
-
     try:
-        distro = fetch_and_validate_distro_support(docker_socket, args.image, env)
+        full_distro = resolve_distro(docker_socket, args.image, env.globals['Distro'])
+        distro = validate_distro_support(full_distro)
     except Exception as e:
         print(e, file=sys.stderr)
         sys.exit(1)
 
-    env.loader = jinja2.FileSystemLoader('templates/')
-
+    template_vars = {
+        'Distro': full_distro,
+        'app_user': unsigned_image.attrs['Config'].get('User') or 'root',
+        'args': extract_define_args(args),
+    }
     sign_template = env.get_template(f'{template_path(distro)}/Dockerfile.sign.template')
-    python_path = env.get_template('python.common.path.template')
-    env.globals.update({'python_path': python_path.module.python_path})
     os.makedirs(tmp_build_path, exist_ok=True)
     with open(tmp_build_path / 'Dockerfile.sign', 'w') as dockerfile:
-        dockerfile.write(sign_template.render(image=unsigned_image_name))
-
-    # copy user-provided signing key to our tmp build dir (to copy it later inside Docker image)
-    tmp_build_key_path = tmp_build_path / 'gsc-signer-key.pem'
-    shutil.copyfile(os.path.abspath(args.key), tmp_build_key_path)
+        dockerfile.write(sign_template.render(image=unsigned_image_name,
+                                              thin_layer=args.thin_layer, **template_vars))
+
+    # skip signing if the existing signed image was signed from exactly the same inputs
+    sign_cache_key = compute_sign_cache_key(unsigned_image, tmp_build_path / 'Dockerfile.sign',
+                                            signing_key, args)
+    signed_image = get_docker_image(docker_socket, signed_image_name)
+    if (not getattr(args, 'no_cache', False)
+            and get_image_label(signed_image, SIGN_CACHE_LABEL) == sign_cache_key):
+        print(f'Signed graminized image `{signed_image_name}` already exists and is up to date.')
+        return
+    labels = {SIGN_CACHE_LABEL: sign_cache_key}
+
+    if args.thin_layer:
+        sign_image_thin_layer(docker_socket,
+                              sign_template.render(path_only=True, **template_vars).strip(),
+                              unsigned_image_name, signed_image_name, tmp_build_path, labels,
+                              signing_key)
+        if args.squash:
+            with trace_span('squash layers', 'docker'):
+                squash_gsc_layers(docker_socket, args.image, signed_image_name)
+        print(f'Successfully built a signed Docker image `{signed_image_name}` from '
+              f'`{unsigned_image_name}`.')
+        return
 
+    # the shared build context contains the signing key (to copy it later inside Docker image)
     build_id = uuid.uuid4().hex
+    dockerfile_name = f'Dockerfile.sign-{build_id}'
+    shutil.copyfile(tmp_build_path / 'Dockerfile.sign',
+                    os.path.join(sign_context.build_context, dockerfile_name))
     try:
         # `forcerm` parameter forces removal of intermediate Docker images even after unsuccessful
         # builds, to not leave the signing key lingering in any Docker containers
-        build_docker_image(docker_socket.api, tmp_build_path, signed_image_name, 'Dockerfile.sign',
-                           forcerm=True, buildargs={'passphrase': args.passphrase,
-                           'BUILD_ID': build_id})
+        build_docker_image(docker_socket.api, sign_context.build_context, signed_image_name,
+                           dockerfile_name, forcerm=True, labels=labels,
+                           buildargs={'passphrase': signing_key.passphrase, 'BUILD_ID': build_id})
     finally:
-        os.remove(tmp_build_key_path)
+        os.remove(os.path.join(sign_context.build_context, dockerfile_name))
         # Remove a temporary image created during multistage docker build to save disk space.
         # Please note that removing the image doesn't assure security.
-        docker_socket.api.prune_images(filters={'label': 'build_id=' + build_id})
+        with trace_span('prune images', 'docker'):
+            docker_socket.api.prune_images(filters={'label': 'build_id=' + build_id})
 
     if get_docker_image(docker_socket, signed_image_name) is None:
         print(f'Failed to build a signed graminized Docker image `{signed_image_name}`.')
         sys.exit(1)
 
+    if args.squash:
+        with trace_span('squash layers', 'docker'):
+            squash_gsc_layers(docker_socket, args.image, signed_image_name)
+
     print(f'Successfully built a signed Docker image `{signed_image_name}` from '
           f'`{unsigned_image_name}`.')
 
@@ -649,73 +2333,485 @@ def read_sigstruct(sig):
 
     return attr
 
-# Retrieve information about a previously built graminized Docker image
-def gsc_info_image(args):
+def sigstruct_info(sig):
+    attr = read_sigstruct(sig)
+    # calculate MRSIGNER as sha256 hash over RSA public key's modulus
+    mrsigner = hashlib.sha256()
+    mrsigner.update(attr['modulus'])
+    sigstruct = {}
+    sigstruct['mr_enclave'] = attr['enclave_hash'].hex()
+    sigstruct['mr_signer'] = mrsigner.digest().hex()
+    sigstruct['isv_prod_id'] = attr['isv_prod_id']
+    sigstruct['isv_svn'] = attr['isv_svn']
+    sigstruct['date'] = '%d-%02d-%02d' % (
+        attr['date_year'], attr['date_month'], attr['date_day'])
+    sigstruct['flags'] = attr['flags'].hex()
+    sigstruct['xfrms'] = attr['xfrms'].hex()
+    sigstruct['misc_select'] = attr['misc_select'].hex()
+    # DEBUG attribute of the enclave is very important, so we print it also separately
+    sigstruct['debug'] = bool(attr['flags'][0] & 0b10)
+    return sigstruct
+
+
+# Returns the Intel SGX-related information from the SIGSTRUCT of a graminized image (or None); the
+# SIGSTRUCT is read from the file system of the image without running a container
+def read_image_sigstruct(docker_socket, image_name):
+    image_id = docker_socket.images.get(image_name).id
+    sigstruct = lookup_image_cache(SIGSTRUCT_CACHE_PATH, image_id)
+    if sigstruct is None:
+        sig = read_file_from_image(docker_socket, image_id, '/gramine/app_files/entrypoint.sig')
+        if sig is None:
+            return None
+        sigstruct = sigstruct_info(sig)
+        store_image_cache(SIGSTRUCT_CACHE_PATH, image_id, sigstruct)
+    return sigstruct
+
+
+# Retrieve information about previously built graminized Docker images
+@traced_command('info', trace_path=lambda args: pathlib.Path('build'),
+                span_args=lambda args: {'images': args.images})
+def gsc_info_image(args, docker_socket=None):
+    if args.jobs < 1:
+        sys.exit(f'Invalid number of concurrent jobs `{args.jobs}`.')
+    if docker_socket is None:
+        docker_socket = docker.from_env(max_pool_size=max(10, args.jobs))
+
+    def info(image_name):
+        if get_docker_image(docker_socket, image_name) is None:
+            return None, (f'Could not find graminized Docker image {image_name}.\n'
+                          'Please make sure to build the graminized image first by using '
+                          '\'gsc build\' command.')
+        try:
+            sigstruct = read_image_sigstruct(docker_socket, image_name)
+        except Exception as e: # pylint: disable=broad-except
+            return None, f'Failed to read SIGSTRUCT of image {image_name}: {e}'
+        if not sigstruct:
+            return None, f'Could not extract Intel SGX-related information from image {image_name}.'
+        return sigstruct, None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(zip(args.images, executor.map(traced_in_thread(info), args.images)))
+
+    failed = False
+    if args.format == 'json':
+        print(json.dumps({image_name: sigstruct if sigstruct else {'error': error}
+                          for image_name, (sigstruct, error) in results}, indent=4))
+        failed = any(sigstruct is None for _, (sigstruct, _) in results)
+    elif args.format == 'jsonl':
+        for image_name, (sigstruct, error) in results:
+            print(json.dumps({'image': image_name, **(sigstruct or {'error': error})}))
+            failed = failed or sigstruct is None
+    else:
+        for image_name, (sigstruct, error) in results:
+            if sigstruct is None:
+                print(error)
+                failed = True
+            elif len(results) == 1:
+                print(tomli_w.dumps(sigstruct))
+            else:
+                print(tomli_w.dumps({image_name: sigstruct}))
+    if failed:
+        sys.exit(1)
+
+
+# Build, sign and retrieve information about a graminized image in one process, sharing the parsed
+# config file, the detected distro and the Docker connection between the stages.
+@traced_command('pipeline')
+def gsc_pipeline(args):
+    config = yaml.safe_load(args.config_file)
     docker_socket = docker.from_env()
-    gsc_image = get_docker_image(docker_socket, args.image)
-    if gsc_image is None:
-        print(f'Could not find graminized Docker image {args.image}.\n'
-              'Please make sure to build the graminized image first by using \'gsc build\''
-              ' command.')
+
+    original_image = get_docker_image(docker_socket, args.image)
+    if original_image is None:
+        print(f'Cannot find original application Docker image `{args.image}`.')
         sys.exit(1)
 
-    # Create temporary directory on the host for sigstruct file
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        # Grant owner, group and everyone else read-write-execute permissions on temporary dir, so
-        # that even non-root users in Docker images can copy `entrypoint.sig` into it
-        os.chmod(tmpdirname,0o777)
-        # Copy sigstruct file from Docker container into temporary directory on the host
-        docker_socket.containers.run(args.image,
-            '\'cp /gramine/app_files/entrypoint.sig /tmp/host/ 2>/dev/null || :\'',
-            entrypoint=['sh', '-c'], remove=True,
-            volumes={tmpdirname: {'bind': '/tmp/host', 'mode': 'rw'}})
-        sigstruct = {}
-        with open(os.path.join(tmpdirname, "entrypoint.sig"), 'rb') as sig:
-            attr = read_sigstruct(sig.read())
-            # calculate MRSIGNER as sha256 hash over RSA public key's modulus
-            mrsigner = hashlib.sha256()
-            mrsigner.update(attr['modulus'])
-            sigstruct['mr_enclave'] = attr['enclave_hash'].hex()
-            sigstruct['mr_signer'] = mrsigner.digest().hex()
-            sigstruct['isv_prod_id'] = attr['isv_prod_id']
-            sigstruct['isv_svn'] = attr['isv_svn']
-            sigstruct['date'] = '%d-%02d-%02d' % (
-                attr['date_year'], attr['date_month'], attr['date_day'])
-            sigstruct['flags'] = attr['flags'].hex()
-            sigstruct['xfrms'] = attr['xfrms'].hex()
-            sigstruct['misc_select'] = attr['misc_select'].hex()
-            # DEBUG attribute of the enclave is very important, so we print it also separately
-            sigstruct['debug'] = bool(attr['flags'][0] & 0b10)
+    # the distro of the original image is needed by both `gsc build` and `gsc sign-image`, so it is
+    # detected once and stored in the shared Jinja env (not in `config`, which must stay as in the
+    # config file for the build cache key to match that of `gsc build`)
+    env = create_jinja_env(config)
+    try:
+        fetch_and_validate_distro_support(docker_socket, args.image, env)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
 
-        if not sigstruct:
-            print(f'Could not extract Intel SGX-related information from image {args.image}.')
-            sys.exit(1)
+    info_args = argparse.Namespace(images=[gsc_image_name(args.image)], format='toml', jobs=1)
+    stages = (
+        ('build', lambda: gsc_build(args, docker_socket, config, env, original_image)),
+        ('sign', lambda: gsc_sign_image(args, docker_socket, config, env)),
+        ('info', lambda: gsc_info_image(info_args, docker_socket)),
+    )
+    stage_times = []
+    for stage_name, stage in stages:
+        start = time.perf_counter()
+        try:
+            with trace_span(f'stage {stage_name}', 'pipeline'):
+                stage()
+        except SystemExit as e:
+            # e.g. `gsc build` exits successfully if the image is up to date
+            if e.code not in (None, 0):
+                raise
+        stage_times.append((stage_name, time.perf_counter() - start))
+
+    print('Pipeline stage times: ' + ', '.join(f'{stage_name} {seconds:.1f}s'
+                                               for stage_name, seconds in stage_times)
+          + f' (total {sum(seconds for _, seconds in stage_times):.1f}s)')
+
+
+class ThreadLocalOutput:
+    # File-like object which forwards writes of each thread to the file set for this thread via
+    # `redirect()` (or to `default`); used to keep the output of concurrent jobs apart
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def redirect(self, output_file):
+        self.local.output_file = output_file
+
+    def _output(self):
+        return getattr(self.local, 'output_file', None) or self.default
+
+    def write(self, data):
+        return self._output().write(data)
+
+    def flush(self):
+        self._output().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+def run_job_with_output(outputs, log_path, function, *function_args):
+    # runs `function` with its output (`ThreadLocalOutput` objects) redirected to `log_path`;
+    # returns the exit status and the duration (`sys.exit()` calls of GSC commands become the exit
+    # status)
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        for output in outputs:
+            output.redirect(log_file)
+        try:
+            function(*function_args)
+            status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print(e.code, file=log_file)
+                status = 1
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc(file=log_file)
+            status = 1
+        finally:
+            for output in outputs:
+                output.redirect(None)
+    return status, time.perf_counter() - start
+
+
+def load_build_many_jobs(job_file):
+    # job file (YAML or JSON): `{'jobs': [{'image': ..., 'manifest': ..., 'args': [...]}, ...]}`,
+    # where `args` are additional `gsc build` options (e.g. `--insecure-args`, `--build-arg X=Y`)
+    jobs = (yaml.safe_load(job_file) or {}).get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        sys.exit('The job file must contain a non-empty list `jobs`.')
+    images = set()
+    for job in jobs:
+        if not isinstance(job, dict) or 'image' not in job or 'manifest' not in job:
+            sys.exit('Each job must specify `image` and `manifest`.')
+        if not isinstance(job.get('args', []), list):
+            sys.exit(f'`args` of job `{job["image"]}` must be a list of `gsc build` options.')
+        if job['image'] in images:
+            sys.exit(f'Image `{job["image"]}` is listed more than once in the job file.')
+        images.add(job['image'])
+    return jobs
+
+
+# Build several graminized Docker images concurrently, as described in a job file.
+@traced_command('build-many', trace_path=lambda args: pathlib.Path('build'),
+                span_args=lambda args: {'job_file': args.job_file.name})
+def gsc_build_many(args):
+    config = yaml.safe_load(args.config_file)
+    jobs = load_build_many_jobs(args.job_file)
+    if args.jobs < 1:
+        sys.exit(f'Invalid number of concurrent jobs `{args.jobs}`.')
+
+    # one Docker client (with a large enough connection pool) shared by all jobs
+    docker_socket = docker.from_env(max_pool_size=max(10, 2 * args.jobs))
+
+    job_args = []
+    for job in jobs:
+        try:
+            build_args = build_many_job_options.parse_args([*map(str, job.get('args', [])),
+                                                            str(job['image']),
+                                                            str(job['manifest'])])
+        except SystemExit:
+            sys.exit(f'Invalid `gsc build` options for job `{job["image"]}`.')
+        if build_args.config_file is not None:
+            build_args.config_file.close()
+            sys.exit(f'Job `{job["image"]}` must not set `-c`/`--config_file`, all jobs use the '
+                     f'configuration file of `gsc build-many`.')
+        job_args.append(build_args)
+
+    outputs = (ThreadLocalOutput(sys.stdout), ThreadLocalOutput(sys.stderr))
+    sys.stdout, sys.stderr = outputs
+    try:
+        return run_build_many(args, config, docker_socket, job_args, outputs)
+    finally:
+        sys.stdout, sys.stderr = (output.default for output in outputs)
 
-        print(tomli_w.dumps(sigstruct))
+
+def run_build_many(args, config, docker_socket, job_args, outputs):
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # Resolve `Distro: auto` once per image, and build each required base-Gramine image only
+        # once instead of compiling Gramine in every job
+        def detect_distro(image_name):
+            if config.get('Distro') != 'auto':
+                return config.get('Distro')
+            try:
+                return get_image_distro(docker_socket, image_name)
+            except Exception as e: # pylint: disable=broad-except
+                print(f'{image_name}: {e}', file=sys.stderr)
+                return None
+        distros = executor.map(traced_in_thread(detect_distro),
+                               [build_args.image for build_args in job_args])
+
+        job_configs = {}
+        base_image_jobs = {}
+        for build_args, distro in zip(job_args, distros):
+            if distro is None:
+                results[build_args.image] = ('failed (distro)', 0.0, None)
+                continue
+            if args.rm:
+                build_args.rm = True
+            if args.no_cache:
+                build_args.no_cache = True
+            job_config = copy.deepcopy(config)
+            job_config['Distro'] = distro
+            gramine_config = job_config.get('Gramine') or {}
+            if not gramine_config.get('Image') and 'Repository' in gramine_config:
+                # the first job of each distro and buildtype provides the build args (e.g. proxy
+                # settings) for the base-Gramine image
+                base_image_jobs.setdefault((distro, build_args.buildtype), build_args)
+            job_configs[build_args.image] = job_config
+
+        # the base-Gramine images are shared with `gsc build` (see `get_cached_gramine_image()`),
+        # so they are keyed by the Gramine commit and a moving branch is rebuilt; the branch is
+        # resolved once, so that all base-Gramine images have the same commit
+        gramine_commit = None
+        if base_image_jobs:
+            gramine_commit = resolve_gramine_commit(config['Gramine'])
+        def get_base_image(base_image_key, build_args, base_images):
+            if gramine_commit is None:
+                sys.exit(1)
+            with trace_span('base-Gramine image', 'gsc', distro=base_image_key[0],
+                            buildtype=base_image_key[1]):
+                image = get_cached_gramine_image(docker_socket, build_args, config,
+                                                 base_image_key[0], gramine_commit)
+            if image is None:
+                sys.exit(1)
+            base_images[base_image_key] = image.tags[0]
+
+        base_images = {}
+        base_image_futures = {}
+        for base_image_key, build_args in base_image_jobs.items():
+            log_name = f'base-gramine-{base_image_key[0]}-{base_image_key[1]}'
+            log_path = gsc_tmp_build_path(re.sub(r'[^a-z0-9_.-]', '-', log_name.lower()))
+            os.makedirs(log_path, exist_ok=True)
+            print(f'Preparing base-Gramine Docker image for {base_image_key[0]} '
+                  f'({base_image_key[1]})...')
+            base_image_futures[base_image_key] = (log_path / 'build-many.log', executor.submit(
+                traced_in_thread(run_job_with_output), outputs, log_path / 'build-many.log',
+                get_base_image, base_image_key, build_args, base_images))
+        for base_image_key, (log_path, future) in base_image_futures.items():
+            status, seconds = future.result()
+            name = base_images.get(base_image_key, f'<base-Gramine {" ".join(base_image_key)}>')
+            results[name] = ('ok' if status == 0 else 'failed', seconds, log_path)
+
+        job_futures = {}
+        for build_args in job_args:
+            job_config = job_configs.get(build_args.image)
+            if job_config is None:
+                continue
+            gramine_config = job_config.get('Gramine') or {}
+            base_image_key = (job_config['Distro'], build_args.buildtype)
+            if base_image_key in base_image_futures:
+                if base_image_key not in base_images:
+                    results[build_args.image] = ('failed (base-Gramine)', 0.0, None)
+                    continue
+                gramine_config['Image'] = base_images[base_image_key]
+            log_path = gsc_tmp_build_path(build_args.image)
+            os.makedirs(log_path, exist_ok=True)
+            print(f'Building unsigned graminized Docker image for `{build_args.image}`...')
+            job_futures[executor.submit(
+                traced_in_thread(run_job_with_output), outputs, log_path / 'build-many.log',
+                gsc_build, build_args, docker_socket, job_config)] = build_args.image
+        for future in concurrent.futures.as_completed(job_futures):
+            image = job_futures[future]
+            status, seconds = future.result()
+            results[image] = ('ok' if status == 0 else 'failed', seconds,
+                              gsc_tmp_build_path(image) / 'build-many.log')
+            print(f'Finished `{image}` ({results[image][0]}, {seconds:.1f} s).')
+
+    # evict only after all jobs, as any job may still use any of the base-Gramine images
+    image_cache_size = gramine_image_cache_size(config.get('Gramine') or {})
+    if base_images and image_cache_size:
+        evict_cached_gramine_images(docker_socket, base_images.values(), image_cache_size)
+
+    print()
+    print(f'{"image":<50} {"status":<22} {"seconds":>9}  log')
+    for name, (status, seconds, log_path) in results.items():
+        print(f'{name:<50} {status:<22} {seconds:>9.1f}  {log_path or "-"}')
+
+    num_failed = sum(1 for status, _, _ in results.values() if status != 'ok')
+    if num_failed:
+        print(f'{num_failed} of {len(results)} builds failed.')
+        return 1
+    print(f'All {len(results)} builds succeeded.')
+    return 0
+
+
+# Sign several graminized Docker images with the same key concurrently.
+@traced_command('sign-many', trace_path=lambda args: pathlib.Path('build'),
+                span_args=lambda args: {'images': args.images})
+def gsc_sign_many(args):
+    config = yaml.safe_load(args.config_file)
+    if args.jobs < 1:
+        sys.exit(f'Invalid number of concurrent jobs `{args.jobs}`.')
+    if len(set(args.images)) != len(args.images):
+        sys.exit('Each image may be listed only once.')
+
+    # the key is read (and its passphrase asked for) once for all images
+    signing_key = SigningKey(args.key, args.passphrase)
+    if signing_key.encrypted and not args.thin_layer:
+        # otherwise, the passphrase would be a build arg of the intermediate image of every image
+        sys.exit('An encrypted signing key requires `--thin-layer` with `gsc sign-many`.')
+    if signing_key.encrypted and signing_key.passphrase is None:
+        signing_key.passphrase = getpass.getpass(f'Passphrase for `{args.key}`: ')
+
+    docker_socket = docker.from_env(max_pool_size=max(10, 2 * args.jobs))
+
+    outputs = (ThreadLocalOutput(sys.stdout), ThreadLocalOutput(sys.stderr))
+    sys.stdout, sys.stderr = outputs
+    try:
+        with SignContext(create_jinja_env(config), signing_key, args.thin_layer) as sign_context:
+            return run_sign_many(args, config, docker_socket, sign_context, outputs)
+    finally:
+        sys.stdout, sys.stderr = (output.default for output in outputs)
+
+
+def run_sign_many(args, config, docker_socket, sign_context, outputs):
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        job_futures = {}
+        for image in args.images:
+            sign_args = argparse.Namespace(**vars(args))
+            sign_args.image = image
+            log_path = gsc_tmp_build_path(image)
+            os.makedirs(log_path, exist_ok=True)
+            print(f'Signing graminized Docker image for `{image}`...')
+            job_futures[executor.submit(
+                traced_in_thread(run_job_with_output), outputs, log_path / 'sign-many.log',
+                gsc_sign_image, sign_args, docker_socket, config, None, sign_context)] = image
+        for future in concurrent.futures.as_completed(job_futures):
+            image = job_futures[future]
+            status, seconds = future.result()
+            results[image] = ('ok' if status == 0 else 'failed', seconds)
+            print(f'Finished `{image}` ({results[image][0]}, {seconds:.1f} s).')
+
+        def read_measurements(image):
+            try:
+                return read_image_sigstruct(docker_socket, gsc_image_name(image)) or {}
+            except Exception as e: # pylint: disable=broad-except
+                print(f'{image}: {e}', file=sys.stderr)
+                return {}
+        signed_images = [image for image in args.images if results[image][0] == 'ok']
+        sigstructs = dict(zip(signed_images, executor.map(traced_in_thread(read_measurements),
+                                                          signed_images)))
+
+    print()
+    print(f'{"image":<40} {"status":<7} {"seconds":>8}  {"mr_enclave":<64}  mr_signer')
+    for image in args.images:
+        status, seconds = results[image]
+        sigstruct = sigstructs.get(image, {})
+        print(f'{image:<40} {status:<7} {seconds:>8.1f}  {sigstruct.get("mr_enclave", "-"):<64}  '
+              f'{sigstruct.get("mr_signer", "-")}')
+
+    num_failed = sum(1 for status, _ in results.values() if status != 'ok')
+    if num_failed:
+        print(f'{num_failed} of {len(results)} images failed to sign, see '
+              f'build/gsc-<image>/sign-many.log.')
+        return 1
+    print(f'All {len(results)} images signed.')
+    return 0
 
 
 argparser = argparse.ArgumentParser()
 subcommands = argparser.add_subparsers(metavar='<command>')
 subcommands.required = True
 
-sub_build = subcommands.add_parser('build', help='Build graminized Docker image')
-sub_build.set_defaults(command=gsc_build)
-sub_build.add_argument('-b', '--buildtype', choices=['release', 'debug', 'debugoptimized'],
+# options of `gsc build`, shared with `gsc pipeline`
+build_options = argparse.ArgumentParser(add_help=False)
+build_options.add_argument('-b', '--buildtype', choices=['release', 'debug', 'debugoptimized'],
     default='release', help='Compile Gramine in release, debug or debugoptimized mode.')
 
-sub_build.add_argument('--insecure-args', action='store_true',
+build_options.add_argument('--insecure-args', action='store_true',
     help='Allow to specify untrusted arguments during Docker run. '
          'Otherwise arguments are ignored.')
-sub_build.add_argument('-nc', '--no-cache', action='store_true',
+build_options.add_argument('-nc', '--no-cache', action='store_true',
     help='Build graminized Docker image without any cached images.')
-sub_build.add_argument('--rm', action='store_true',
+build_options.add_argument('--rm', action='store_true',
     help='Remove intermediate Docker images when build is successful.')
-sub_build.add_argument('--build-arg', action='append', default=[],
+build_options.add_argument('--build-arg', action='append', default=[],
     help='Set build-time variables (same as "docker build --build-arg").')
-sub_build.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
+build_options.add_argument('--reuse-hashes', action='store_true',
+    help='Reuse trusted-file hashes of the previously built unsigned graminized image for files '
+         'whose size, modification time, inode number and change time did not change.')
+build_options.add_argument('--elf-closure', action='store_true',
+    help='Add only the executables of the application, the shared libraries they need and the '
+         '`TrustedFiles.DataPaths` from the config file as trusted files.')
+build_options.add_argument('--access-trace',
+    help='Add only files which the application opened or executed according to this Gramine trace '
+         'log or strace log as trusted files.')
+build_options.add_argument('--host-finalize', action='store_true',
+    help='Hash trusted files on the host directly from the image layers instead of inside a '
+         'container, and add the finalized manifest to the image as a single layer.')
+build_options.add_argument('--compile-cache', action='store_true',
+    help='Compile Gramine (if `Gramine.Image` is not set) from a local shallow mirror of the '
+         'Gramine repository and with a persistent compiler cache.')
+build_options.add_argument('--slim-runtime', action='store_true',
+    help='Copy only the Gramine files needed at runtime (loaders, PALs, LibOS, runtime libraries, '
+         'tools and their ELF closure) into the image instead of the whole Gramine installation.')
+build_options.add_argument('-j', '--finalize-jobs', type=int,
+    help='Number of parallel workers hashing trusted files inside the Docker image '
+         '(default: number of CPUs available to the Docker build).')
+build_options.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
     default='config.yaml', help='Specify configuration file.')
-sub_build.add_argument('image', help='Name of the application Docker image.')
-sub_build.add_argument('manifest', help='Manifest file to use.')
+build_options.add_argument('image', help='Name of the application Docker image.')
+build_options.add_argument('manifest', help='Manifest file to use.')
+
+sub_build = subcommands.add_parser('build', parents=[build_options],
+    help='Build graminized Docker image')
+sub_build.set_defaults(command=gsc_build)
+
+# options of the jobs of `gsc build-many`, which are built with its (already parsed) config file
+build_many_job_options = argparse.ArgumentParser(prog='gsc build-many job',
+                                                 parents=[build_options], add_help=False)
+build_many_job_options.set_defaults(config_file=None)
+
+sub_build_many = subcommands.add_parser('build-many',
+    help='Build several graminized Docker images concurrently')
+sub_build_many.set_defaults(command=gsc_build_many)
+sub_build_many.add_argument('-j', '--jobs', type=int, default=4,
+    help='Maximum number of concurrent Docker builds (default: 4).')
+sub_build_many.add_argument('-nc', '--no-cache', action='store_true',
+    help='Build graminized Docker images without any cached images.')
+sub_build_many.add_argument('--rm', action='store_true',
+    help='Remove intermediate Docker images when builds are successful.')
+sub_build_many.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
+    default='config.yaml', help='Specify configuration file.')
+sub_build_many.add_argument('job_file', type=argparse.FileType('r', encoding='UTF-8'),
+    help='YAML or JSON file with the list of images to graminize.')
 
 sub_build_gramine = subcommands.add_parser('build-gramine',
     help='Build base-Gramine Docker image')
@@ -729,6 +2825,9 @@ sub_build_gramine.add_argument('--rm', action='store_true',
     help='Remove intermediate Docker images when build is successful.')
 sub_build_gramine.add_argument('--build-arg', action='append', default=[],
     help='Set build-time variables (same as "docker build --build-arg").')
+sub_build_gramine.add_argument('--compile-cache', action='store_true',
+    help='Compile Gramine from a local shallow mirror of the Gramine repository and with a '
+         'persistent compiler cache.')
 sub_build_gramine.add_argument('-c', '--config_file',
     type=argparse.FileType('r', encoding='UTF-8'),
     default='config.yaml', help='Specify configuration file.')
@@ -737,25 +2836,59 @@ sub_build_gramine.add_argument('-f', '--file-only', action='store_true',
 sub_build_gramine.add_argument('image',
     help='Name of the output base-Gramine Docker image.')
 
-sub_sign = subcommands.add_parser('sign-image', help='Sign graminized Docker image')
-sub_sign.set_defaults(command=gsc_sign_image)
-sub_sign.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
-    default='config.yaml', help='Specify configuration file.')
-sub_sign.add_argument('image', help='Name of the application (base) Docker image.')
-sub_sign.add_argument('key', help='Key to sign the Intel SGX enclaves inside the Docker image.')
-sub_sign.add_argument('-p', '--passphrase', "--password", help='Passphrase for the signing key.')
-sub_sign.add_argument('-D','--define', action='append', default=[],
+# options of `gsc sign-image`, shared with `gsc pipeline`
+sign_options = argparse.ArgumentParser(add_help=False)
+sign_options.add_argument('-p', '--passphrase', "--password",
+    help='Passphrase for the signing key.')
+sign_options.add_argument('-D','--define', action='append', default=[],
     help='Set image sign-time variables.')
-sub_sign.add_argument('--remove-gramine-deps', action='append_const', dest='define',
+sign_options.add_argument('--thin-layer', action='store_true',
+    help='Sign in a temporary container of the unsigned image and add only the signature and the '
+         'SGX manifest as a single layer.')
+sign_options.add_argument('--squash', action='store_true',
+    help='Squash all layers added by GSC on top of the original image into a single layer of the '
+         'signed image; the layers of the original image are kept.')
+sign_options.add_argument('--remove-gramine-deps', action='append_const', dest='define',
     const='remove_gramine_deps=true', help='Remove Gramine dependencies that are not needed'
                                            ' at runtime.')
-sub_sign.add_argument('--no-remove-gramine-deps', action='append_const', dest='define',
+sign_options.add_argument('--no-remove-gramine-deps', action='append_const', dest='define',
     const='remove_gramine_deps=false', help='Retain Gramine dependencies that are not needed'
                                             ' at runtime.')
+
+sub_sign = subcommands.add_parser('sign-image', parents=[sign_options],
+    help='Sign graminized Docker image')
+sub_sign.set_defaults(command=gsc_sign_image)
+sub_sign.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
+    default='config.yaml', help='Specify configuration file.')
+sub_sign.add_argument('image', help='Name of the application (base) Docker image.')
+sub_sign.add_argument('key', help='Key to sign the Intel SGX enclaves inside the Docker image.')
+sub_sign_many = subcommands.add_parser('sign-many', parents=[sign_options],
+    help='Sign several graminized Docker images concurrently')
+sub_sign_many.set_defaults(command=gsc_sign_many)
+sub_sign_many.add_argument('-j', '--jobs', type=int, default=4,
+    help='Maximum number of images signed concurrently (default: 4).')
+sub_sign_many.add_argument('-c', '--config_file', type=argparse.FileType('r', encoding='UTF-8'),
+    default='config.yaml', help='Specify configuration file.')
+sub_sign_many.add_argument('key',
+    help='Key to sign the Intel SGX enclaves inside the Docker images.')
+sub_sign_many.add_argument('images', nargs='+', metavar='image',
+    help='Name of an application (base) Docker image.')
+
 sub_info = subcommands.add_parser('info-image', help='Retrieve information about a graminized '
                                   'Docker image')
 sub_info.set_defaults(command=gsc_info_image)
-sub_info.add_argument('image', help='Name of the graminized Docker image.')
+sub_info.add_argument('--format', choices=['toml', 'json', 'jsonl'], default='toml',
+    help='Output format: TOML (default), one JSON object with all images, or one JSON object per '
+         'line and image.')
+sub_info.add_argument('-j', '--jobs', type=int, default=8,
+    help='Maximum number of images inspected concurrently (default: 8).')
+sub_info.add_argument('images', nargs='+', metavar='image',
+    help='Names of the graminized Docker images.')
+
+sub_pipeline = subcommands.add_parser('pipeline', parents=[build_options, sign_options],
+    help='Build, sign and retrieve information about a graminized Docker image')
+sub_pipeline.set_defaults(command=gsc_pipeline)
+sub_pipeline.add_argument('key', help='Key to sign the Intel SGX enclaves inside the Docker image.')
 
 def main(args):
     args = argparser.parse_args()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2024 Intel Corp.
+
+# Benchmarks of the manifest finalization pipeline of GSC on synthetic directory trees. Runs
+# locally against a plain directory, no Docker daemon is required. See README.rst for usage.
+
+import argparse
+import copy
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import finalize_manifest # pylint: disable=wrong-import-position
+
+# Trees are created inside `--dir`; a tree is reused by later runs if its marker file exists
+TREE_MARKER = '.gsc_bench_tree_complete'
+
+# Block of pseudo-random data repeated to fill large files, so that writing them is cheap while
+# hashing them costs the same as for real data
+LARGE_FILE_BLOCK = os.urandom(1024 * 1024)
+
+# Paths under these directories are always excluded by `generate_trusted_files()`
+EXCLUDED_ROOT_DIRS = ['/boot', '/dev', '/proc', '/sys', '/var']
+
+def create_file(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = LARGE_FILE_BLOCK[:size]
+            f.write(block)
+            size -= len(block)
+
+def create_small_files(root, num_files, files_per_dir=1000):
+    # two-level layout similar to package trees, e.g. `d0012/d0003/f0042`; file sizes cycle through
+    # typical sizes of small files (0.5-16 KiB)
+    sizes = [512, 1024, 2048, 4096, 8192, 16384]
+    for i in range(num_files):
+        dirpath = os.path.join(root, f'd{i // files_per_dir // 100:04}',
+                               f'd{i // files_per_dir % 100:04}')
+        if i % files_per_dir == 0:
+            os.makedirs(dirpath, exist_ok=True)
+        create_file(os.path.join(dirpath, f'f{i % files_per_dir:04}'), sizes[i % len(sizes)])
+
+def create_large_files(root, num_files, file_size):
+    # similar to the model files of Examples/openvino
+    os.makedirs(os.path.join(root, 'models'))
+    for i in range(num_files):
+        create_file(os.path.join(root, 'models', f'model{i}.bin'), file_size)
+
+def create_deep_tree(root, depth):
+    dirpath = root
+    for i in range(depth):
+        dirpath = os.path.join(dirpath, 'd')
+        os.mkdir(dirpath)
+        create_file(os.path.join(dirpath, f'f{i}'), 1024)
+
+def create_symlink_farm(root, num_libs):
+    # merged-/usr layout: `/bin`, `/sbin`, `/lib` and `/lib64` are symlinks into `/usr`, and shared
+    # libraries come with `libN.so -> libN.so.1 -> libN.so.1.2.3` symlink chains
+    libdir = os.path.join(root, 'usr', 'lib', 'x86_64-linux-gnu')
+    os.makedirs(libdir)
+    for dirname in ('bin', 'sbin', 'lib64'):
+        os.makedirs(os.path.join(root, 'usr', dirname))
+    for i in range(num_libs):
+        create_file(os.path.join(libdir, f'lib{i}.so.1.2.3'), 64 * 1024)
+        os.symlink(f'lib{i}.so.1.2.3', os.path.join(libdir, f'lib{i}.so.1'))
+        os.symlink(f'lib{i}.so.1', os.path.join(libdir, f'lib{i}.so'))
+        if i % 10 == 0:
+            create_file(os.path.join(root, 'usr', 'bin', f'prog{i}'), 32 * 1024)
+            os.link(os.path.join(root, 'usr', 'bin', f'prog{i}'),
+                    os.path.join(root, 'usr', 'sbin', f'prog{i}'))
+    os.symlink('../lib/x86_64-linux-gnu/libc.so.6', os.path.join(root, 'usr', 'lib64', 'libc.so'))
+    create_file(os.path.join(libdir, 'libc.so.6'), 2 * 1024 * 1024)
+    for dirname in ('bin', 'sbin', 'lib', 'lib64'):
+        os.symlink(os.path.join('usr', dirname), os.path.join(root, dirname))
+
+def scenarios(args):
+    # name -> function creating the tree in the given (empty) directory
+    return {
+        'small-10k': lambda root: create_small_files(root, 10_000),
+        'small-100k': lambda root: create_small_files(root, 100_000),
+        'small-1m': lambda root: create_small_files(root, 1_000_000),
+        'large': lambda root: create_large_files(root, args.large_files,
+                                                 args.large_file_size * 2**30),
+        'deep': lambda root: create_deep_tree(root, args.depth),
+        'symlinks': lambda root: create_symlink_farm(root, args.libs),
+    }
+
+def prepare_tree(root, create):
+    if os.path.exists(os.path.join(root, TREE_MARKER)):
+        return 0.0
+    if os.path.exists(root):
+        # left over from an interrupted run
+        shutil.rmtree(root)
+    os.makedirs(root)
+    start = time.perf_counter()
+    create(root)
+    with open(os.path.join(root, TREE_MARKER), 'w'):
+        pass
+    return time.perf_counter() - start
+
+def consume(iterable):
+    num_items = 0
+    for _ in iterable:
+        num_items += 1
+    return num_items
+
+def stage_walk(root, args):
+    return consume(finalize_manifest.generate_trusted_files(root, []))
+
+def stage_hash(root, args):
+    trusted_files = finalize_manifest.generate_trusted_files(root, [])
+    return consume(finalize_manifest.expand_trusted_files(trusted_files, num_workers=args.jobs))
+
+def stage_finalize(root, args):
+    # complete pipeline including writing the manifest, as in `finalize_manifest.main()`
+    trusted_files = finalize_manifest.expand_trusted_files(
+        finalize_manifest.generate_trusted_files(root, []), num_workers=args.jobs)
+    manifest_path = os.path.join(args.dir, 'bench.manifest')
+    finalize_manifest.write_manifest(manifest_path, {'sgx': {'debug': True}}, trusted_files)
+    num_bytes = os.path.getsize(manifest_path)
+    os.remove(manifest_path)
+    return num_bytes
+
+def stage_library_paths(args):
+    return len(finalize_manifest.generate_library_paths().split(':'))
+
+def stage_merge_manifests(args):
+    # pylint: disable=import-outside-toplevel
+    # requires the Python packages of `gsc` (but not the Docker daemon)
+    import gsc
+
+    num_entries = args.merge_entries
+    user_manifest = {
+        'loader': {'env': {f'USER_VAR{i}': str(i) for i in range(100)}},
+        'sgx': {'trusted_files': [f'file:/app/data/f{i}' for i in range(num_entries)],
+                'allowed_files': [f'file:/app/logs/f{i}' for i in range(num_entries // 10)]},
+        'fs': {'mounts': [{'path': f'/mnt{i}', 'uri': f'file:/mnt{i}'} for i in range(100)]},
+    }
+    entrypoint_manifest = {
+        'libos': {'entrypoint': '/gramine/app_files/app'},
+        'loader': {'env': {'LD_LIBRARY_PATH': '/lib', 'PATH': '/usr/bin'}},
+        'sgx': {'trusted_files': [f'file:/usr/lib/f{i}' for i in range(num_entries)],
+                'debug': True},
+    }
+    image_env = {'loader': {'env': {f'IMAGE_VAR{i}': str(i) for i in range(100)}}}
+
+    # merging modifies the manifests, so they are copied for each round (not timed)
+    seconds = 0.0
+    for _ in range(args.merge_rounds):
+        manifest1, manifest2, manifest3 = copy.deepcopy((user_manifest, entrypoint_manifest,
+                                                         image_env))
+        start = time.perf_counter()
+        merged = gsc.merge_manifests_in_order(manifest1, manifest2, 'user', 'entrypoint')
+        merged = gsc.merge_manifests_in_order(merged, manifest3, 'merged', 'image env')
+        seconds += time.perf_counter() - start
+    return len(merged['sgx']['trusted_files']), seconds
+
+def run_stage_in_child(function, stage_args, result_queue):
+    # each stage runs in a forked child, so that `ru_maxrss` is the peak memory of this stage only
+    stdout = sys.stdout
+    if not stage_args[-1].verbose:
+        sys.stdout = io.StringIO()
+    try:
+        start = time.perf_counter()
+        items = function(*stage_args)
+        seconds = time.perf_counter() - start
+        if isinstance(items, tuple):
+            # the stage timed itself (to exclude its setup)
+            items, seconds = items
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        result_queue.put({'seconds': round(seconds, 3), 'items': items,
+                          'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+                          'peak_rss_mib': round(rusage.ru_maxrss / 1024, 1)})
+    except Exception: # pylint: disable=broad-except
+        result_queue.put({'error': traceback.format_exc().strip().splitlines()[-1]})
+    finally:
+        sys.stdout = stdout
+
+def run_stage(function, *stage_args):
+    context = multiprocessing.get_context('fork')
+    result_queue = context.Queue()
+    process = context.Process(target=run_stage_in_child, args=(function, stage_args, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+def print_result(scenario, stage, result):
+    if 'error' in result:
+        print(f'{scenario:<12} {stage:<16} failed: {result["error"]}')
+        return
+    print(f'{scenario:<12} {stage:<16} {result["seconds"]:>10.3f} {result["cpu_seconds"]:>10.3f} '
+          f'{result["peak_rss_mib"]:>10.1f} {result["items"]:>12}')
+
+argparser = argparse.ArgumentParser(
+    description='Benchmark the manifest finalization pipeline of GSC on synthetic trees.')
+argparser.add_argument('-d', '--dir', required=True,
+    help='Directory in which the synthetic trees are created (reused by later runs).')
+argparser.add_argument('-s', '--scenario', action='append', dest='scenarios',
+    choices=['small-10k', 'small-100k', 'small-1m', 'large', 'deep', 'symlinks'],
+    help='Scenario to run (may be repeated; default: small-10k, deep and symlinks).')
+argparser.add_argument('-j', '--jobs', type=int, default=finalize_manifest.default_num_workers(),
+    help='Number of parallel hashing workers (default: number of available CPUs).')
+argparser.add_argument('--large-files', type=int, default=3,
+    help='Number of files in the `large` scenario (default: 3).')
+argparser.add_argument('--large-file-size', type=int, default=2,
+    help='Size of each file in the `large` scenario in GiB (default: 2).')
+argparser.add_argument('--depth', type=int, default=1000,
+    help='Depth of the `deep` scenario (default: 1000).')
+argparser.add_argument('--libs', type=int, default=5000,
+    help='Number of shared libraries in the `symlinks` scenario (default: 5000).')
+argparser.add_argument('--merge-entries', type=int, default=100_000,
+    help='Number of trusted files in each manifest merged by `merge_manifests_in_order()` '
+         '(default: 100000).')
+argparser.add_argument('--merge-rounds', type=int, default=10,
+    help='Number of repetitions of merging the manifests (default: 10).')
+argparser.add_argument('--json', help='Write the results to this JSON file.')
+argparser.add_argument('--cleanup', action='store_true',
+    help='Remove the synthetic trees after the benchmark.')
+argparser.add_argument('-v', '--verbose', action='store_true',
+    help='Show the output of the benchmarked functions.')
+
+def main(args=None):
+    args = argparser.parse_args(args[1:])
+    args.dir = os.path.abspath(args.dir)
+    if any(args.dir == path or args.dir.startswith(path + '/') for path in EXCLUDED_ROOT_DIRS):
+        argparser.error(f'`{args.dir}` is excluded from trusted files by GSC, use another '
+                        f'directory.')
+    os.makedirs(args.dir, exist_ok=True)
+
+    results = {
+        'python': platform.python_version(),
+        'cpus': finalize_manifest.default_num_workers(),
+        'jobs': args.jobs,
+        'scenarios': {},
+    }
+    print(f'{"scenario":<12} {"stage":<16} {"seconds":>10} {"cpu [s]":>10} {"RSS [MiB]":>10} '
+          f'{"items":>12}')
+
+    all_scenarios = scenarios(args)
+    for scenario in args.scenarios or ['small-10k', 'deep', 'symlinks']:
+        root = os.path.join(args.dir, scenario)
+        setup_seconds = prepare_tree(root, all_scenarios[scenario])
+        if setup_seconds:
+            print(f'{scenario:<12} {"(create tree)":<16} {setup_seconds:>10.3f}')
+
+        # note that the first stage reads the tree from disk, while the later ones may find it in
+        # the page cache
+        scenario_results = {}
+        for stage, function in (('walk', stage_walk), ('walk+hash', stage_hash),
+                                ('finalize', stage_finalize)):
+            scenario_results[stage] = run_stage(function, root, args)
+            print_result(scenario, stage, scenario_results[stage])
+        results['scenarios'][scenario] = scenario_results
+
+        if args.cleanup:
+            shutil.rmtree(root)
+
+    results['library_paths'] = run_stage(stage_library_paths, args)
+    print_result('-', 'library_paths', results['library_paths'])
+    results['merge_manifests'] = run_stage(stage_merge_manifests, args)
+    print_result('-', 'merge_manifests', results['merge_manifests'])
+
+    if args.json:
+        with open(args.json, 'w', encoding='UTF-8') as json_file:
+            json.dump(results, json_file, indent=4)
+            json_file.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,435 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2024 Intel Corp.
+
+# Unit tests of finalize_manifest.py on small directory trees created by the tests. Run with
+# `python3 -m pytest test/`.
+
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+
+import pytest
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = pytest.importorskip('tomli')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import finalize_manifest # pylint: disable=wrong-import-position
+
+
+def write_file(path, data=b''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+# Hashing in parallel (`--jobs`)
+
+def test_parallel_hashing_writes_identical_manifest(tmp_path):
+    # more files than fit in the window of pending hashes, with sizes spanning several hash blocks
+    # so that hashes complete out of order
+    for i in range(3 * finalize_manifest.PENDING_FILES_PER_WORKER):
+        size = (i * 7919) % (3 * finalize_manifest.HASH_BLOCK_SIZE) if i % 16 == 0 else i
+        write_file(tmp_path / 'root' / f'dir{i % 5}' / f'file{i}', bytes([i % 256]) * size)
+    os.symlink('dir0', tmp_path / 'root' / 'alias')
+
+    manifests = []
+    for num_workers in (1, 4):
+        manifest_path = str(tmp_path / f'entrypoint.manifest.{num_workers}')
+        trusted_files = finalize_manifest.generate_trusted_files(str(tmp_path / 'root'), [])
+        finalize_manifest.write_manifest(manifest_path, {'sgx': {'enclave_size': '4G'}},
+                                         finalize_manifest.expand_trusted_files(
+                                             trusted_files, num_workers=num_workers))
+        with open(manifest_path, 'rb') as manifest_file:
+            manifests.append(manifest_file.read())
+    assert manifests[0] == manifests[1]
+
+
+# Hashing each inode once (`expand_trusted_files()`)
+
+def test_expand_trusted_files_hashes_hardlinks_once(tmp_path, monkeypatch):
+    first = write_file(tmp_path / 'first', b'same data')
+    hardlink = str(tmp_path / 'hardlink')
+    os.link(first, hardlink)
+    # same contents, but a different inode
+    copy = write_file(tmp_path / 'copy', b'same data')
+    other = write_file(tmp_path / 'other', b'other data')
+
+    hashed = []
+    compute_sha256 = finalize_manifest.compute_sha256
+    def counting_compute_sha256(filename):
+        hashed.append(str(filename))
+        return compute_sha256(filename)
+    monkeypatch.setattr(finalize_manifest, 'compute_sha256', counting_compute_sha256)
+
+    paths = [first, copy, hardlink, other]
+    entries = list(finalize_manifest.expand_trusted_files(
+        [(f'file:{path}', False) for path in paths], num_workers=2))
+    assert entries == [{'uri': f'file:{path}', 'sha256': compute_sha256(path)} for path in paths]
+    # `hardlink` shares the inode (`st_dev`, `st_ino`) of `first`
+    assert sorted(hashed) == sorted([first, copy, other])
+
+
+# Hash indexes (`--hash-index`, `--strict-hash-index`)
+
+def test_hash_index_reuse(tmp_path):
+    path = write_file(tmp_path / 'file', b'data')
+    index_path = str(tmp_path / 'index.json')
+    new_hash_index = {}
+    list(finalize_manifest.expand_trusted_files([(f'file:{path}', False)],
+                                                new_hash_index=new_hash_index))
+    # pretend that the file had a different hash, to see whether it gets reused
+    new_hash_index[path][2] = 'indexed'
+    finalize_manifest.write_hash_index(index_path, new_hash_index)
+
+    def expand(**hash_indexes):
+        return list(finalize_manifest.expand_trusted_files([(f'file:{path}', False)],
+                                                           **hash_indexes))[0]['sha256']
+
+    hash_index = finalize_manifest.load_hash_index([index_path])
+    strict_hash_index = finalize_manifest.load_hash_index([index_path], strict=True)
+    assert expand(hash_index=hash_index) == 'indexed'
+    assert expand(strict_hash_index=strict_hash_index) == 'indexed'
+
+    # rewriting the file with the same size and mtime changes its ctime (and possibly inode)
+    stat = os.stat(path)
+    os.unlink(path)
+    write_file(path, b'DATA')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    if (os.stat(path).st_ino, os.stat(path).st_ctime_ns) == (stat.st_ino, stat.st_ctime_ns):
+        pytest.skip('the file system does not update inode numbers or ctimes')
+    assert expand(hash_index=hash_index) == 'indexed'
+    assert expand(strict_hash_index=strict_hash_index) == finalize_manifest.compute_sha256(path)
+
+def test_load_hash_index_confined_to_its_directory(tmp_path):
+    entry = [1, 2, 'hash', 3, 4]
+    index_path = write_file(tmp_path / 'gramine' / 'index.json', json.dumps(
+        {'version': 1, 'files': {str(tmp_path / 'gramine' / 'lib' / 'a'): entry,
+                                 str(tmp_path / 'gramine-other'): entry, '/etc/passwd': entry}
+        }).encode())
+    assert finalize_manifest.load_hash_index([index_path]) == {
+        str(tmp_path / 'gramine' / 'lib' / 'a'): entry[:3]}
+    # files anywhere may be listed in a strict index
+    assert len(finalize_manifest.load_hash_index([index_path], strict=True)) == 3
+
+def test_filter_hash_index(tmp_path):
+    index_path = write_file(tmp_path / 'index.json', json.dumps(
+        {'version': 1, 'files': {'/a': [1, 2, 'a', 3, 4], '/b': [1, 2, 'b', 3, 4]}}).encode())
+    finalize_manifest.filter_hash_index(index_path, str(tmp_path / 'new.json'), ['/b', '/c'])
+    with open(tmp_path / 'new.json') as index_file:
+        assert json.load(index_file) == {'version': 1, 'files': {'/b': [1, 2, 'b', 3, 4]}}
+
+
+# Walking the file system (`walk_files()`)
+
+def test_walk_files_symlink_cycles(tmp_path, capsys):
+    data = write_file(tmp_path / 'root' / 'dir' / 'data', b'data')
+    os.symlink('..', tmp_path / 'root' / 'dir' / 'parent')
+    os.symlink('.', tmp_path / 'root' / 'dir' / 'self')
+    # a symlinked directory which is not an ancestor is walked (again)
+    os.symlink('dir', tmp_path / 'root' / 'alias')
+    os.symlink(data, tmp_path / 'root' / 'dir' / 'link')
+
+    walked = list(finalize_manifest.walk_files(str(tmp_path / 'root'),
+                                               finalize_manifest.EXCLUDED_PATHS_RE))
+    root = os.fsencode(tmp_path / 'root')
+    assert sorted(walked) == sorted([
+        (root + b'/dir/data', False),
+        (root + b'/dir/link', True),
+        (root + b'/alias/data', True),
+        (root + b'/alias/link', True),
+    ])
+    # within a directory, symlinks come first
+    assert walked.index((root + b'/dir/link', True)) < walked.index((root + b'/dir/data', False))
+    output = capsys.readouterr().out
+    assert f'Skipping directory {tmp_path}/root/dir/parent: symlink cycle detected.' in output
+    assert f'Skipping directory {tmp_path}/root/dir/self: symlink cycle detected.' in output
+
+
+# `TrustedFiles.Exclude` and `TrustedFiles.Include`
+
+def test_exclusion_rules_include_takes_precedence():
+    rules = finalize_manifest.ExclusionRules(['/usr/share/locale', '/usr/share/*/man'],
+                                             ['/usr/share/locale/en_US'])
+    # the directory must still be entered to reach the included subdirectory
+    assert not rules.prune_dir('/usr/share/locale')
+    assert rules.prune_dir('/usr/share/locale/de')
+    assert not rules.prune_dir('/usr/share/locale/en_US')
+    assert rules.prune_dir('/usr/share/x/man')
+    assert not rules.prune_dir('/usr/share/doc')
+    assert rules.exclude_file('/usr/share/locale/locale.alias', size=10)
+    assert not rules.exclude_file('/usr/share/locale/en_US/LC_MESSAGES/app.mo', size=10)
+    assert not rules.exclude_file('/usr/share/localedata', size=10)
+    assert rules.saved == {'/usr/share/locale': [1, 10, 1], '/usr/share/*/man': [0, 0, 1]}
+
+def test_generate_trusted_files_with_exclusion_rules(tmp_path, capsys):
+    locale = tmp_path / 'usr' / 'share' / 'locale'
+    kept = {write_file(locale / 'en_US' / 'LC_MESSAGES' / 'app.mo', b'en'),
+            write_file(tmp_path / 'usr' / 'share' / 'doc' / 'README', b'doc')}
+    write_file(locale / 'locale.alias', b'alias')
+    write_file(locale / 'de' / 'LC_MESSAGES' / 'app.mo', b'de')
+    rules = finalize_manifest.ExclusionRules([str(locale)], [str(locale / 'en_US')])
+    trusted_files = finalize_manifest.generate_trusted_files(str(tmp_path), [], rules)
+    assert {uri for uri, _ in trusted_files} == {f'file:{path}' for path in kept}
+    # `de/` is pruned without being walked, so only `locale.alias` is counted as a file
+    assert rules.saved == {str(locale): [1, len(b'alias'), 1]}
+    rules.print_report(prefix='')
+    assert (f'Exclude rule `{locale}` removed 1 files (0.0 MiB) and 1 whole directories'
+            in capsys.readouterr().out)
+
+
+# Streaming the manifest (`write_manifest()`)
+
+def test_write_manifest_round_trip(tmp_path):
+    manifest_path = str(tmp_path / 'entrypoint.manifest')
+    manifest_dict = {
+        'libos': {'entrypoint': '/usr/bin/python3'},
+        'loader': {'env': {'LD_LIBRARY_PATH': '/lib:/usr/lib'}, 'insecure__use_cmdline_argv': True},
+        'fs': {'mounts': [{'path': '/tmp', 'type': 'tmpfs'}]},
+        'sgx': {'enclave_size': '4G', 'allowed_files': ['file:/etc/hosts']},
+    }
+    trusted_files = [{'uri': f'file:/app/{name}', 'sha256': f'{i:064x}'}
+                     for i, name in enumerate(['app.py', 'quote"d', 'back\\slash', 'ünïcode'])]
+    written = []
+    def stream():
+        for entry in trusted_files:
+            written.append(entry)
+            yield entry
+    finalize_manifest.write_manifest(manifest_path, manifest_dict, stream())
+    assert written == trusted_files
+    assert not os.path.exists(f'{manifest_path}.tmp')
+
+    expected = {**manifest_dict, 'sgx': {**manifest_dict['sgx'], 'trusted_files': trusted_files}}
+    with open(manifest_path, 'rb') as manifest_file:
+        assert tomllib.load(manifest_file) == expected
+
+    if shutil.which('gramine-manifest') is None:
+        return
+    output = subprocess.run(['gramine-manifest', manifest_path], check=True,
+                            stdout=subprocess.PIPE).stdout
+    assert tomllib.loads(output.decode('UTF-8')) == expected
+
+def test_write_manifest_without_trusted_files(tmp_path):
+    manifest_path = str(tmp_path / 'entrypoint.manifest')
+    manifest_dict = {'sgx': {'enclave_size': '4G'}}
+    finalize_manifest.write_manifest(manifest_path, manifest_dict, iter([]))
+    with open(manifest_path, 'rb') as manifest_file:
+        assert tomllib.load(manifest_file) == {'sgx': {'enclave_size': '4G', 'trusted_files': []}}
+
+    # e.g. with `allow_all_but_log`, the manifest is written as it is
+    finalize_manifest.write_manifest(manifest_path, manifest_dict)
+    with open(manifest_path, 'rb') as manifest_file:
+        assert tomllib.load(manifest_file) == manifest_dict
+
+
+# ELF dependency closure (`--elf-closure`)
+
+def write_elf(path, machine=62, interp=None, needed=(), runpath=None):
+    # a minimal little-endian ELF64 file with a `PT_INTERP` segment, and a `PT_DYNAMIC` segment
+    # whose string table is in a `PT_LOAD` segment covering the whole file
+    strtab = b'\0'
+    dynamic = []
+    for name in needed:
+        dynamic.append((finalize_manifest.DT_NEEDED, len(strtab)))
+        strtab += name.encode() + b'\0'
+    if runpath is not None:
+        dynamic.append((finalize_manifest.DT_RUNPATH, len(strtab)))
+        strtab += runpath.encode() + b'\0'
+    interp = interp.encode() + b'\0' if interp is not None else b''
+
+    phnum = 3 if interp else 2
+    strtab_offset = 64 + 56 * phnum
+    interp_offset = strtab_offset + len(strtab)
+    dynamic_offset = interp_offset + len(interp)
+    dynamic += [(finalize_manifest.DT_STRTAB, strtab_offset),
+                (finalize_manifest.DT_STRSZ, len(strtab)), (finalize_manifest.DT_NULL, 0)]
+    dynamic = b''.join(struct.pack('<qQ', tag, val) for tag, val in dynamic)
+    size = dynamic_offset + len(dynamic)
+
+    phdrs = [(finalize_manifest.PT_LOAD, 0, size), (finalize_manifest.PT_DYNAMIC, dynamic_offset,
+                                                    len(dynamic))]
+    if interp:
+        phdrs.append((finalize_manifest.PT_INTERP, interp_offset, len(interp)))
+    data = finalize_manifest.ELF_MAGIC + bytes([2, finalize_manifest.ELFDATA2LSB, 1]) + bytes(9)
+    data += struct.pack('<HHIQQQIHHHHHH', 3, machine, 1, 0, 64, 0, 0, 64, 56, phnum, 64, 0, 0)
+    for p_type, p_offset, p_filesz in phdrs:
+        data += struct.pack('<IIQQQQQQ', p_type, 4, p_offset, p_offset, p_offset, p_filesz,
+                            p_filesz, 8)
+    return write_file(path, data + strtab + interp + dynamic)
+
+def test_generate_elf_closure(tmp_path):
+    root = os.path.realpath(tmp_path)
+    interp = write_elf(f'{root}/lib/ld-linux.so')
+    env = write_elf(f'{root}/bin/env')
+    app = write_elf(f'{root}/app/bin/app', interp=interp, needed=['libfoo.so.1'],
+                    runpath='$ORIGIN/../lib')
+    os.chmod(app, 0o755)
+    libfoo = write_elf(f'{root}/app/lib/libfoo.so.1.2', needed=['libbar.so'])
+    os.symlink('libfoo.so.1.2', f'{root}/app/lib/libfoo.so.1')
+    write_elf(f'{root}/app/lib/libunused.so')
+    # found first in `LD_LIBRARY_PATH`, but for another architecture
+    write_elf(f'{root}/ld-other/libbar.so', machine=183)
+    libbar = write_elf(f'{root}/ld/libbar.so')
+    script = write_file(f'{root}/app/bin/run.sh', f'#!{env} app\n'.encode())
+
+    assert finalize_manifest.read_elf_info(app) == {
+        'class': 2, 'machine': 62, 'interp': interp, 'needed': ['libfoo.so.1'], 'rpath': [],
+        'runpath': ['$ORIGIN/../lib'],
+    }
+    closure = list(finalize_manifest.generate_elf_closure(
+        [script], f'{root}/ld-other:{root}/ld', f'{root}/app/bin'))
+    assert sorted(closure) == sorted([script, env, app, interp, f'{root}/app/lib/libfoo.so.1',
+                                      libfoo, libbar])
+
+    with pytest.raises(finalize_manifest.ManifestError):
+        list(finalize_manifest.generate_elf_closure([f'{root}/missing'], '', ''))
+
+
+# Access traces (`--access-trace`)
+
+GRAMINE_TRACE = '''\
+[P1:T1:python3] trace: ---- openat(AT_FDCWD, "/etc/ld.so.cache", O_RDONLY|0x80000, 0000) = 0x3
+[P1:T1:python3] trace: ---- openat(AT_FDCWD, "/usr/lib/missing.py", O_RDONLY|0x80000, 0000) = -2
+[P1:T1:python3] trace: ---- open("/app/data.bin", O_RDONLY, 0000) = 0x4
+[P1:T1:python3] trace: ---- execve("/usr/bin/ls", [ls,], [PATH=/usr/bin,]) ...
+[P1:T1:python3] trace: ---- execve("/usr/bin/ls", [ls,], [PATH=/usr/bin,]) = 0x0
+[P1:T1:python3] trace: ---- stat("/etc/hosts", 0x7ffd) = 0x0
+[P1:T1:python3] trace: ---- openat(AT_FDCWD, "relative.txt", O_RDONLY, 0000) = 0x5
+'''
+
+STRACE_TRACE = '''\
+12345 execve("/usr/bin/python3", ["python3", "app.py"], 0x7ffd1a2b3c40 /* 9 vars */) = 0
+12345 openat(AT_FDCWD, "/lib/x86_64-linux-gnu/libc.so.6", O_RDONLY|O_CLOEXEC) = 3
+[pid 12346] openat(AT_FDCWD, "/nonexistent", O_RDONLY) = -1 ENOENT (No such file or directory)
+[pid 12347] openat(AT_FDCWD, "/etc/resolv.conf", O_RDONLY|O_CLOEXEC <unfinished ...>
+[pid 12347] <... openat resumed>) = 6
+12345 openat(AT_FDCWD, "/tmp/quote\\"d", O_RDONLY) = 7
+12345 creat("/tmp/new", 0644) = 8
+'''
+
+def test_access_trace_re_gramine():
+    matches = [finalize_manifest.ACCESS_TRACE_RE.search(line)
+               for line in GRAMINE_TRACE.splitlines()]
+    assert [(m.group(1), m.group(2)) if m else None for m in matches] == [
+        ('/etc/ld.so.cache', ''),
+        ('/usr/lib/missing.py', '-'),
+        ('/app/data.bin', ''),
+        None,
+        ('/usr/bin/ls', ''),
+        None,
+        ('relative.txt', ''),
+    ]
+
+def test_access_trace_re_strace():
+    matches = [finalize_manifest.ACCESS_TRACE_RE.search(line)
+               for line in STRACE_TRACE.splitlines()]
+    assert [(m.group(1), m.group(2)) if m else None for m in matches] == [
+        ('/usr/bin/python3', ''),
+        ('/lib/x86_64-linux-gnu/libc.so.6', ''),
+        ('/nonexistent', '-'),
+        ('/etc/resolv.conf', None),
+        None,
+        ('/tmp/quote\\"d', ''),
+        ('/tmp/new', ''),
+    ]
+
+@pytest.mark.parametrize('trace, expected', [
+    (GRAMINE_TRACE, {'/etc/ld.so.cache', '/app/data.bin', '/usr/bin/ls'}),
+    (STRACE_TRACE, {'/usr/bin/python3', '/lib/x86_64-linux-gnu/libc.so.6', '/etc/resolv.conf',
+                    '/tmp/quote"d', '/tmp/new'}),
+])
+def test_read_access_trace(tmp_path, trace, expected):
+    trace_path = write_file(tmp_path / 'trace.log', trace.encode())
+    accessed = finalize_manifest.read_access_trace(trace_path)
+    # real paths are added as well
+    assert expected <= accessed
+    assert accessed <= expected | {os.path.realpath(path) for path in expected}
+
+def test_add_gramine_runtime_paths(tmp_path):
+    runtime_dir = tmp_path / 'runtime' / 'glibc'
+    libc = write_file(runtime_dir / 'libc.so.6')
+    accessed = {'/lib/x86_64-linux-gnu/libc.so.6', '/etc/hosts'}
+    assert finalize_manifest.add_gramine_runtime_paths(accessed, []) == accessed
+    mapped = finalize_manifest.add_gramine_runtime_paths(accessed, [str(runtime_dir)])
+    assert mapped == accessed | {libc, os.path.realpath(libc)}
+
+def test_prune_to_access_trace(tmp_path):
+    files = {name: write_file(tmp_path / name, b'x' * 10) for name in ('app', 'lib', 'data', 'doc')}
+    trusted_files = [(f'file:{path}', False) for path in files.values()]
+    kept = list(finalize_manifest.prune_to_access_trace(iter(trusted_files), {files['data']},
+                                                        [files['app'], files['lib']]))
+    assert kept == [(f'file:{files[name]}', False) for name in ('app', 'lib', 'data')]
+
+def test_access_trace_keeps_elf_closure_of_entrypoint():
+    # the ELF interpreter and libraries of the app are loaded without syscalls in the trace, so
+    # `main()` keeps the closure of the entrypoints
+    binary = shutil.which('true')
+    if binary is None or finalize_manifest.read_elf_info(os.path.realpath(binary)) is None:
+        pytest.skip('no dynamically linked `true` binary')
+    binary = os.path.realpath(binary)
+    elf_info = finalize_manifest.read_elf_info(binary)
+    if not elf_info['needed']:
+        pytest.skip('`true` is statically linked')
+    manifest = {'libos': {'entrypoint': binary},
+                'loader': {'env': {'LD_LIBRARY_PATH': finalize_manifest.generate_library_paths()}}}
+    roots, ld_library_path, exec_path = finalize_manifest.get_closure_roots(manifest)
+    keep = set(finalize_manifest.generate_elf_closure(roots, ld_library_path, exec_path))
+    assert binary in keep
+    assert elf_info['interp'] in keep
+    assert any(os.path.basename(path) == 'libc.so.6' for path in keep)
+
+
+# Runtime payload of the Gramine installation (`--runtime-payload`)
+
+def test_generate_runtime_payload_from_meson_install_plan(tmp_path):
+    prefix = tmp_path / 'meson_build_output'
+    build_dir = tmp_path / 'build'
+    libdir = prefix / 'lib' / 'x86_64-linux-gnu'
+    python_dir = libdir / 'python3.12' / 'site-packages' / 'graminelibos'
+    # (source in the build directory, installed path, install tag)
+    installed_files = [
+        ('libos/src/libsysdb.so', libdir / 'gramine' / 'libsysdb.so', 'runtime'),
+        ('pal/src/host/linux/libpal.so', libdir / 'gramine' / 'direct' / 'libpal.so', 'runtime'),
+        ('pal/src/host/linux-sgx/libpal.so', libdir / 'gramine' / 'sgx' / 'libpal.so', 'runtime'),
+        ('pal/src/host/linux-sgx/loader', libdir / 'gramine' / 'sgx' / 'loader', 'runtime'),
+        ('python/graminelibos/__init__.py', python_dir / '__init__.py', 'python-runtime'),
+        ('python/graminelibos/sgx_sign.py', python_dir / 'sgx_sign.py', 'python-runtime'),
+        ('tools/gramine-sgx-sign', prefix / 'bin' / 'gramine-sgx-sign', None),
+        ('libos/include/gramine.h', prefix / 'include' / 'gramine' / 'gramine.h', 'devel'),
+        ('meson-private/gramine.pc', libdir / 'pkgconfig' / 'gramine.pc', 'devel'),
+        ('subprojects/mbedtls/libmbedcrypto_gramine.a', libdir / 'libmbedcrypto_gramine.a',
+         'devel'),
+    ]
+    for _, path, _ in installed_files:
+        write_file(path, b'data')
+    os.symlink('graminelibos', python_dir.parent / 'gramine')
+    write_file(prefix / 'gsc_hash_index.json', b'{}')
+    write_file(prefix / 'share' / 'leftover.txt', b'not installed by meson')
+
+    install_plan = {'targets': {}, 'data': {}, 'python': {}, 'headers': {}}
+    installed = {}
+    for source, path, tag in installed_files:
+        section = ('headers' if tag == 'devel' and source.endswith('.h') else
+                   'python' if tag == 'python-runtime' else 'targets')
+        source = str(build_dir / source)
+        install_plan[section][source] = {'destination': '{prefix}/...', 'tag': tag,
+                                         'subproject': None}
+        installed[source] = str(path)
+    write_file(build_dir / 'meson-info' / 'intro-install_plan.json',
+               json.dumps(install_plan).encode())
+    write_file(build_dir / 'meson-info' / 'intro-installed.json', json.dumps(installed).encode())
+
+    payload = finalize_manifest.generate_runtime_payload(str(prefix), str(build_dir))
+    expected = [path for _, path, tag in installed_files if tag != 'devel']
+    expected += [python_dir.parent / 'gramine', prefix / 'gsc_hash_index.json']
+    assert payload == sorted(os.path.relpath(path, prefix) for path in expected)
+
+    # without an install plan, the whole installation is kept
+    payload = finalize_manifest.generate_runtime_payload(str(prefix), str(tmp_path / 'missing'))
+    assert len(payload) == len(installed_files) + 3